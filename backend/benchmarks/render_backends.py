@@ -0,0 +1,195 @@
+"""
+Head-to-head benchmark of the rasterization backends behind /convertPng.
+
+Renders the same pages through each backend at several DPIs, the way the
+route does (pdf_render.iter_rendered_pages, default encoder profile, no
+cache), and reports pages per second and peak memory, so a deployment can
+pick PDF_RENDER_BACKEND from numbers taken on its own hardware:
+
+    cd backend
+    python -m benchmarks.render_backends
+    python -m benchmarks.render_backends --pdf invoices.pdf --dpi 150 300 --pages 50
+    PDF_RENDER_WORKERS=4 python -m benchmarks.render_backends --json results.json
+
+Without --pdf, three synthetic documents are generated: "text" (dense text),
+"vector" (many filled paths) and "scan" (one full-page photo-like image per
+page). Each case runs in a fresh process: "rss" is that process's peak
+(MuPDF itself, for pymupdf) and "worker rss" the largest child's peak, pool
+workers for pymupdf and pdftoppm processes for poppler. Workers follow
+PDF_RENDER_WORKERS for both backends.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+# Run from backend/ or from anywhere with backend/ on the path.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_DPIS = (72, 150, 300)
+DEFAULT_PAGES = 10
+BACKENDS = ("pymupdf", "poppler")
+
+
+def _text_document(pages):
+    import fitz
+
+    doc = fitz.open()
+    words = [
+        "lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+        "adipiscing", "elit", "sed", "do", "eiusmod",
+    ]
+    rng = random.Random(1)
+    for number in range(pages):
+        page = doc.new_page()
+        lines = [" ".join(rng.choice(words) for _ in range(14)) for _ in range(60)]
+        page.insert_text((40, 40), f"Page {number + 1}\n" + "\n".join(lines), fontsize=9)
+    return doc.tobytes(deflate=True)
+
+
+def _vector_document(pages):
+    import fitz
+
+    doc = fitz.open()
+    rng = random.Random(2)
+    for _ in range(pages):
+        page = doc.new_page()
+        shape = page.new_shape()
+        for _ in range(500):
+            x, y = rng.uniform(0, 560), rng.uniform(0, 800)
+            shape.draw_circle((x, y), rng.uniform(2, 30))
+            shape.finish(color=(0, 0, 0), fill=(rng.random(), rng.random(), rng.random()), width=0.5)
+        shape.commit()
+    return doc.tobytes(deflate=True)
+
+
+def _scan_document(pages):
+    import fitz
+
+    doc = fitz.open()
+    rng = random.Random(3)
+    for _ in range(pages):
+        page = doc.new_page()
+        # Dark strokes on a tinted page, JPEG-encoded like a scanner's output.
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 1240, 1754), False)
+        pix.set_rect(pix.irect, (rng.randrange(180, 255),) * 3)
+        for _ in range(400):
+            x, y = rng.randrange(0, 1200), rng.randrange(0, 1700)
+            pix.set_rect(fitz.IRect(x, y, x + 40, y + 6), (rng.randrange(0, 120),) * 3)
+        page.insert_image(page.rect, stream=pix.tobytes("jpeg"))
+    return doc.tobytes(deflate=True)
+
+
+SYNTHETIC_DOCUMENTS = {
+    "text": _text_document,
+    "vector": _vector_document,
+    "scan": _scan_document,
+}
+
+
+def _run_case(backend, pdf_bytes, dpi, pages):
+    """Render `pages` pages at `dpi` through `backend`; runs in a fresh process."""
+    from utils import pdf_render
+
+    if backend == "pymupdf" and pdf_render.RENDER_WORKERS > 1:
+        # A server's pool is already up; start it and import the renderer in
+        # every worker before the clock starts. pdftoppm's process start-up,
+        # on the other hand, is paid by every request and stays in.
+        pool = pdf_render._get_pool()
+        warm_up = [pdf_render.DEFAULT_AA_LEVEL] * pdf_render.RENDER_WORKERS * 2
+        list(pool.map(pdf_render.effective_aa_level, warm_up))
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    spec = {"zoom": dpi / 72.0, "profile": "default", "tiled": "auto", "backend": backend}
+
+    started = time.perf_counter()
+    output_bytes = 0
+    for _, images in pdf_render.iter_rendered_pages(
+        None, pdf_bytes, range(1, pages + 1), spec, parallel="auto"
+    ):
+        output_bytes += sum(len(data) for _, data, _ in images)
+    elapsed = time.perf_counter() - started
+
+    # Pool workers only count towards RUSAGE_CHILDREN once they have exited.
+    if pdf_render._pool is not None:
+        pdf_render._pool.shutdown(wait=True)
+
+    return {
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 2),
+        "output_mb": round(output_bytes / 1e6, 2),
+        "baseline_rss_mb": round(baseline_kb / 1024, 1),
+        "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def _in_fresh_process(*args):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_case, *args).result()
+
+
+def _page_count(pdf_bytes):
+    import fitz
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pdf", nargs="*", default=[], help="PDFs to render instead of the synthetic set")
+    parser.add_argument("--dpi", nargs="*", type=int, default=list(DEFAULT_DPIS))
+    parser.add_argument("--pages", type=int, default=DEFAULT_PAGES, help="pages per document (at most)")
+    parser.add_argument("--backends", nargs="*", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    from utils.poppler_render import poppler_available
+
+    backends = list(args.backends)
+    if "poppler" in backends and not poppler_available():
+        print("poppler: pdftoppm/pdfinfo not found, skipping the poppler backend.")
+        backends.remove("poppler")
+
+    if args.pdf:
+        documents = {}
+        for path in args.pdf:
+            with open(path, "rb") as handle:
+                documents[os.path.basename(path)] = handle.read()
+    else:
+        documents = {name: build(args.pages) for name, build in SYNTHETIC_DOCUMENTS.items()}
+
+    print(f"render workers: {os.getenv('PDF_RENDER_WORKERS', 'default')}")
+    header = f"{'document':<16}{'dpi':>5}  {'backend':<9}{'pages':>6}{'pages/s':>9}{'out MB':>8}{'rss MB':>8}{'worker rss MB':>15}"
+    print(header)
+    print("-" * len(header))
+
+    results = []
+    for name, pdf_bytes in documents.items():
+        pages = min(args.pages, _page_count(pdf_bytes))
+        for dpi in args.dpi:
+            for backend in backends:
+                result = {"document": name, "dpi": dpi, "backend": backend, "pages": pages}
+                result.update(_in_fresh_process(backend, pdf_bytes, dpi, pages))
+                results.append(result)
+                print(
+                    f"{name:<16}{dpi:>5}  {backend:<9}{pages:>6}{result['pages_per_second']:>9}"
+                    f"{result['output_mb']:>8}{result['rss_mb']:>8}{result['worker_rss_mb']:>15}"
+                )
+
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(results, handle, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
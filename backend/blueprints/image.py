@@ -1,25 +1,71 @@
+import json
+import logging
 import os
-from io import BytesIO
+import time
+import zipfile
 
 from flask import Blueprint, request
-from PIL import Image, ImageEnhance
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
 
+from utils import image_ops
 from utils.decorators import process_image_request
-from utils.helpers import send_file_and_cleanup, error
-from utils.validators import validate_image_file, validate_uploaded_file
+from utils.helpers import send_file_and_cleanup, send_stream, error
+from utils.image_batch import ImageError, iter_image_set, iter_processed_images
+from utils.image_ops import COMPRESSION_FORMATS
+from utils.validators import (
+    ALLOWED_IMAGE_MIME_TYPES,
+    validate_image_file,
+    validate_uploaded_file,
+)
+from utils.zip_stream import iter_zip, unique_stems
 
 image_bp = Blueprint("image", __name__)
 
-# Output formats the compressor can emit, keyed by the value accepted in the
-# request. "original" is handled separately: it keeps the uploaded format.
-COMPRESSION_FORMATS = {"jpeg": "JPEG", "webp": "WEBP", "png": "PNG"}
-COMPRESSION_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
-COMPRESSION_MIMETYPES = {
-    "JPEG": "image/jpeg",
-    "WEBP": "image/webp",
-    "PNG": "image/png",
+logger = logging.getLogger(__name__)
+
+# Images accepted by one batch request; larger catalogs are sent in several.
+MAX_BATCH_IMAGES = 1000
+
+# Steps one /imagePipeline request may chain.
+MAX_PIPELINE_STEPS = 20
+
+# Accepted range for a target-size compression's target_bytes.
+MIN_TARGET_BYTES = 1024
+MAX_TARGET_BYTES = 50 * 1024 * 1024
+
+# Accepted range for a visual-quality compression's min_ssim.
+MIN_SSIM = 0.5
+MAX_SSIM = 0.999
+
+# Fields of an operation's report, and the response header each is sent in.
+REPORT_HEADERS = {
+    "quality": "X-Compress-Quality",
+    "scale": "X-Compress-Scale",
+    "encodes": "X-Compress-Encodes",
+    "target_met": "X-Compress-Target-Met",
+    "ssim": "X-Compress-SSIM",
+    "format": "X-Compress-Format",
+    "candidates": "X-Compress-Candidates",
 }
 
+# The same for /convertWebP, whose encoder settings are chosen per image.
+WEBP_REPORT_HEADERS = {
+    "mode": "X-WebP-Mode",
+    "method": "X-WebP-Method",
+    "quality": "X-WebP-Quality",
+    "encode_ms": "X-WebP-Encode-Ms",
+}
+
+# Accepted range for /convertWebP's latency_budget_ms.
+MAX_LATENCY_BUDGET_MS = 60_000
+
+# Widths and formats of a /responsiveImages set when the request names none,
+# and how many widths one request may ask for.
+DEFAULT_RESPONSIVE_WIDTHS = (320, 640, 960, 1280, 1920)
+DEFAULT_RESPONSIVE_FORMATS = ("webp", "jpeg")
+MAX_RESPONSIVE_WIDTHS = 12
+
 
 def _parse_positive_int(value, field_name):
     try:
@@ -59,126 +105,226 @@ def _convert_to_pixels(value, unit, field_name):
     return pixels
 
 
-def _convert_alpha_to_rgb(img):
-    if img.mode in ("RGBA", "LA") or (
-        img.mode == "P" and "transparency" in img.info
-    ):
-        rgba_image = img.convert("RGBA")
-        background = Image.new("RGB", rgba_image.size, (255, 255, 255))
-        background.paste(rgba_image, mask=rgba_image.getchannel("A"))
-        return background
+def _parse_compress_options(form):
+    quality = form.get("quality", 70, type=int)
+    quality = max(1, min(100, quality))
 
-    if img.mode != "RGB":
-        return img.convert("RGB")
+    output_format = form.get("format", "original").lower()
+    if output_format not in ("original", "auto") and output_format not in COMPRESSION_FORMATS:
+        raise ValueError("Invalid format. Please choose one of: original, auto, jpeg, webp, png.")
 
-    return img
+    options = {"quality": quality, "output_format": output_format}
 
+    # With a target size, quality (and, if allowed, resolution) is searched
+    # for instead of taken from the request.
+    if form.get("target_bytes"):
+        target_bytes = _parse_positive_int(form.get("target_bytes"), "target_bytes")
+        if not MIN_TARGET_BYTES <= target_bytes <= MAX_TARGET_BYTES:
+            raise ValueError(
+                f"target_bytes must be between {MIN_TARGET_BYTES} and {MAX_TARGET_BYTES}."
+            )
+        options["target_bytes"] = target_bytes
+        options["allow_resize"] = form.get("allow_resize", "false").lower() == "true"
+
+    # With a minimum SSIM, the lowest quality that still looks close enough
+    # to the source is searched for.
+    if form.get("min_ssim"):
+        if "target_bytes" in options:
+            raise ValueError("Use either target_bytes or min_ssim, not both.")
+        try:
+            min_ssim = float(form.get("min_ssim"))
+        except ValueError:
+            min_ssim = None
+        if min_ssim is None or not MIN_SSIM <= min_ssim <= MAX_SSIM:
+            raise ValueError(f"min_ssim must be a number between {MIN_SSIM} and {MAX_SSIM}.")
+        options["min_ssim"] = min_ssim
+
+    # PNG output may be quantized to a palette of at most `colors` colours,
+    # which is lossy; other formats ignore it.
+    if form.get("colors"):
+        colors = _parse_positive_int(form.get("colors"), "colors")
+        if not 2 <= colors <= 256:
+            raise ValueError("colors must be between 2 and 256.")
+        options["colors"] = colors
+
+    return options
+
+
+def _parse_webp_options(form):
+    mode = form.get("mode", "lossy").lower()
+    if mode not in image_ops.WEBP_MODES:
+        raise ValueError(f"Invalid mode. Please choose one of: {', '.join(image_ops.WEBP_MODES)}.")
+
+    options = {"mode": mode}
+    if form.get("latency_budget_ms"):
+        budget = _parse_positive_int(form.get("latency_budget_ms"), "latency_budget_ms")
+        options["latency_budget_ms"] = min(budget, MAX_LATENCY_BUDGET_MS)
+    return options
+
+
+def _parse_responsive_options(form):
+    widths = DEFAULT_RESPONSIVE_WIDTHS
+    if form.get("widths"):
+        try:
+            widths = [int(width) for width in form.get("widths").split(",") if width.strip()]
+        except ValueError:
+            widths = []
+        if not widths or any(width <= 0 for width in widths):
+            raise ValueError("widths must be a comma-separated list of positive integers.")
+        if len(widths) > MAX_RESPONSIVE_WIDTHS:
+            raise ValueError(f"Too many widths. Maximum allowed: {MAX_RESPONSIVE_WIDTHS}.")
+
+    formats = DEFAULT_RESPONSIVE_FORMATS
+    if form.get("formats"):
+        formats = [name.strip().lower() for name in form.get("formats").split(",") if name.strip()]
+        if not formats or any(name not in image_ops.RESPONSIVE_FORMATS for name in formats):
+            raise ValueError(
+                f"Invalid formats. Please choose from: {', '.join(image_ops.RESPONSIVE_FORMATS)}."
+            )
 
-@image_bp.route("/convertWebP", methods=["POST"])
-@process_image_request
-def convert_to_webp(img, filename, file_bytes):
-    buf = None
-    try:
-        if img.mode not in ("RGB", "RGBA"):
-            img = img.convert("RGBA")
+    quality = max(1, min(100, form.get("quality", 80, type=int)))
+    return {"widths": list(widths), "formats": list(dict.fromkeys(formats)), "quality": quality}
+
+
+def _parse_resize_options(form):
+    unit = form.get("unit", "px").lower()
+    if unit not in {"px", "mm", "cm"}:
+        raise ValueError("unit must be one of: px, mm, cm")
+
+    maintain_aspect_ratio = form.get("maintainAspectRatio", "false").lower() == "true"
 
-        buf = BytesIO()
-        img.save(buf, format="WEBP", quality=85, method=6)
-        buf.seek(0)
-        data = buf.getvalue()
+    width = _convert_to_pixels(form.get("width"), unit, "width")
+    # The height follows from each image's aspect ratio when it is kept.
+    height = None if maintain_aspect_ratio else _convert_to_pixels(form.get("height"), unit, "height")
 
-        base = os.path.splitext(filename)[0]
+    return {"width": width, "height": height}
 
-        return send_file_and_cleanup(
-            data,
-            mimetype="image/webp",
-            as_attachment=True,
-            download_name=f"{base}.webp",
+
+def _parse_upscale_options(form):
+    scale_factor = form.get("scale", 2, type=int)
+    return {"scale": max(image_ops.MIN_UPSCALE, min(image_ops.MAX_UPSCALE, scale_factor))}
+
+
+def _parse_rotate_flip_options(form):
+    action = form.get("action", "")
+    if action not in image_ops.ROTATE_FLIP_TRANSPOSES:
+        raise ValueError(f"Invalid action: {action}")
+    return {"action": action}
+
+
+# Pipeline steps and the parser for each step's fields, which are the form
+# fields of the matching single-image route.
+PIPELINE_STEP_PARSERS = {
+    "resize": _parse_resize_options,
+    "rotateFlip": _parse_rotate_flip_options,
+    "grayscale": lambda form: {},
+    "upscale": _parse_upscale_options,
+}
+
+
+def _step_form(step):
+    """A pipeline step's JSON fields as form values, for the route parsers."""
+    return MultiDict(
+        {
+            key: str(value).lower() if isinstance(value, bool) else str(value)
+            for key, value in step.items()
+            if value is not None
+        }
+    )
+
+
+def _parse_pipeline_options(form):
+    raw_steps = form.get("operations", "")
+    try:
+        steps = json.loads(raw_steps)
+    except ValueError:
+        steps = None
+
+    if not isinstance(steps, list) or not steps or not all(isinstance(step, dict) for step in steps):
+        raise ValueError(
+            'operations must be a JSON list of steps, e.g. [{"op": "resize", "width": 800}].'
         )
-    finally:
-        if buf:
-            try:
-                buf.close()
-            except Exception:
-                pass
 
-@image_bp.route("/upscale", methods=["POST"])
+    if len(steps) > MAX_PIPELINE_STEPS:
+        raise ValueError(f"Too many operations ({len(steps)}). Maximum allowed: {MAX_PIPELINE_STEPS}.")
+
+    parsed = []
+    for number, step in enumerate(steps, start=1):
+        name = step.get("op")
+        if name not in PIPELINE_STEP_PARSERS:
+            raise ValueError(
+                f"Operation {number}: op must be one of: {', '.join(PIPELINE_STEP_PARSERS)}."
+            )
+        try:
+            parsed.append((name, PIPELINE_STEP_PARSERS[name](_step_form(step))))
+        except ValueError as e:
+            raise ValueError(f"Operation {number} ({name}): {e}")
+
+    # The result is encoded once, with /compress's format and quality.
+    return {"steps": parsed, **_parse_compress_options(form)}
+
+
+def _send_output(output, report_headers=REPORT_HEADERS):
+    data, mimetype, download_name, report = output
+    response = send_file_and_cleanup(
+        data,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+    )
+    for field, value in report.items():
+        if field in report_headers and value is not None:
+            if isinstance(value, bool):
+                value = str(value).lower()
+            response.headers[report_headers[field]] = str(value)
+    return response
+
+
+@image_bp.route("/convertWebP", methods=["POST"])
 @process_image_request
-def upscale_image(img, filename, file_bytes):
-    buf = None
-    upscaled = None
-    try:
-        scale_factor = request.form.get("scale", 2, type=int)
+def convert_to_webp(img, filename, file_bytes):
+    options = _parse_webp_options(request.form)
+    return _send_output(image_ops.to_webp(img, filename, **options), WEBP_REPORT_HEADERS)
 
-        # Limit scale factor
-        scale_factor = max(1, min(4, scale_factor))
 
-        # Upscale using LANCZOS (High quality)
-        new_size = (img.width * scale_factor, img.height * scale_factor)
-        upscaled = img.resize(new_size, resample=Image.Resampling.LANCZOS)
+@image_bp.route("/upscale", methods=["POST"])
+@process_image_request
+def upscale_image(img, filename, file_bytes):
+    options = _parse_upscale_options(request.form)
+    if not image_ops.can_tile(img, options["scale"]):
+        return _send_output(image_ops.upscale(img, filename, **options))
 
-        # Apply Sharpness Enhancement
-        enhancer = ImageEnhance.Sharpness(upscaled)
-        upscaled = enhancer.enhance(1.5)
+    # Large outputs stream as their tiles are encoded, from a copy of the
+    # upload, which the decorator closes on return.
+    source = img.copy()
+    chunks, mimetype, download_name = image_ops.upscale_stream(source, filename, **options)
+    response = send_stream(chunks, mimetype, download_name)
 
-        buf = BytesIO()
-        upscaled.save(buf, format="PNG", optimize=True)
-        buf.seek(0)
+    def close():
+        chunks.close()
+        source.close()
 
-        data = buf.getvalue()
+    response.call_on_close(close)
+    return response
 
-        base = os.path.splitext(filename)[0]
 
-        return send_file_and_cleanup(
-            data,
-            mimetype="image/png",
-            as_attachment=True,
-            download_name=f"{base}_upscaled_{scale_factor}x.png",
-        )
-    finally:
-        if buf:
-            try:
-                buf.close()
-            except Exception:
-                pass
-        if upscaled and upscaled is not img:
-            try:
-                upscaled.close()
-            except Exception:
-                pass
 @image_bp.route("/convertJpeg", methods=["POST"])
 @process_image_request
 def convert_to_jpeg(img, filename, file_bytes):
-    buf = None
-    try:
-        if img.mode != "RGB":
-            img = img.convert("RGB")
+    return _send_output(image_ops.to_jpeg(img, filename))
 
-        buf = BytesIO()
-        img.save(buf, format="JPEG", quality=90, optimize=True)
-        buf.seek(0)
-        data = buf.getvalue()
 
-        base = os.path.splitext(filename)[0]
+@image_bp.route("/convertGrayscale", methods=["POST"])
+@process_image_request
+def convert_to_grayscale(img, filename, file_bytes):
+    return _send_output(image_ops.to_grayscale(img, filename))
 
-        return send_file_and_cleanup(
-            data,
-            mimetype="image/jpeg",
-            as_attachment=True,
-            download_name=f"{base}.jpg",
-        )
-    finally:
-        if buf:
-            try:
-                buf.close()
-            except Exception:
-                pass
 
-@image_bp.route("/convertGrayscale", methods=["POST"])
-def convert_to_grayscale():
+def _convert_upload(convert, parse_options):
+    # Options are checked before the upload is decoded, so a bad request is
+    # refused without paying for the decode, and an operation that shrinks
+    # the image can decode it no larger than it needs.
     img = None
-    grayscale_img = None
-    buf = None 
 
     try:
         file, filename, upload_error = validate_uploaded_file(
@@ -189,208 +335,272 @@ def convert_to_grayscale():
         if upload_error:
             return upload_error
 
-        img, file_bytes, image_error = validate_image_file(file)
-
-        if image_error:
-            return image_error
-
-        grayscale_img = img.convert("L")
+        options = parse_options(request.form)
 
-        buf = BytesIO()
+        def plan(opened):
+            nonlocal options
+            options = image_ops.plan_decode(convert, opened, options)
 
-        grayscale_img.save(buf, format="PNG")
+        img, file_bytes, image_error = validate_image_file(file, before_load=plan)
 
-        buf.seek(0)
-
-        data = buf.getvalue()
+        if image_error:
+            return image_error
 
-        base = os.path.splitext(filename)[0]
+        return _send_output(convert(img, filename, **options))
 
-        return send_file_and_cleanup(
-            data,
-            mimetype="image/png",
-            as_attachment=True,
-            download_name=f"{base}_grayscale.png",
-        )
+    except ValueError as e:
+        return error(str(e), 400)
 
     except Exception as e:
         return error(str(e), 500)
 
     finally:
-        if grayscale_img:
-            try:
-                grayscale_img.close()
-            except Exception:
-                pass
-
         if img:
             try:
                 img.close()
             except Exception:
                 pass
-        if buf:  
-            try:
-                buf.close()
-            except Exception:
-                pass
 
 
 @image_bp.route("/compress", methods=["POST"])
 def compress_image():
-    img = None
-    output_img = None
-    buf = None
+    return _convert_upload(image_ops.compress, _parse_compress_options)
 
-    try:
-        file, filename, upload_error = validate_uploaded_file(
-            request,
-            "image",
+
+@image_bp.route("/imagePipeline", methods=["POST"])
+def image_pipeline():
+    # An ordered list of steps run on one decoded image, encoded once at the
+    # end instead of once per route.
+    return _convert_upload(image_ops.run_pipeline, _parse_pipeline_options)
+
+
+@image_bp.route("/resizeImage", methods=["POST"])
+def resize_image():
+    return _convert_upload(image_ops.resize, _parse_resize_options)
+
+
+def _responsive_zip_entries(stem, source, options, results, started):
+    """
+    Write each size and format to the ZIP as it is encoded, then a
+    manifest.json listing them, widest first, with a ready-made srcset per
+    format.
+    """
+    records = []
+    for (width, height), output_format, result in results:
+        name = f"{stem}_{width}w{image_ops.RESPONSIVE_FORMATS[output_format][1]}"
+        record = {"name": name, "format": output_format, "width": width, "height": height}
+        records.append(record)
+
+        if isinstance(result, ImageError):
+            record.update(status="error", message=str(result))
+            continue
+
+        yield name, result["data"], zipfile.ZIP_STORED
+        record.update(status="ok", bytes=len(result["data"]), encode_ms=result["encode_ms"])
+
+    records.sort(key=lambda record: (-record["width"], options["formats"].index(record["format"])))
+    srcset = {
+        output_format: ", ".join(
+            f"{record['name']} {record['width']}w"
+            for record in records
+            if record["format"] == output_format and record["status"] == "ok"
         )
+        for output_format in options["formats"]
+    }
+    manifest = {
+        **source,
+        "options": options,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "srcset": srcset,
+        "images": records,
+    }
+    yield "manifest.json", json.dumps(manifest, indent=2).encode("utf-8"), zipfile.ZIP_DEFLATED
+
+
+@image_bp.route("/responsiveImages", methods=["POST"])
+def responsive_images():
+    # One upload becomes a srcset: it is decoded once, no larger than the
+    # widest output, then resized down the widths in turn, each from the
+    # previous size, while the pool encodes every size in every format.
+    started = time.perf_counter()
+    img = None
 
+    try:
+        file, filename, upload_error = validate_uploaded_file(request, "image")
         if upload_error:
             return upload_error
 
-        img, file_bytes, image_error = validate_image_file(file)
+        options = _parse_responsive_options(request.form)
+        source = {"source": filename}
+        steps = []
+
+        def plan(opened):
+            sizes = image_ops.responsive_sizes(opened.size, options["widths"])
+            box = image_ops.shrink_on_load(opened, sizes[0])
+            steps.extend([(sizes[0], box)] + [(size, None) for size in sizes[1:]])
+            source.update(width=opened.width, height=opened.height)
 
+        img, file_bytes, image_error = validate_image_file(file, before_load=plan)
         if image_error:
             return image_error
+        source.update(
+            input_bytes=len(file_bytes),
+            decode_ms=round((time.perf_counter() - started) * 1000, 2),
+        )
 
-        quality = request.form.get("quality", 70, type=int)
-
-        quality = max(1, min(100, quality))
-
-        requested_format = request.form.get("format", "original").lower()
-
-        if requested_format == "original":
-            # Keep the uploaded format, falling back to JPEG for anything the
-            # compressor cannot re-encode.
-            img_format = (
-                img.format
-                if img.format in COMPRESSION_EXTENSIONS
-                else "JPEG"
-            )
-        elif requested_format in COMPRESSION_FORMATS:
-            img_format = COMPRESSION_FORMATS[requested_format]
-        else:
-            return error(
-                "Invalid format. Please choose one of: original, jpeg, webp, png.",
-                400,
-            )
-
-        # JPEG has no alpha channel, so transparency is flattened onto white
-        # instead of turning black. WebP only accepts RGB/RGBA input.
-        if img_format == "JPEG":
-            output_img = _convert_alpha_to_rgb(img)
-        elif img_format == "WEBP" and img.mode not in ("RGB", "RGBA"):
-            output_img = img.convert("RGBA")
-        else:
-            output_img = img
-
-        extension = COMPRESSION_EXTENSIONS[img_format]
-        mimetype = COMPRESSION_MIMETYPES[img_format]
-
-        buf = BytesIO()
-
-        # PNG is lossless, so it is optimized rather than quality-scaled.
-        save_kwargs = {"format": img_format, "optimize": True}
-        if img_format != "PNG":
-            save_kwargs["quality"] = quality
-
-        output_img.save(buf, **save_kwargs)
-
-        buf.seek(0)
+        results = iter_image_set(
+            img,
+            steps,
+            options["formats"],
+            lambda image, output_format: image_ops.encode_responsive(
+                image, output_format, options["quality"]
+            ),
+        )
+        stem = os.path.splitext(filename)[0] or "image"
+        entries = _responsive_zip_entries(stem, source, options, results, started)
+        response = send_stream(iter_zip(entries), "application/zip", f"{stem}_responsive.zip")
 
-        data = buf.getvalue()
+        def close():
+            results.close()
+            img.close()
 
-        base = os.path.splitext(filename)[0]
+        response.call_on_close(close)
+        img = None
+        return response
 
-        return send_file_and_cleanup(
-            data,
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=f"{base}_compressed{extension}",
-        )
+    except ValueError as e:
+        return error(str(e), 400)
 
     except Exception as e:
         return error(str(e), 500)
 
     finally:
-        if output_img is not None and output_img is not img:
-            try:
-                output_img.close()
-            except Exception:
-                pass
+        # Once the response owns the image, it closes it when streamed.
         if img:
             try:
                 img.close()
             except Exception:
                 pass
-        if buf:
-            try:
-                buf.close()
-            except Exception:
-                pass
-@image_bp.route("/resizeImage", methods=["POST"])
-@process_image_request
-def resize_image(img, filename, file_bytes):
-    buf = None
-    resized_img = None
+
+
+def _batch_upload_problem(upload):
+    if upload.mimetype not in ALLOWED_IMAGE_MIME_TYPES:
+        return "Invalid image MIME type."
+    return None
+
+
+def _batch_zip_entries(operation, options, sources, problems, results):
+    """
+    Write each converted image to the ZIP as soon as it finishes and close
+    the archive with a manifest.json of every upload's outcome, in upload
+    order. `results` are the iter_processed_images() results for the
+    uploads without a problem.
+    """
+    started = time.perf_counter()
+    records = [{"source": source} for source in sources]
+    submitted = [index for index, problem in enumerate(problems) if problem is None]
+
+    for index, problem in enumerate(problems):
+        if problem is not None:
+            records[index].update(status="error", message=problem)
+
+    for position, result in results:
+        record = records[submitted[position]]
+
+        if isinstance(result, ImageError):
+            logger.warning("Batch image %s failed: %s", record["source"], result)
+            record.update(status="error", message=str(result))
+            continue
+
+        data = result.pop("data")
+        del result["mimetype"]
+        # Converted images are already compressed; deflating them again
+        # would only cost time.
+        yield result["name"], data, zipfile.ZIP_STORED
+        record.update(status="ok", **result)
+
+    manifest = {
+        "operation": operation,
+        "options": options,
+        "images_ok": sum(record["status"] == "ok" for record in records),
+        "images_failed": sum(record["status"] == "error" for record in records),
+        "input_bytes": sum(record.get("input_bytes", 0) for record in records),
+        "output_bytes": sum(record.get("output_bytes", 0) for record in records),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "images": records,
+    }
+    yield "manifest.json", json.dumps(manifest, indent=2).encode("utf-8"), zipfile.ZIP_DEFLATED
+
+
+def _image_batch(operation, convert, parse_options=None):
+    # Many images, as repeated "images" fields, share one set of options.
+    # They are converted concurrently on the image pool and written to one
+    # streamed ZIP in the order they finish; an image that fails is recorded
+    # in the manifest instead of failing the batch.
+    uploads = [upload for upload in request.files.getlist("images") if upload and upload.filename]
+
+    if not uploads:
+        return error("No images provided. Upload each image as an images field.")
+
+    if len(uploads) > MAX_BATCH_IMAGES:
+        return error(f"Too many images ({len(uploads)}). Maximum allowed: {MAX_BATCH_IMAGES}.")
+
     try:
-        unit = request.form.get("unit", "px").lower()
-        if unit not in {"px", "mm", "cm"}:
-            raise ValueError("unit must be one of: px, mm, cm")
+        options = parse_options(request.form) if parse_options else {}
+    except ValueError as e:
+        return error(str(e))
 
-        maintain_aspect_ratio = (
-            request.form.get("maintainAspectRatio", "false").lower() == "true"
-        )
+    sources = [secure_filename(upload.filename) for upload in uploads]
+    stems = unique_stems(sources, "image")
+    problems = [_batch_upload_problem(upload) for upload in uploads]
 
-        original_ext = os.path.splitext(filename)[1].lower()
-        format_map = {
-            "PNG": ("PNG", "image/png", ".png"),
-            "JPEG": ("JPEG", "image/jpeg", ".jpg"),
-            "WEBP": ("WEBP", "image/webp", ".webp"),
-        }
+    results = iter_processed_images(
+        [
+            (stem + os.path.splitext(source)[1], upload.read())
+            for stem, source, upload, problem in zip(stems, sources, uploads, problems)
+            if problem is None
+        ],
+        convert,
+        options,
+    )
+    entries = _batch_zip_entries(operation, options, sources, problems, results)
 
-        if img.format not in format_map:
-            raise ValueError("Unsupported image format. Please use PNG, JPG, JPEG, or WEBP.")
-
-        width = _convert_to_pixels(request.form.get("width"), unit, "width")
-        if maintain_aspect_ratio:
-            height = round(width * img.height / img.width)
-            if height <= 0:
-                raise ValueError("Calculated height must be a positive pixel value")
-        else:
-            height = _convert_to_pixels(request.form.get("height"), unit, "height")
-
-        output_format, mimetype, default_ext = format_map[img.format]
-        output_ext = original_ext if original_ext in {".png", ".jpg", ".jpeg", ".webp"} else default_ext
-
-        if output_format == "JPEG":
-            resized_img = _convert_alpha_to_rgb(img.resize((width, height), Image.Resampling.LANCZOS))
-        else:
-            resized_img = img.resize((width, height), Image.Resampling.LANCZOS)
-
-        buf = BytesIO()
-        resized_img.save(buf, format=output_format)
-        buf.seek(0)
-        data = buf.getvalue()
-
-        base = os.path.splitext(filename)[0] or "image"
-
-        return send_file_and_cleanup(
-            data,
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=f"{base}_resized{output_ext}",
-        )
-    finally:
-        if buf:
-            try:
-                buf.close()
-            except Exception:
-                pass
-        if resized_img and resized_img is not img:
-            try:
-                resized_img.close()
-            except Exception:
-                pass
\ No newline at end of file
+    response = send_stream(iter_zip(entries), "application/zip", f"{operation}_batch.zip")
+    response.call_on_close(results.close)
+    response.headers["X-Batch-Images"] = str(len(uploads))
+    return response
+
+
+@image_bp.route("/convertWebPBatch", methods=["POST"])
+def convert_to_webp_batch():
+    return _image_batch("webp", image_ops.to_webp, _parse_webp_options)
+
+
+@image_bp.route("/upscaleBatch", methods=["POST"])
+def upscale_batch():
+    return _image_batch("upscale", image_ops.upscale, _parse_upscale_options)
+
+
+@image_bp.route("/convertJpegBatch", methods=["POST"])
+def convert_to_jpeg_batch():
+    return _image_batch("jpeg", image_ops.to_jpeg)
+
+
+@image_bp.route("/convertGrayscaleBatch", methods=["POST"])
+def convert_to_grayscale_batch():
+    return _image_batch("grayscale", image_ops.to_grayscale)
+
+
+@image_bp.route("/compressBatch", methods=["POST"])
+def compress_batch():
+    return _image_batch("compress", image_ops.compress, _parse_compress_options)
+
+
+@image_bp.route("/resizeImageBatch", methods=["POST"])
+def resize_image_batch():
+    return _image_batch("resize", image_ops.resize, _parse_resize_options)
+
+
+@image_bp.route("/imagePipelineBatch", methods=["POST"])
+def image_pipeline_batch():
+    return _image_batch("pipeline", image_ops.run_pipeline, _parse_pipeline_options)
@@ -1,23 +1,508 @@
 from flask import Blueprint, request
 import base64
-import fitz
+import json
+import logging
 import zipfile
-import io
-from utils.helpers import error, send_file_and_cleanup, success
+from itertools import chain
+import fitz
+from werkzeug.utils import secure_filename
+from utils.helpers import (
+    error,
+    send_file_and_cleanup,
+    send_stream,
+    stream_response,
+    success,
+)
+from utils.json_stream import iter_success_data_url, ndjson_line
+from utils.pdf_archive import ArchiveError, read_pdf_archive
+from utils.poppler_render import poppler_available
+from utils.page_encoders import (
+    DEFAULT_PROFILE,
+    ENCODER_PROFILES,
+    profile_extension,
+    profile_mimetype,
+    profile_zip_compression,
+)
+from utils.pdf_render import (
+    COLORSPACES,
+    DEFAULT_RENDER_BACKEND,
+    MAX_BUDGET_DPI,
+    RENDER_BACKENDS,
+    RENDER_PROFILES,
+    CLIP_UNITS,
+    DocumentError,
+    PageRenderError,
+    effective_aa_level,
+    grid_layout,
+    poppler_unsupported,
+    iter_previews,
+    iter_rendered_documents,
+    iter_rendered_pages,
+    render_grid_image,
+)
+from utils.render_cache import document_key, render_cache
 from utils.validators import validate_uploaded_file, validate_pdf_file
+from utils.zip_stream import iter_zip, unique_stems
 
 pdf_bp = Blueprint("pdf", __name__)
 
+logger = logging.getLogger(__name__)
+
 # Maximum number of pages that can be converted in a single request
 # to prevent resource exhaustion attacks
 MAX_PAGES_PER_REQUEST = 500
 
+# Accepted values for the parallel/tiled switches.
+RENDER_MODES = {"auto", "true", "false"}
+
+# Multi-resolution renders: how many sizes one request may ask for, and the
+# bounds on a width-based size ("320w").
+MAX_SIZES = 5
+MIN_SIZE_WIDTH = 16
+MAX_SIZE_WIDTH = 8000
+
+# Grid layout (layout=grid): bounds on the column count and cell size, and on
+# the pixels of the whole grid image.
+MAX_GRID_COLUMNS = 20
+DEFAULT_GRID_COLUMNS = 4
+MIN_GRID_CELL = 32
+MAX_GRID_CELL = 1024
+DEFAULT_GRID_CELL_WIDTH = 200
+MAX_GRID_PIXELS = 40_000_000
+
+# Pixel budgets (max_width / max_height / max_megapixels): bounds on the
+# total pixels a budget may allow per page.
+MIN_BUDGET_MEGAPIXELS = 0.01
+MAX_BUDGET_MEGAPIXELS = 100
+
+# Clip rectangles: the largest coordinate accepted in points, the PDF limit on
+# page size (200 inches).
+MAX_CLIP_POINTS = 14400
+
+# Batch route: PDFs per request, pages rendered per document, and pages per
+# batch, after which the remaining documents are skipped.
+MAX_BATCH_DOCUMENTS = 1000
+MAX_BATCH_DOCUMENT_PAGES = 100
+MAX_BATCH_PAGES = 5000
+
+# Page-grid previews: thumbnail width bounds and default, accepted encoders.
+MIN_PREVIEW_WIDTH = 32
+MAX_PREVIEW_WIDTH = 512
+DEFAULT_PREVIEW_WIDTH = 160
+PREVIEW_FORMATS = {"jpeg", "webp"}
+
+
+def _parse_sizes(value):
+    """
+    Parse a comma-separated size list such as "72,150,300" (DPI) or
+    "320w,1280w" (pixel widths) into [("dpi", 72), ("width", 320), ...].
+    """
+    tokens = [token.strip().lower() for token in value.split(",") if token.strip()]
+
+    if not tokens or len(tokens) > MAX_SIZES:
+        raise ValueError(f"sizes must list between 1 and {MAX_SIZES} sizes")
+
+    sizes = []
+    for token in tokens:
+        kind = "width" if token.endswith("w") else "dpi"
+        try:
+            number = int(token[:-1] if kind == "width" else token)
+        except ValueError:
+            raise ValueError(f"Invalid size: {token}. Use a DPI such as 150 or a width such as 320w.")
+
+        if kind == "dpi" and not 72 <= number <= 600:
+            raise ValueError("DPI sizes must be between 72 and 600")
+        if kind == "width" and not MIN_SIZE_WIDTH <= number <= MAX_SIZE_WIDTH:
+            raise ValueError(
+                f"Width sizes must be between {MIN_SIZE_WIDTH} and {MAX_SIZE_WIDTH} pixels"
+            )
+
+        if (kind, number) not in sizes:
+            sizes.append((kind, number))
+
+    return sizes
+
+
+def _parse_budget(form, max_dpi):
+    """
+    Read the pixel-budget fields as (max_width, max_height, max_pixels,
+    max_dpi), or None when the request sets none of them. Each page is then
+    rendered at the largest zoom that fits every limit given.
+    """
+    if not any(form.get(field) for field in ("max_width", "max_height", "max_megapixels")):
+        return None
+
+    try:
+        max_width = int(form["max_width"]) if form.get("max_width") else None
+        max_height = int(form["max_height"]) if form.get("max_height") else None
+        megapixels = float(form["max_megapixels"]) if form.get("max_megapixels") else None
+    except ValueError:
+        raise ValueError("Invalid pixel budget. max_width and max_height must be integers, max_megapixels a number.")
+
+    for limit in (max_width, max_height):
+        if limit is not None and not MIN_SIZE_WIDTH <= limit <= MAX_SIZE_WIDTH:
+            raise ValueError(
+                f"max_width and max_height must be between {MIN_SIZE_WIDTH} and {MAX_SIZE_WIDTH} pixels"
+            )
+
+    max_pixels = None
+    if megapixels is not None:
+        if not MIN_BUDGET_MEGAPIXELS <= megapixels <= MAX_BUDGET_MEGAPIXELS:
+            raise ValueError(
+                f"max_megapixels must be between {MIN_BUDGET_MEGAPIXELS} and {MAX_BUDGET_MEGAPIXELS}"
+            )
+        max_pixels = round(megapixels * 1_000_000)
+
+    return max_width, max_height, max_pixels, max_dpi
+
+
+def _parse_grid(form):
+    """
+    Read the grid fields of a layout=grid request as (columns, cell_width,
+    cell_height); cell_height is None when the first page should decide it.
+    """
+    try:
+        columns = int(form.get("columns", DEFAULT_GRID_COLUMNS))
+        cell_width = int(form.get("cell_width", DEFAULT_GRID_CELL_WIDTH))
+        cell_height = int(form["cell_height"]) if form.get("cell_height") else None
+    except (ValueError, TypeError):
+        raise ValueError("Invalid grid value. columns, cell_width and cell_height must be integers.")
+
+    if not 1 <= columns <= MAX_GRID_COLUMNS:
+        raise ValueError(f"columns must be between 1 and {MAX_GRID_COLUMNS}")
+
+    for cell in (cell_width, cell_height):
+        if cell is not None and not MIN_GRID_CELL <= cell <= MAX_GRID_CELL:
+            raise ValueError(
+                f"Cell sizes must be between {MIN_GRID_CELL} and {MAX_GRID_CELL} pixels"
+            )
+
+    return columns, cell_width, cell_height
+
+
+def _parse_clip(form):
+    """
+    Read the clip fields as (units, x0, y0, x1, y1), or None without a clip.
+    "clip" is "x0,y0,x1,y1" from the page's top-left corner, in the
+    clip_units given: "pt" (default) or "fraction" of the page.
+    """
+    if not form.get("clip"):
+        return None
+
+    units = form.get("clip_units", "pt").lower()
+    if units not in CLIP_UNITS:
+        raise ValueError(f"Invalid clip_units. Must be one of: {', '.join(CLIP_UNITS)}.")
+
+    try:
+        x0, y0, x1, y1 = (float(value) for value in form["clip"].split(","))
+    except ValueError:
+        raise ValueError("Invalid clip. Must be four numbers: x0,y0,x1,y1.")
+
+    limit = 1 if units == "fraction" else MAX_CLIP_POINTS
+    if not all(0 <= value <= limit for value in (x0, y0, x1, y1)):
+        raise ValueError(f"clip coordinates must be between 0 and {limit} ({units})")
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("clip must have x1 > x0 and y1 > y0")
+
+    return units, x0, y0, x1, y1
+
+
+def _parse_render_profile(form):
+    """
+    Resolve the render_profile preset and its per-field overrides
+    (colorspace, aa, annots) into {"colorspace", "aa", "annots"}.
+    """
+    name = form.get("render_profile", "default").lower()
+    if name not in RENDER_PROFILES:
+        raise ValueError(f"Invalid render_profile. Must be one of: {', '.join(RENDER_PROFILES)}.")
+
+    render = dict(RENDER_PROFILES[name])
+
+    if form.get("colorspace"):
+        render["colorspace"] = form["colorspace"].lower()
+        if render["colorspace"] not in COLORSPACES:
+            raise ValueError(f"Invalid colorspace. Must be one of: {', '.join(COLORSPACES)}.")
+
+    if form.get("aa"):
+        try:
+            render["aa"] = int(form["aa"])
+        except ValueError:
+            raise ValueError("Invalid aa value. Must be an integer.")
+        if not 0 <= render["aa"] <= 8:
+            raise ValueError("aa must be between 0 and 8")
+
+    if form.get("annots"):
+        annots = form["annots"].lower()
+        if annots not in ("true", "false"):
+            raise ValueError("Invalid annots value. Must be true or false.")
+        render["annots"] = annots == "true"
+
+    return render
+
+
+def _parse_render_spec(form):
+    """
+    Read the fields that describe how each page is rendered (dpi, sizes, the
+    pixel budget, clip, tiled, profile, the render profile and the backend)
+    into the spec iter_rendered_pages() takes. Raises ValueError with a message for the
+    client. The AA level in the spec is the one actually applied (see
+    effective_aa_level()), so it can be reported back.
+    """
+    # DPI determines the scaling: zoom = requested_dpi / 72. Default to 72 DPI
+    # (standard screen resolution); 150 DPI is a zoom of 2.08, 300 DPI 4.17.
+    try:
+        dpi = int(form.get("dpi", "72"))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid DPI value. Must be an integer.")
+    if dpi < 72 or dpi > 600:
+        raise ValueError("DPI must be between 72 and 600")
+
+    # Optional multi-resolution render: every listed size is produced from
+    # one parse of each page and returned together in the ZIP.
+    sizes = _parse_sizes(form["sizes"]) if form.get("sizes") else None
+
+    # Pixel budget: each page gets the zoom that fits max_width, max_height
+    # and/or max_megapixels, so render cost no longer depends on the page's
+    # physical size. An explicit dpi becomes the ceiling.
+    budget = _parse_budget(form, dpi if form.get("dpi") else MAX_BUDGET_DPI)
+    if budget and sizes:
+        raise ValueError("sizes cannot be combined with max_width, max_height or max_megapixels.")
+
+    # Clip rectangle: only that part of each page is rasterized, so a small
+    # crop costs a small share of a full-page render.
+    clip = _parse_clip(form)
+
+    # Oversized pages are rendered in bands ("auto"); "true" and "false"
+    # force the choice either way.
+    tiled = form.get("tiled", "auto").lower()
+    if tiled not in RENDER_MODES:
+        raise ValueError("Invalid parallel/tiled value. Must be one of: auto, true, false.")
+
+    # Encoder profile: output format, compression effort and ZIP method.
+    profile = form.get("profile", DEFAULT_PROFILE).lower()
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Invalid profile. Must be one of: {', '.join(ENCODER_PROFILES)}.")
+
+    # Render profile: colorspace, anti-aliasing and annotations. The AA level
+    # actually applied is reported back, since it needs the pool.
+    render = _parse_render_profile(form)
+    render["aa"] = effective_aa_level(render["aa"])
+
+    spec = {
+        "zoom": dpi / 72.0,
+        "sizes": sizes,
+        "budget": budget,
+        "clip": clip,
+        "tiled": tiled,
+        "profile": profile,
+        **render,
+    }
+    spec["backend"] = _parse_backend(form, spec)
+    return spec
+
+
+def _parse_backend(form, spec):
+    """
+    Pick the rasterization engine for `spec`. A request that asks for poppler
+    gets an error when it cannot be used; a poppler deployment default gives
+    way to PyMuPDF instead.
+    """
+    requested = form.get("backend", "").lower()
+    backend = requested or DEFAULT_RENDER_BACKEND
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"Invalid backend. Must be one of: {', '.join(RENDER_BACKENDS)}.")
+
+    if backend == "poppler":
+        unsupported = poppler_unsupported(spec)
+        if unsupported and requested:
+            raise ValueError(f"The poppler backend does not support {unsupported}.")
+        if not unsupported and not poppler_available():
+            if requested:
+                raise ValueError("The poppler backend is not available on this server.")
+            logger.warning("PDF_RENDER_BACKEND is poppler, but pdftoppm is not installed.")
+        if unsupported or not poppler_available():
+            backend = "pymupdf"
+
+    return backend
+
+
+def _open_document(pdf_bytes):
+    """
+    Open an uploaded PDF for rendering. Returns (doc, error_response); the
+    document is only returned when it opened cleanly and is not encrypted.
+    """
+    try:
+        doc = fitz.open(
+            stream=pdf_bytes,
+            filetype="pdf",
+        )
+    except Exception:
+        return None, error("Failed to process PDF file. The file may be corrupted or invalid.")
+
+    # Password-protected PDFs must be rejected with a clean, specific
+    # message before any further processing touches them. Without this
+    # check, load_page()/get_pixmap() would raise deep inside PyMuPDF and
+    # fall through to the route's generic handler.
+    if doc.needs_pass:
+        doc.close()
+        return None, error(
+            "This PDF is password-protected and cannot be converted. "
+            "Please remove the password and try again.",
+            422,
+        )
+
+    return doc, None
+
+
+def _encode_report(page_num, name, data, info):
+    """
+    Manifest record for one encoded image; info is None for cache hits.
+    Copies of an identical earlier page name it in "duplicate_of".
+    """
+    info = info or {}
+    return {
+        "name": name,
+        "page": page_num,
+        "bytes": len(data),
+        "colorspace": info.get("colorspace"),
+        "width": info.get("width"),
+        "height": info.get("height"),
+        "dpi": info.get("dpi"),
+        "raw_bytes": info.get("raw_bytes"),
+        "raw_bytes_saved": info.get("raw_bytes_saved"),
+        "render_ms": info.get("render_ms"),
+        "encode_ms": info.get("encode_ms"),
+        "cached": not info,
+        "duplicate_of": info.get("duplicate_of"),
+    }
+
+
+def _manifest(profile, reports):
+    pages = {report["page"] for report in reports}
+    duplicates = {report["page"] for report in reports if report["duplicate_of"]}
+
+    return {
+        "profile": profile,
+        "total_bytes": sum(report["bytes"] for report in reports),
+        "total_encode_ms": round(
+            sum(report["encode_ms"] or 0 for report in reports), 2
+        ),
+        "total_raw_bytes_saved": sum(report["raw_bytes_saved"] or 0 for report in reports),
+        # Pages that drew the same thing as an earlier page, and were not
+        # rendered again.
+        "dedup_hits": len(duplicates),
+        "dedup_rate": round(len(duplicates) / len(pages), 4) if pages else 0.0,
+        "images": reports,
+    }
+
+
+def _page_images(page_num, images, profile, reports):
+    """Name one page's images, recording an encode report for each."""
+    extension = profile_extension(profile)
+
+    for label, data, info in images:
+        suffix = "" if label is None else f"_{label}"
+        name = f"page_{page_num}{suffix}.{extension}"
+        reports.append(_encode_report(page_num, name, data, info))
+        yield name, data
+
+
+def _zip_entries(first_page, pages, profile, manifest=False):
+    """
+    Name rendered pages for the ZIP, starting from the pre-rendered first
+    page. With `manifest`, close the archive with a manifest.json of encode
+    statistics.
+    """
+    compression = profile_zip_compression(profile)
+    reports = []
+
+    try:
+        for page_num, images in chain([first_page], pages):
+            for name, data in _page_images(page_num, images, profile, reports):
+                yield name, data, compression
+    except PageRenderError as exc:
+        # Headers have already gone out, so all that can be done is to cut
+        # the archive short; the client sees an incomplete download.
+        logger.error("Failed to render page %s while streaming.", exc.page_number)
+        raise
+
+    if manifest:
+        data = json.dumps(_manifest(profile, reports), indent=2).encode("utf-8")
+        yield "manifest.json", data, zipfile.ZIP_DEFLATED
+
+
+def _ndjson_lines(first_page, pages, profile):
+    """
+    Emit one JSON line per rendered page as soon as it is ready, then a
+    closing line with the encode manifest (or the error that cut it short).
+    """
+    mimetype = profile_mimetype(profile)
+    reports = []
+
+    try:
+        for page_num, images in chain([first_page], pages):
+            yield ndjson_line(
+                {
+                    "page": page_num,
+                    "images": [
+                        {
+                            "name": name,
+                            "image_data": (
+                                f"data:{mimetype};base64,"
+                                f"{base64.b64encode(data).decode('utf-8')}"
+                            ),
+                        }
+                        for name, data in _page_images(page_num, images, profile, reports)
+                    ],
+                }
+            )
+    except PageRenderError as exc:
+        # Unlike a ZIP, a line stream can still tell the client what failed.
+        logger.error("Failed to render page %s while streaming.", exc.page_number)
+        yield ndjson_line(
+            {
+                "success": False,
+                "message": f"Failed to render page {exc.page_number}. {exc.reason}",
+            }
+        )
+        return
+
+    yield ndjson_line({"success": True, "manifest": _manifest(profile, reports)})
+
+
+def _add_cache_headers(response, render_stats):
+    response.headers["X-Render-Cache-Hits"] = str(render_stats.get("cache_hits", 0))
+    response.headers["X-Render-Cache-Misses"] = str(render_stats.get("cache_misses", 0))
+    response.headers["X-Render-Dedup-Hits"] = str(render_stats.get("dedup_hits", 0))
+
+
+def _add_render_headers(response, render):
+    response.headers["X-Render-Backend"] = render.get("backend", "pymupdf")
+    response.headers["X-Render-AA-Level"] = str(render["aa"])
+    response.headers["X-Render-Annots"] = "true" if render["annots"] else "false"
+
+
+def _add_encode_headers(response, report, profile):
+    response.headers["X-Encode-Profile"] = profile
+    response.headers["X-Encoded-Bytes"] = str(report["bytes"])
+    for header, field in (
+        ("X-Render-DPI", "dpi"),
+        ("X-Render-Colorspace", "colorspace"),
+        ("X-Raw-Bytes", "raw_bytes"),
+        ("X-Raw-Bytes-Saved", "raw_bytes_saved"),
+        ("X-Render-Time-Ms", "render_ms"),
+        ("X-Encode-Time-Ms", "encode_ms"),
+    ):
+        if report[field] is not None:
+            response.headers[header] = str(report[field])
+
+
 @pdf_bp.route("/convertPng", methods=["POST"])
 def convert_pdf_to_png():
     doc = None
     pdf_bytes = None
-    pix = None
     png_bytes = None
+    stream_doc = None
 
     try:
         pdf_file, filename, upload_error = validate_uploaded_file(
@@ -38,20 +523,49 @@ def convert_pdf_to_png():
 
         target_lang = request.form.get("language", "eng")
 
-        # Extract DPI/resolution settings. Default to 72 DPI (standard screen resolution).
-        # DPI determines the scaling: zoom = requested_dpi / 72
-        # For 150 DPI: zoom = 150/72 = 2.08
-        # For 300 DPI: zoom = 300/72 = 4.17
-        dpi = request.form.get("dpi", "72")
+        # Page size, clip, encoder and render profile, shared with the batch
+        # route.
         try:
-            dpi = int(dpi)
-            if dpi < 72 or dpi > 600:
-                return error("DPI must be between 72 and 600")
-        except (ValueError, TypeError):
-            return error("Invalid DPI value. Must be an integer.")
+            spec = _parse_render_spec(request.form)
+        except ValueError as e:
+            return error(str(e))
+        sizes, budget, clip, profile = spec["sizes"], spec["budget"], spec["clip"], spec["profile"]
+
+        # Long ranges go to the process pool ("auto"); "true" and "false"
+        # force the choice either way.
+        parallel = request.form.get("parallel", "auto").lower()
+        if parallel not in RENDER_MODES:
+            return error("Invalid parallel/tiled value. Must be one of: auto, true, false.")
+
+        # "base64" wraps the output in a JSON data URL; "ndjson" streams one
+        # JSON line per page. Anything else is a file download.
+        response_type = request.form.get("response_type")
+
+        # manifest=true ends a ZIP with manifest.json; by default the archive
+        # holds only the pages.
+        manifest = request.form.get("manifest", "false").lower()
+        if manifest not in ("true", "false"):
+            return error("Invalid manifest value. Must be true or false.")
+
+        # layout=grid lays the whole range out as one image instead of one
+        # image per page.
+        layout = request.form.get("layout", "pages").lower()
+        if layout not in ("pages", "grid"):
+            return error("Invalid layout. Must be one of: pages, grid.")
+
+        if layout == "grid":
+            if sizes or budget or clip or response_type == "ndjson":
+                return error(
+                    "layout=grid produces one image and cannot be combined with sizes, "
+                    "a pixel budget, a clip or ndjson."
+                )
+            try:
+                grid_fields = _parse_grid(request.form)
+            except ValueError as e:
+                return error(str(e))
+            # Grid cells are composed from MuPDF pixmaps whatever the backend.
+            spec["backend"] = "pymupdf"
 
-        # Calculate zoom level from DPI
-        zoom = dpi / 72.0
         # Extract page range parameters for selective page conversion.
         # If start_page and end_page are not specified, converts only the first page (backward compatible).
         # Pages are 1-indexed (start_page=1 is the first page).
@@ -66,34 +580,29 @@ def convert_pdf_to_png():
         except (ValueError, TypeError):
             return error("Invalid page numbers. Must be integers.")
 
-        try:
-            doc = fitz.open(
-                stream=pdf_bytes,
-                filetype="pdf",
-            )
-        except Exception:
-            return error("Failed to process PDF file. The file may be corrupted or invalid.")
+        # Documents seen before have a cached page count, which also proves
+        # they open cleanly and are not encrypted. A fully cached range is
+        # then served without handing the PDF to MuPDF at all.
+        pdf_key = document_key(pdf_bytes)
+        total_pages = render_cache.get_page_count(pdf_key)
+
+        if total_pages is None:
+            doc, open_error = _open_document(pdf_bytes)
+            if open_error:
+                return open_error
 
         try:
-            # Password-protected PDFs must be rejected with a clean, specific
-            # message before any further processing touches them. Without this
-            # check, load_page()/get_pixmap() below would raise deep inside
-            # PyMuPDF and fall through to the generic handler at the bottom of
-            # this function.
-            if doc.needs_pass:
-                return error(
-                    "This PDF is password-protected and cannot be converted. "
-                    "Please remove the password and try again.",
-                    422,
-                )
+            if doc is not None:
+                total_pages = doc.page_count
+                render_cache.put_page_count(pdf_key, total_pages)
 
-            if doc.page_count == 0:
+            if total_pages == 0:
                 return error("Empty PDF")
 
             # Clamp end_page to actual page count
-            end_page = min(end_page, doc.page_count)
-            if start_page > doc.page_count:
-                return error(f"PDF has only {doc.page_count} pages. start_page exceeds page count.")
+            end_page = min(end_page, total_pages)
+            if start_page > total_pages:
+                return error(f"PDF has only {total_pages} pages. start_page exceeds page count.")
 
             # Enforce maximum page limit to prevent resource exhaustion
             page_range = end_page - start_page + 1
@@ -103,85 +612,143 @@ def convert_pdf_to_png():
                     f"Requested: {page_range} pages. Please select a smaller range."
                 )
 
-            mat = fitz.Matrix(zoom, zoom)
-
             # Convert requested page range to PNG(s)
             page_count = end_page - start_page + 1
-            png_bytes_list = []
+            render_stats = {}
 
-            for page_num in range(start_page - 1, end_page):
-                try:
-                    page = doc.load_page(page_num)
-                    pix = page.get_pixmap(
-                        matrix=mat,
-                        alpha=False,
+            if layout == "grid":
+                # The grid is one composite image, so it bypasses the page cache.
+                render_stats.update(cache_hits=0, cache_misses=page_count)
+                if doc is None:
+                    doc, open_error = _open_document(pdf_bytes)
+                    if open_error:
+                        return open_error
+
+                grid = grid_layout(
+                    doc,
+                    range(start_page, end_page + 1),
+                    *grid_fields,
+                    aa=spec["aa"],
+                    annots=spec["annots"],
+                )
+                if grid["width"] * grid["height"] > MAX_GRID_PIXELS:
+                    return error(
+                        f"Grid image of {grid['width']}x{grid['height']} pixels exceeds the "
+                        f"limit of {MAX_GRID_PIXELS} pixels. Use smaller cells or fewer pages."
                     )
-                    png_bytes = (
-                        pix.tobytes(output="png")
-                        if hasattr(pix, "tobytes")
-                        else pix.tobytes()
+
+                try:
+                    png_bytes, info = render_grid_image(
+                        doc,
+                        pdf_bytes,
+                        range(start_page, end_page + 1),
+                        grid,
+                        profile,
+                        parallel,
                     )
-                    png_bytes_list.append((page_num + 1, png_bytes))
-                    pix = None
-                except Exception:
-                    return error(f"Failed to render page {page_num + 1}. The page may be corrupted or unsupported.")
-
-            # If single page, use original behavior (backward compatible)
-            if page_count == 1:
-                png_bytes = png_bytes_list[0][1]
+                except PageRenderError as exc:
+                    return error(f"Failed to render page {exc.page_number}. {exc.reason}")
+
+                streamed = False
+                encode_report = _encode_report(
+                    start_page,
+                    f"pages_{start_page}-{end_page}_grid.{profile_extension(profile)}",
+                    png_bytes,
+                    info,
+                )
             else:
-                # Multiple pages: return zip file with all pages
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for page_num, page_png in png_bytes_list:
-                        zip_file.writestr(f"page_{page_num}.png", page_png)
-                zip_buffer.seek(0)
-                png_bytes = zip_buffer.getvalue()
+                pages = iter_rendered_pages(
+                    doc,
+                    pdf_bytes,
+                    range(start_page, end_page + 1),
+                    spec,
+                    parallel=parallel,
+                    pdf_key=pdf_key,
+                    stats=render_stats,
+                )
+
+                # Render the first page before committing to a response, so a
+                # document that cannot be rendered at all still gets a clean error.
+                try:
+                    first_page = next(pages)
+                except PageRenderError as exc:
+                    return error(f"Failed to render page {exc.page_number}. {exc.reason}")
+
+                streamed = True
+                encode_report = None
+
+                # If single page, use original behavior (backward compatible)
+                if page_count == 1 and len(first_page[1]) == 1 and response_type != "ndjson":
+                    streamed = False
+                    _, png_bytes, info = first_page[1][0]
+                    encode_report = _encode_report(
+                        first_page[0], f"converted.{profile_extension(profile)}", png_bytes, info
+                    )
+                    pages.close()
+                else:
+                    # Multiple pages or sizes: the body is built page by page as
+                    # the client reads it, so the open document now belongs to
+                    # the response.
+                    stream_doc, doc = doc, None
 
         finally:
-            if doc:
+            if doc is not None:
                 doc.close()
-            # Clean up pixmap
-            if pix:
-                try:
-                    pix = None
-                except Exception:
-                    pass
-
-        # Determine response format and MIME type based on page count
-        if page_count > 1:
-            mimetype = "application/zip"
-            download_name = f"pages_{start_page}-{end_page}.zip"
-        else:
-            mimetype = "image/png"
-            download_name = "converted.png"
-
-        if request.form.get("response_type") == "base64":
-            base64_string = base64.b64encode(png_bytes).decode("utf-8")
-            # Force garbage collection
-            import gc
-            gc.collect()
-            content_type = "application/zip" if page_count > 1 else "image/png"
-            return success(
-                {
-                    "image_data": (
-                        f"data:{content_type};base64,{base64_string}"
+
+        if streamed:
+            if response_type == "ndjson":
+                response = stream_response(
+                    _ndjson_lines(first_page, pages, profile),
+                    "application/x-ndjson",
+                )
+            else:
+                zip_chunks = iter_zip(
+                    _zip_entries(first_page, pages, profile, manifest == "true")
+                )
+                if response_type == "base64":
+                    response = stream_response(
+                        iter_success_data_url(
+                            zip_chunks, "application/zip", "Image encoded successfully."
+                        ),
+                        "application/json",
+                    )
+                else:
+                    response = send_stream(
+                        zip_chunks,
+                        "application/zip",
+                        f"pages_{start_page}-{end_page}.zip",
                     )
-                },
-                "Image encoded successfully.",
+
+            response.call_on_close(pages.close)
+            if stream_doc is not None:
+                response.call_on_close(stream_doc.close)
+            _add_cache_headers(response, render_stats)
+            _add_render_headers(response, spec)
+            return response
+
+        mimetype = profile_mimetype(profile)
+
+        if response_type == "base64":
+            response = stream_response(
+                iter_success_data_url(
+                    [png_bytes],
+                    mimetype,
+                    "Image encoded successfully.",
+                    {"encode": encode_report},
+                ),
+                "application/json",
             )
+        else:
+            response = send_file_and_cleanup(
+                png_bytes,
+                mimetype=mimetype,
+                as_attachment=True,
+                download_name=encode_report["name"],
+            )
+            _add_encode_headers(response, encode_report, profile)
 
-        response = send_file_and_cleanup(
-            png_bytes,
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=download_name,
-        )
-        
-        # Force garbage collection
-        import gc
-        gc.collect()
-        
+        _add_cache_headers(response, render_stats)
+        _add_render_headers(response, spec)
         return response
 
     except Exception:
@@ -189,3 +756,246 @@ def convert_pdf_to_png():
         return error(
             "The provided PDF file appears to be corrupted or unreadable."
         )
+
+
+def _parse_batch_pages(form):
+    """
+    Read a batch's page range as (start_page, end_page); end_page is None
+    (every page) unless given, and is clamped to each document's length.
+    """
+    try:
+        start_page = int(form.get("start_page", "1"))
+        end_page = int(form["end_page"]) if form.get("end_page") else None
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page numbers. Must be integers.")
+
+    if start_page < 1 or (end_page is not None and end_page < start_page):
+        raise ValueError("Invalid page range. start_page must be >= 1 and <= end_page.")
+
+    return start_page, end_page
+
+
+def _batch_document_problem(name, pdf_bytes):
+    """Why a batch member cannot be rendered at all, or None."""
+    if not name.lower().endswith(".pdf"):
+        return "Invalid file format. Please upload a PDF file."
+    if not pdf_bytes.startswith(b"%PDF"):
+        return "Invalid PDF file. File does not have valid PDF signature."
+    return None
+
+
+def _batch_zip_entries(documents, rendered, profile):
+    """
+    Lay the batch out as one ZIP folder per document and close it with a
+    manifest.json recording each document's outcome. `documents` holds
+    (name, problem) in upload order, and `rendered` the
+    iter_rendered_documents() results for those without a problem.
+    """
+    compression = profile_zip_compression(profile)
+    records = []
+    pages_left = MAX_BATCH_PAGES
+
+    folders = unique_stems((name for name, _ in documents), "document")
+    for folder, (name, problem) in zip(folders, documents):
+        record = {"name": folder, "source": name}
+        records.append(record)
+
+        if problem is None and pages_left <= 0:
+            rendered.close()
+            problem = f"Skipped: the batch reached its limit of {MAX_BATCH_PAGES} pages."
+        elif problem is None:
+            _, result = next(rendered)
+            if isinstance(result, DocumentError):
+                problem = str(result)
+
+        if problem is not None:
+            logger.warning("Batch document %s failed: %s", folder, problem)
+            record.update(status="error", message=problem)
+            continue
+
+        reports = []
+        for page_num, images in result["pages"]:
+            for image_name, data in _page_images(page_num, images, profile, reports):
+                yield f"{folder}/{image_name}", data, compression
+        for report in reports:
+            report["name"] = f"{folder}/{report['name']}"
+
+        pages_left -= len(result["pages"])
+        manifest = _manifest(profile, reports)
+        del manifest["profile"]
+        record.update(status="ok", page_count=result["page_count"], **manifest)
+
+    manifest = {
+        "profile": profile,
+        "documents_ok": sum(record["status"] == "ok" for record in records),
+        "documents_failed": sum(record["status"] == "error" for record in records),
+        "total_bytes": sum(record.get("total_bytes", 0) for record in records),
+        "documents": records,
+    }
+    yield "manifest.json", json.dumps(manifest, indent=2).encode("utf-8"), zipfile.ZIP_DEFLATED
+
+
+@pdf_bp.route("/convertPngBatch", methods=["POST"])
+def convert_pdf_batch():
+    # Many PDFs, as repeated "files" fields and/or one ZIP "archive", share
+    # one render spec. Documents render concurrently on the pool and come
+    # back as one streamed ZIP with a folder per document; a document that
+    # fails is recorded in the manifest instead of failing the batch.
+    uploads = [upload for upload in request.files.getlist("files") if upload and upload.filename]
+    archive = request.files.get("archive")
+    if archive is not None and not archive.filename:
+        archive = None
+
+    if not uploads and archive is None:
+        return error("No files provided. Upload PDFs as files or a ZIP of PDFs as archive.")
+
+    try:
+        spec = _parse_render_spec(request.form)
+        start_page, end_page = _parse_batch_pages(request.form)
+    except ValueError as e:
+        return error(str(e))
+
+    documents = [(secure_filename(upload.filename), upload.read()) for upload in uploads]
+    if archive is not None:
+        try:
+            documents.extend(read_pdf_archive(archive.read()))
+        except ArchiveError as e:
+            return error(str(e))
+
+    if len(documents) > MAX_BATCH_DOCUMENTS:
+        return error(
+            f"Too many documents ({len(documents)}). Maximum allowed: {MAX_BATCH_DOCUMENTS}."
+        )
+
+    problems = [_batch_document_problem(name, pdf_bytes) for name, pdf_bytes in documents]
+    rendered = iter_rendered_documents(
+        [pdf_bytes for (_, pdf_bytes), problem in zip(documents, problems) if problem is None],
+        start_page,
+        end_page,
+        spec,
+        MAX_BATCH_DOCUMENT_PAGES,
+    )
+    entries = _batch_zip_entries(
+        [(name, problem) for (name, _), problem in zip(documents, problems)],
+        rendered,
+        spec["profile"],
+    )
+
+    response = send_stream(iter_zip(entries), "application/zip", "batch.zip")
+    response.call_on_close(rendered.close)
+    response.headers["X-Batch-Documents"] = str(len(documents))
+    _add_render_headers(response, spec)
+    return response
+
+
+@pdf_bp.route("/previewPdf", methods=["POST"])
+def preview_pdf():
+    """
+    Render low-fidelity thumbnails of a whole document (or a page range) for
+    a page grid, returned together as JSON data URLs.
+    """
+    doc = None
+
+    try:
+        pdf_file, filename, upload_error = validate_uploaded_file(
+            request,
+            "file",
+        )
+
+        if upload_error:
+            return upload_error
+
+        pdf_error = validate_pdf_file(pdf_file, filename)
+
+        if pdf_error:
+            return pdf_error
+
+        pdf_bytes = pdf_file.read()
+
+        try:
+            width = int(request.form.get("width", DEFAULT_PREVIEW_WIDTH))
+            quality = int(request.form.get("quality", "50"))
+        except (ValueError, TypeError):
+            return error("Invalid width or quality value. Must be an integer.")
+
+        if not MIN_PREVIEW_WIDTH <= width <= MAX_PREVIEW_WIDTH:
+            return error(
+                f"Width must be between {MIN_PREVIEW_WIDTH} and {MAX_PREVIEW_WIDTH} pixels"
+            )
+        if not 1 <= quality <= 95:
+            return error("Quality must be between 1 and 95")
+
+        image_format = request.form.get("format", "jpeg").lower()
+        if image_format == "jpg":
+            image_format = "jpeg"
+        if image_format not in PREVIEW_FORMATS:
+            return error("Invalid format. Must be one of: jpeg, webp.")
+
+        parallel = request.form.get("parallel", "auto").lower()
+        if parallel not in RENDER_MODES:
+            return error("Invalid parallel value. Must be one of: auto, true, false.")
+
+        # The whole document by default: previews are meant for page grids.
+        try:
+            start_page = int(request.form.get("start_page", "1"))
+            end_page = int(request.form.get("end_page", MAX_PAGES_PER_REQUEST))
+            if start_page < 1 or end_page < start_page:
+                return error("Invalid page range. start_page must be >= 1 and <= end_page.")
+        except (ValueError, TypeError):
+            return error("Invalid page numbers. Must be integers.")
+
+        doc, open_error = _open_document(pdf_bytes)
+        if open_error:
+            return open_error
+
+        total_pages = doc.page_count
+        if total_pages == 0:
+            return error("Empty PDF")
+
+        if start_page > total_pages:
+            return error(f"PDF has only {total_pages} pages. start_page exceeds page count.")
+
+        end_page = min(end_page, total_pages, start_page + MAX_PAGES_PER_REQUEST - 1)
+
+        options = {"width": width, "format": image_format, "quality": quality}
+        previews = []
+
+        try:
+            for page_num, image_bytes, thumb_width, thumb_height in iter_previews(
+                doc,
+                pdf_bytes,
+                range(start_page, end_page + 1),
+                options,
+                parallel=parallel,
+            ):
+                previews.append(
+                    {
+                        "page": page_num,
+                        "width": thumb_width,
+                        "height": thumb_height,
+                        "image_data": (
+                            f"data:image/{image_format};base64,"
+                            f"{base64.b64encode(image_bytes).decode('utf-8')}"
+                        ),
+                    }
+                )
+        except PageRenderError as exc:
+            return error(f"Failed to render page {exc.page_number}. {exc.reason}")
+
+        return success(
+            {
+                "page_count": total_pages,
+                "format": image_format,
+                "pages": previews,
+            },
+            "Previews rendered successfully.",
+        )
+
+    except Exception:
+        return error(
+            "The provided PDF file appears to be corrupted or unreadable."
+        )
+
+    finally:
+        if doc is not None:
+            doc.close()
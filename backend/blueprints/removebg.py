@@ -9,6 +9,7 @@ from skimage import morphology
 
 from utils.decorators import process_image_request
 from utils.helpers import safe_gc_collect
+from utils.png_optimizer import optimize_png
 from utils.job_manager import create_job, update_job, get_job, delete_job, cleanup_old_jobs
 
 remove_bp = Blueprint("removebg", __name__)
@@ -57,10 +58,7 @@ def process_bg_removal(job_id, file_bytes):
         out_img.putalpha(refined_alpha)
 
         update_job(job_id, stage="finalizing", progress=90)
-        buf = io.BytesIO()
-        out_img.save(buf, format="PNG", optimize=True)
-        buf.seek(0)
-        data = buf.getvalue()
+        data = optimize_png(out_img)
 
         out_img.close()
         del output_bytes
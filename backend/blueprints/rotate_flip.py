@@ -1,11 +1,13 @@
 import io
-from flask import Blueprint, request, send_file
+from flask import Blueprint, request
 from PIL import Image
 from utils.decorators import process_image_request
+from utils.helpers import send_file_and_cleanup
+from utils import image_ops
 
 rotate_flip_bp = Blueprint("rotate_flip", __name__)
 
-ALLOWED_ACTIONS = {"rotate_left", "rotate_right", "flip_h", "flip_v"}
+ALLOWED_ACTIONS = set(image_ops.ROTATE_FLIP_TRANSPOSES)
 ALLOWED_FORMATS = {"PNG", "JPEG", "WEBP"}
 
 
@@ -34,14 +36,7 @@ def rotate_flip(img, filename, file_bytes):
         else:
             img_copy = img.copy()
 
-        if action == "rotate_left":
-            img_copy = img_copy.rotate(90, expand=True)
-        elif action == "rotate_right":
-            img_copy = img_copy.rotate(-90, expand=True)
-        elif action == "flip_h":
-            img_copy = img_copy.transpose(Image.FLIP_LEFT_RIGHT)
-        elif action == "flip_v":
-            img_copy = img_copy.transpose(Image.FLIP_TOP_BOTTOM)
+        img_copy = image_ops.rotate_flip(img_copy, action)
 
         # JPEG has no alpha channel — composite onto white background
         if fmt == "JPEG" and img_copy.mode == "RGBA":
@@ -56,8 +51,10 @@ def rotate_flip(img, filename, file_bytes):
         mime = "image/jpeg" if fmt == "JPEG" else f"image/{fmt.lower()}"
         ext  = "jpg"        if fmt == "JPEG" else fmt.lower()
         
-        return send_file(output, mimetype=mime,
-                         download_name=f"transformed.{ext}")
+        # The buffer is closed below, so its bytes are sent rather than the
+        # buffer itself.
+        return send_file_and_cleanup(output.getvalue(), mimetype=mime,
+                                     download_name=f"transformed.{ext}")
     
     finally:
         # Clean up buffer
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, send_file
 from PIL import Image, ImageDraw, ImageFont
 from utils.helpers import error
+from utils.png_optimizer import optimize_png
 import io
 import os
 
@@ -59,9 +60,7 @@ def add_watermark():
     else:
         result_img = apply_positioned_watermark(img, watermark_layer, position)
 
-    img_byte_arr = io.BytesIO()
-    result_img.save(img_byte_arr, format='PNG')
-    img_byte_arr.seek(0)
+    img_byte_arr = io.BytesIO(optimize_png(result_img))
 
     return send_file(
         img_byte_arr,
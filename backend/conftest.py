@@ -1,6 +1,8 @@
 import sys
 from unittest.mock import MagicMock
 
+import pytest
+
 # Mock out problematic C-extensions and modules
 mock_modules = [
     'fitz',
@@ -28,3 +30,13 @@ for mod in mock_modules:
     mock = MagicMock()
     mock.__version__ = "2.0.0"
     sys.modules[mod] = mock
+
+
+@pytest.fixture(autouse=True)
+def _empty_render_cache():
+    # Every mocked PDF upload has the same bytes, so cached pages and page
+    # counts would otherwise leak from one test into the next.
+    from utils.render_cache import render_cache
+
+    yield
+    render_cache.clear()
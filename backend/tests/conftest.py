@@ -1,6 +1,13 @@
+import collections
+import threading
+import time
+
 import pytest
+from PIL import Image
+
 from app import create_app
 
+
 @pytest.fixture
 def app():
     app = create_app()
@@ -13,4 +20,32 @@ def app():
 
 @pytest.fixture
 def client(app):
-    return app.test_client()
\ No newline at end of file
+    return app.test_client()
+
+
+@pytest.fixture
+def save_overlaps(monkeypatch):
+    """
+    Record the format of every Image.save() that starts while another save
+    of the same image object is running. Each save is slowed a little so
+    that saves which can overlap do.
+    """
+    in_flight = collections.Counter()
+    overlaps = []
+    lock = threading.Lock()
+    real_save = Image.Image.save
+
+    def recording_save(self, *args, **kwargs):
+        with lock:
+            in_flight[id(self)] += 1
+            if in_flight[id(self)] > 1:
+                overlaps.append(kwargs.get("format"))
+        try:
+            time.sleep(0.01)
+            return real_save(self, *args, **kwargs)
+        finally:
+            with lock:
+                in_flight[id(self)] -= 1
+
+    monkeypatch.setattr(Image.Image, "save", recording_save)
+    return overlaps
@@ -0,0 +1,93 @@
+import io
+import time
+
+from PIL import Image
+
+from utils import image_ops
+
+
+def test_effort_drops_as_images_grow_or_budgets_shrink():
+    small = image_ops.webp_settings(1_000_000)
+    assert small == {"lossless": False, "quality": 85, "method": 6}
+
+    large = image_ops.webp_settings(40_000_000)
+    assert large["method"] < small["method"]
+    assert large["quality"] < small["quality"]
+
+    assert image_ops.webp_settings(1_000_000, latency_budget_ms=100)["method"] == 2
+    # Nothing fits: the cheapest setting is used anyway.
+    assert image_ops.webp_settings(40_000_000, latency_budget_ms=1)["method"] == 0
+
+
+def test_lossless_modes_pick_an_effort_level():
+    settings = image_ops.webp_settings(1_000_000, "lossless")
+    assert settings == {"lossless": True, "quality": 75, "method": 4}
+    assert image_ops.webp_settings(100_000, "near_lossless")["method"] == 6
+
+
+def test_a_cost_factor_scales_the_estimates():
+    assert image_ops.webp_settings(1_000_000, "lossless", cost_factor=0.2)["method"] == 6
+    assert image_ops.webp_settings(1_000_000, cost_factor=5)["method"] == 5
+
+
+def test_the_probe_finds_noise_slower_than_a_flat_graphic():
+    noise = Image.effect_noise((256, 256), 80).convert("RGB")
+    flat = Image.new("RGB", (256, 256), "teal")
+
+    assert image_ops._webp_cost_factor(noise, "lossy") > image_ops._webp_cost_factor(flat, "lossy")
+
+
+def test_an_encode_past_the_budget_falls_back_to_the_fastest_setting(monkeypatch):
+    real_encode_copy = image_ops.encode_copy
+
+    def slow_encode_copy(img, buffer=None, **params):
+        time.sleep(0.5)
+        return real_encode_copy(img, buffer, **params)
+
+    monkeypatch.setattr(image_ops, "encode_copy", slow_encode_copy)
+    img = Image.effect_noise((64, 64), 80).convert("RGB")
+
+    data, _, _, report = image_ops.to_webp(img, "noise.png", latency_budget_ms=100)
+
+    assert report["method"] == 0
+    assert report["encode_ms"] < 500
+    assert Image.open(io.BytesIO(data)).size == (64, 64)
+
+
+def test_near_lossless_moves_no_channel_by_more_than_half_a_step():
+    img = Image.effect_noise((64, 64), 80).convert("RGBA")
+    img.putalpha(Image.linear_gradient("L").resize(img.size))
+
+    data, _, _, report = image_ops.to_webp(img, "noise.png", mode="near_lossless")
+
+    decoded = Image.open(io.BytesIO(data)).convert("RGBA")
+    for original, result in zip(img.split(), decoded.split()):
+        diffs = [abs(a - b) for a, b in zip(original.tobytes(), result.tobytes())]
+        assert max(diffs) <= image_ops.NEAR_LOSSLESS_STEP // 2
+    assert report["mode"] == "near_lossless"
+
+
+def test_convert_webp_reports_its_settings(client):
+    buf = io.BytesIO()
+    Image.new("RGB", (40, 30), "teal").save(buf, format="PNG")
+    form = {"image": (io.BytesIO(buf.getvalue()), "flat.png"), "mode": "lossless"}
+
+    response = client.post("/convertWebP", data=form, content_type="multipart/form-data")
+
+    assert response.status_code == 200
+    assert response.headers["X-WebP-Mode"] == "lossless"
+    assert response.headers["X-WebP-Method"] == "6"
+    assert int(response.headers["X-WebP-Encode-Ms"]) >= 0
+    result = Image.open(io.BytesIO(response.get_data())).convert("RGB")
+    assert result.tobytes() == Image.new("RGB", (40, 30), "teal").tobytes()
+
+
+def test_convert_webp_rejects_unknown_modes(client):
+    buf = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buf, format="PNG")
+    form = {"image": (io.BytesIO(buf.getvalue()), "flat.png"), "mode": "lossier"}
+
+    response = client.post("/convertWebP", data=form, content_type="multipart/form-data")
+
+    assert response.status_code == 400
+    assert "Invalid mode" in response.get_json()["message"]
@@ -0,0 +1,87 @@
+import io
+import threading
+
+from PIL import Image, ImageDraw
+
+from utils import format_race, image_ops
+
+
+def _post(client, img, **form):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    form["image"] = (io.BytesIO(buf.getvalue()), "upload.png")
+    return client.post("/compress", data=form, content_type="multipart/form-data")
+
+
+def test_losers_stop_once_they_outgrow_the_leader():
+    leader_done = threading.Event()
+
+    def small(max_bytes):
+        leader_done.set()
+        return b"x" * 10, {}
+
+    def large(max_bytes):
+        leader_done.wait(5)
+        with format_race.RaceBuffer(max_bytes) as buffer:
+            for _ in range(100):
+                buffer.write(b"y" * 4)
+            return buffer.getvalue(), {}
+
+    results = format_race.race({"large": large, "small": small})
+
+    assert results == {"large": None, "small": (b"x" * 10, {})}
+
+
+def test_auto_picks_png_for_flat_graphics(client):
+    graphic = Image.new("RGB", (300, 200), "white")
+    ImageDraw.Draw(graphic).rectangle((40, 40, 160, 120), fill=(20, 90, 200))
+
+    response = _post(client, graphic, format="auto")
+
+    assert response.status_code == 200
+    assert response.headers["X-Compress-Format"] == "png"
+    assert response.mimetype == "image/png"
+    assert "upload_compressed.png" in response.headers["Content-Disposition"]
+    assert Image.open(io.BytesIO(response.get_data())).convert("RGB").tobytes() == graphic.tobytes()
+
+
+def test_auto_picks_a_lossy_format_for_photos(client):
+    photo = Image.effect_noise((300, 200), 40).convert("RGB")
+
+    response = _post(client, photo, format="auto", quality="60")
+
+    assert response.status_code == 200
+    assert response.headers["X-Compress-Format"] in ("jpeg", "webp")
+    candidates = dict(
+        entry.split("=") for entry in response.headers["X-Compress-Candidates"].split(", ")
+    )
+    assert list(candidates) == ["png", "webp", "jpeg"]
+    assert candidates[response.headers["X-Compress-Format"]] == str(len(response.get_data()))
+
+
+def test_auto_skips_jpeg_for_transparent_images(client):
+    logo = Image.new("RGBA", (120, 80), (0, 0, 0, 0))
+    ImageDraw.Draw(logo).ellipse((10, 10, 110, 70), fill=(255, 0, 0, 255))
+
+    response = _post(client, logo, format="auto")
+
+    assert response.status_code == 200
+    assert "jpeg" not in response.headers["X-Compress-Candidates"]
+    assert Image.open(io.BytesIO(response.get_data())).mode in ("P", "RGBA")
+
+
+def test_auto_rejects_a_target_size(client):
+    response = _post(client, Image.new("RGB", (40, 30)), format="auto", target_bytes="5000")
+
+    assert response.status_code == 400
+    assert "format=auto" in response.get_json()["message"]
+
+
+def test_the_legs_never_save_the_same_image(save_overlaps):
+    photo = Image.effect_noise((120, 80), 40).convert("RGB")
+
+    data, report = image_ops.encode_auto(photo, 60)
+
+    assert save_overlaps == []
+    assert getattr(photo, "encoderinfo", {}) == {}
+    assert Image.open(io.BytesIO(data)).format == report["format"].upper()
@@ -0,0 +1,130 @@
+import io
+import json
+import threading
+import zipfile
+
+from PIL import Image
+
+from utils import image_batch
+
+
+def _png(size=(8, 6), mode="RGBA"):
+    buf = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128)[: len(mode)]).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _post_batch(client, path, images, **form):
+    data = dict(form)
+    data["images"] = [(io.BytesIO(payload), name) for name, payload in images]
+    return client.post(path, data=data, content_type="multipart/form-data")
+
+
+def _read_zip(response):
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    manifest = json.loads(archive.read("manifest.json"))
+    return archive, manifest
+
+
+def test_batch_converts_each_image_and_records_failures(client):
+    response = _post_batch(
+        client,
+        "/convertWebPBatch",
+        [
+            ("photo.png", _png()),
+            ("photo.jpg", _png()),
+            ("broken.png", b"not an image"),
+            ("notes.txt", b"hello"),
+        ],
+    )
+
+    assert response.status_code == 200
+    assert response.headers["X-Batch-Images"] == "4"
+
+    archive, manifest = _read_zip(response)
+    assert sorted(archive.namelist()) == ["manifest.json", "photo-2.webp", "photo.webp"]
+    assert Image.open(io.BytesIO(archive.read("photo.webp"))).format == "WEBP"
+
+    assert manifest["operation"] == "webp"
+    assert (manifest["images_ok"], manifest["images_failed"]) == (2, 2)
+    records = manifest["images"]
+    assert [record["source"] for record in records] == ["photo.png", "photo.jpg", "broken.png", "notes.txt"]
+    assert records[0]["name"] == "photo.webp"
+    assert records[0]["input_bytes"] == len(_png())
+    assert records[0]["output_bytes"] == len(archive.read("photo.webp"))
+    assert (records[0]["width"], records[0]["height"]) == (8, 6)
+    assert records[0]["decode_ms"] >= 0 and records[0]["convert_ms"] >= 0
+    assert records[2] == {
+        "source": "broken.png",
+        "status": "error",
+        "message": "Invalid or corrupted image file provided",
+    }
+    assert records[3]["message"] == "Invalid image MIME type."
+
+
+def test_batch_applies_the_shared_options(client):
+    response = _post_batch(
+        client,
+        "/resizeImageBatch",
+        [("a.png", _png((40, 20))), ("b.png", _png((10, 10)))],
+        width="20",
+        maintainAspectRatio="true",
+    )
+
+    archive, manifest = _read_zip(response)
+    assert manifest["options"] == {"width": 20, "height": None}
+    assert Image.open(io.BytesIO(archive.read("a_resized.png"))).size == (20, 10)
+    assert Image.open(io.BytesIO(archive.read("b_resized.png"))).size == (20, 20)
+
+
+def test_batch_rejects_invalid_options_before_streaming(client):
+    response = _post_batch(client, "/compressBatch", [("a.png", _png())], format="gif")
+
+    assert response.status_code == 400
+    assert "format" in response.get_json()["message"].lower()
+
+
+def test_batch_requires_images(client):
+    response = client.post("/upscaleBatch", data={}, content_type="multipart/form-data")
+
+    assert response.status_code == 400
+    assert "images" in response.get_json()["message"]
+
+
+def test_pool_yields_images_as_they_finish(monkeypatch):
+    monkeypatch.setattr(image_batch, "IMAGE_BATCH_WORKERS", 2)
+    monkeypatch.setattr(image_batch, "_pool", None)
+    release_first = threading.Event()
+
+    def convert(img, filename):
+        # The first image only finishes once the second has been yielded.
+        if filename == "first.png":
+            assert release_first.wait(5)
+        return b"out", "image/png", filename, {}
+
+    images = [("first.png", _png()), ("second.png", _png())]
+    results = image_batch.iter_processed_images(images, convert, {})
+
+    index, result = next(results)
+    assert (index, result["name"]) == (1, "second.png")
+
+    release_first.set()
+    index, result = next(results)
+    assert (index, result["name"]) == (0, "first.png")
+
+
+def test_batch_reports_the_stored_size_of_a_shrunk_decode(client):
+    buf = io.BytesIO()
+    Image.new("RGB", (800, 600), (10, 120, 200)).save(buf, format="JPEG")
+
+    response = _post_batch(
+        client,
+        "/resizeImageBatch",
+        [("big.jpg", buf.getvalue())],
+        width="40",
+        maintainAspectRatio="true",
+    )
+
+    archive, manifest = _read_zip(response)
+    assert (manifest["images"][0]["width"], manifest["images"][0]["height"]) == (800, 600)
+    assert Image.open(io.BytesIO(archive.read("big_resized.jpg"))).size == (40, 30)
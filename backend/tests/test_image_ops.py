@@ -0,0 +1,62 @@
+import io
+
+from PIL import Image, ImageChops, ImageStat
+
+from utils import image_ops
+
+
+def _jpeg(size):
+    buf = io.BytesIO()
+    Image.effect_mandelbrot(size, (-2, -1.2, 1, 1.2), 50).convert("RGB").save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+
+def _decode(data, convert, options):
+    img = image_ops.open_image(data)
+    options = image_ops.plan_decode(convert, img, options)
+    return image_ops.load_image(img), options
+
+
+def test_resize_decodes_a_jpeg_no_larger_than_it_needs():
+    data = _jpeg((801, 601))
+
+    img, options = _decode(data, image_ops.resize, {"width": 100, "height": None})
+
+    # 801 // 300 == 2: half scale keeps the decode REDUCING_GAP times the output.
+    assert img.size == (401, 301)
+    # The height is pinned from the stored aspect ratio, and the box covers
+    # the stored image within the rounded-up decode.
+    assert (options["width"], options["height"]) == (100, 75)
+    assert options["box"] == (0, 0, 400.5, 300.5)
+
+    shrunk = image_ops.resized(img, **options)
+    full = Image.open(io.BytesIO(data)).resize((100, 75), Image.Resampling.LANCZOS)
+    assert shrunk.size == (100, 75)
+    assert max(ImageStat.Stat(ImageChops.difference(shrunk, full)).mean) < 3
+
+
+def test_small_reductions_and_other_formats_decode_at_full_size():
+    img, options = _decode(_jpeg((400, 300)), image_ops.resize, {"width": 200, "height": 100})
+    assert img.size == (400, 300)
+    assert options == {"width": 200, "height": 100, "box": None}
+
+    buf = io.BytesIO()
+    Image.new("RGB", (800, 600)).save(buf, format="PNG")
+    img, options = _decode(buf.getvalue(), image_ops.resize, {"width": 50, "height": None})
+    assert img.size == (800, 600)
+    assert options["box"] is None
+
+
+def test_pipeline_plans_only_a_leading_resize():
+    data = _jpeg((800, 600))
+    steps = [("rotateFlip", {"action": "rotate_left"}), ("resize", {"width": 50, "height": None})]
+    options = {"steps": steps, "quality": 80, "output_format": "png"}
+
+    img, planned = _decode(data, image_ops.run_pipeline, options)
+    assert img.size == (800, 600)
+    assert planned["steps"] == steps
+
+    options["steps"] = steps[::-1]
+    img, planned = _decode(data, image_ops.run_pipeline, options)
+    assert img.size == (200, 150)
+    assert planned["steps"][0] == ("resize", {"width": 50, "height": 38, "box": None})
@@ -0,0 +1,75 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+
+
+def _png(size=(40, 20)):
+    buf = io.BytesIO()
+    Image.effect_noise(size, 40).convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _post(client, path, payload, **form):
+    form["image"] = (io.BytesIO(payload), "photo.png")
+    return client.post(path, data=form, content_type="multipart/form-data")
+
+
+def test_pipeline_runs_every_step_on_one_decode(client):
+    source = _png()
+    steps = [
+        {"op": "resize", "width": 20, "maintainAspectRatio": True},
+        {"op": "rotateFlip", "action": "rotate_right"},
+        {"op": "grayscale"},
+    ]
+
+    response = _post(client, "/imagePipeline", source, operations=json.dumps(steps), format="png")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert "photo_processed.png" in response.headers["Content-Disposition"]
+
+    expected = (
+        Image.open(io.BytesIO(source))
+        .resize((20, 10), Image.Resampling.LANCZOS)
+        .transpose(Image.Transpose.ROTATE_270)
+        .convert("L")
+    )
+    result = Image.open(io.BytesIO(response.get_data()))
+    assert result.mode == "L"
+    assert result.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize(
+    "operations, message",
+    [
+        ("", "JSON list"),
+        ("{\"op\": \"grayscale\"}", "JSON list"),
+        (json.dumps([{"op": "blur"}]), "Operation 1: op must be one of"),
+        (json.dumps([{"op": "grayscale"}, {"op": "resize"}]), "Operation 2 (resize): width"),
+        (json.dumps([{"op": "rotateFlip", "action": "spin"}]), "Invalid action"),
+    ],
+)
+def test_pipeline_rejects_invalid_operations(client, operations, message):
+    response = _post(client, "/imagePipeline", b"not decoded", operations=operations)
+
+    assert response.status_code == 400
+    assert message in response.get_json()["message"]
+
+
+def test_pipeline_refuses_steps_that_outgrow_the_pixel_limit(client, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    steps = [{"op": "upscale", "scale": 2}]
+
+    response = _post(client, "/imagePipeline", _png((20, 20)), operations=json.dumps(steps))
+
+    assert response.status_code == 400
+    assert "upscale step" in response.get_json()["message"]
+
+
+def test_rotate_flip_returns_the_transformed_image(client):
+    response = _post(client, "/rotateFlip", _png(), action="rotate_left", format="PNG")
+
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.get_data())).size == (20, 40)
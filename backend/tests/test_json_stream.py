@@ -0,0 +1,56 @@
+import base64
+import json
+
+from utils.json_stream import iter_base64, iter_success_data_url, ndjson_line
+
+
+def test_iter_base64_matches_one_shot_encoding_across_odd_chunks():
+    payload = bytes(range(256)) * 40
+    chunks = [payload[:1], payload[1:7], payload[7:5000], payload[5000:]]
+
+    encoded = b"".join(iter_base64(chunks, block_size=3 * 100))
+
+    assert encoded == base64.b64encode(payload)
+
+
+def test_iter_base64_never_pads_mid_stream():
+    blocks = list(iter_base64([b"ab", b"cd", b"efg"], block_size=3))
+
+    assert all(b"=" not in block for block in blocks[:-1])
+    assert b"".join(blocks) == base64.b64encode(b"abcdefg")
+
+
+def test_iter_success_data_url_is_the_success_envelope():
+    body = b"".join(
+        iter_success_data_url(
+            [b"PK\x03\x04", b"rest"], "application/zip", "Done.", {"encode": {"bytes": 8}}
+        )
+    )
+
+    parsed = json.loads(body)
+    assert parsed["success"] is True
+    assert parsed["message"] == "Done."
+    assert parsed["data"]["encode"] == {"bytes": 8}
+    assert parsed["data"]["image_data"] == (
+        "data:application/zip;base64," + base64.b64encode(b"PK\x03\x04rest").decode()
+    )
+
+
+def test_ndjson_lines_record_render_errors_instead_of_truncating():
+    from blueprints.pdf import _ndjson_lines
+    from utils.pdf_render import PageRenderError
+
+    def pages():
+        yield 2, [(None, b"png-2", None)]
+        raise PageRenderError(3)
+
+    lines = [json.loads(line) for line in _ndjson_lines((1, [(None, b"png-1", None)]), pages(), "default")]
+
+    assert [line.get("page") for line in lines] == [1, 2, None]
+    assert lines[0]["images"][0]["name"] == "page_1.png"
+    assert lines[-1]["success"] is False
+    assert "page 3" in lines[-1]["message"]
+
+
+def test_ndjson_line_is_newline_terminated():
+    assert ndjson_line({"page": 1}) == b'{"page": 1}\n'
@@ -0,0 +1,75 @@
+import io
+import json
+import zipfile
+
+import pytest
+from PIL import Image
+
+from utils.page_encoders import (
+    ENCODER_PROFILES,
+    encode_image,
+    png_band_level,
+    profile_extension,
+    profile_zip_compression,
+)
+
+
+@pytest.mark.parametrize(
+    "profile, image_format",
+    [("small", "PNG"), ("lossy-web", "WEBP"), ("jpeg", "JPEG")],
+)
+def test_encode_image_uses_the_profile_format(profile, image_format):
+    image = Image.new("RGB", (64, 48), "white")
+
+    encoded = Image.open(io.BytesIO(encode_image(image, profile)))
+
+    assert encoded.format == image_format
+    assert encoded.size == (64, 48)
+
+
+def test_lossy_profiles_store_zip_entries():
+    assert profile_extension("jpeg") == "jpg"
+    assert profile_zip_compression("lossy-web") == zipfile.ZIP_STORED
+    assert profile_zip_compression("default") == zipfile.ZIP_DEFLATED
+    assert png_band_level("default") == 6
+    assert png_band_level("fast") == 1
+
+
+def test_zip_entries_hold_only_the_pages_by_default():
+    from blueprints.pdf import _zip_entries
+
+    first_page = (1, [(None, b"a" * 10, {"render_ms": 2.0, "encode_ms": 1.5, "raw_bytes": 300})])
+    rest = iter([(2, [(None, b"b" * 20, None)])])
+
+    entries = list(_zip_entries(first_page, rest, "fast"))
+
+    assert [name for name, *_ in entries] == ["page_1.png", "page_2.png"]
+
+
+def test_zip_entries_end_with_an_encode_manifest_on_request():
+    from blueprints.pdf import _zip_entries
+
+    first_page = (1, [(None, b"a" * 10, {"render_ms": 2.0, "encode_ms": 1.5, "raw_bytes": 300})])
+    rest = iter([(2, [(None, b"b" * 20, None)])])
+
+    entries = list(_zip_entries(first_page, rest, "fast", manifest=True))
+
+    assert [name for name, *_ in entries] == ["page_1.png", "page_2.png", "manifest.json"]
+    assert entries[0][2] == ENCODER_PROFILES["fast"]["zip"]
+
+    manifest = json.loads(entries[-1][1])
+    assert manifest["profile"] == "fast"
+    assert manifest["total_bytes"] == 30
+    assert manifest["total_encode_ms"] == 1.5
+    assert manifest["images"][1]["cached"] is True
+
+
+def test_convert_png_rejects_unknown_profile(client):
+    response = client.post(
+        "/convertPng",
+        data={"file": (io.BytesIO(b"%PDF-1.4\n"), "doc.pdf"), "profile": "tiny"},
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 400
+    assert "Invalid profile" in response.get_json()["message"]
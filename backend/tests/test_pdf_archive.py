@@ -0,0 +1,61 @@
+import io
+import zipfile
+
+import pytest
+
+from utils import pdf_archive
+from utils.pdf_archive import ArchiveError, read_pdf_archive
+
+
+def _archive(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_read_pdf_archive_returns_pdfs_in_order_and_skips_the_rest():
+    data = _archive(
+        [
+            ("b.pdf", b"%PDF-b"),
+            ("notes.txt", b"ignore me"),
+            ("__MACOSX/._b.pdf", b"fork"),
+            ("nested/a.PDF", b"%PDF-a"),
+        ]
+    )
+
+    assert read_pdf_archive(data) == [("b.pdf", b"%PDF-b"), ("nested/a.PDF", b"%PDF-a")]
+
+
+def test_read_pdf_archive_rejects_archives_without_pdfs():
+    with pytest.raises(ArchiveError, match="no PDF"):
+        read_pdf_archive(_archive([("notes.txt", b"text")]))
+
+    with pytest.raises(ArchiveError, match="Invalid archive"):
+        read_pdf_archive(b"PK not really")
+
+
+def test_read_pdf_archive_rejects_highly_compressed_members():
+    data = _archive([("bomb.pdf", b"%PDF" + b"\0" * 1_000_000)])
+
+    with pytest.raises(ArchiveError, match="too large"):
+        read_pdf_archive(data)
+
+
+def test_read_pdf_archive_caps_the_total_extracted_size(monkeypatch):
+    monkeypatch.setattr(pdf_archive, "MAX_ARCHIVE_TOTAL_BYTES", 1500)
+    data = _archive(
+        [(f"{n}.pdf", b"%PDF" + bytes(range(256)) * 3) for n in range(3)],
+        zipfile.ZIP_STORED,
+    )
+
+    with pytest.raises(ArchiveError, match="too large once extracted"):
+        read_pdf_archive(data)
+
+
+def test_read_pdf_archive_limits_the_member_count(monkeypatch):
+    monkeypatch.setattr(pdf_archive, "MAX_ARCHIVE_MEMBERS", 2)
+
+    with pytest.raises(ArchiveError, match="too many PDFs"):
+        read_pdf_archive(_archive([(f"{n}.pdf", b"%PDF") for n in range(3)]))
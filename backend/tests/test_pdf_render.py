@@ -0,0 +1,602 @@
+import concurrent.futures
+import io
+import json
+import os
+import time
+import zipfile
+
+import pytest
+
+from utils import pdf_render
+
+
+@pytest.fixture
+def thread_pool(monkeypatch):
+    # The real pool spawns processes that import the genuine PyMuPDF; a
+    # thread pool exercises the same ordering logic against the fitz mock.
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 4)
+    monkeypatch.setattr(pdf_render, "_get_pool", lambda: pool)
+    yield pool
+    pool.shutdown()
+
+
+def test_split_into_tasks_keeps_pages_contiguous_and_ordered(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 4)
+
+    chunks = pdf_render._split_into_tasks(list(range(1, 201)))
+
+    assert [page for chunk in chunks for page in chunk] == list(range(1, 201))
+    assert all(len(chunk) <= pdf_render.MAX_PAGES_PER_TASK for chunk in chunks)
+    assert len(chunks) >= 8
+
+
+def test_use_parallel_respects_mode_and_threshold(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 4)
+    monkeypatch.setattr(pdf_render, "PARALLEL_MIN_PAGES", 4)
+
+    assert pdf_render.use_parallel(None, 10) is True
+    assert pdf_render.use_parallel("auto", 2) is False
+    assert pdf_render.use_parallel("true", 2) is True
+    assert pdf_render.use_parallel("false", 10) is False
+    assert pdf_render.use_parallel("true", 1) is False
+
+
+def test_use_parallel_is_disabled_without_workers(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 1)
+
+    assert pdf_render.use_parallel("true", 100) is False
+
+
+def test_parallel_pages_come_back_in_page_order(monkeypatch, thread_pool):
+    def fake_task(pdf_bytes, page_numbers, spec):
+        # Later chunks finish first, so ordering must come from the caller.
+        time.sleep(0.01 * (10 - page_numbers[0] % 10))
+        return [(n, [(None, f"png-{n}".encode(), None)]) for n in page_numbers]
+
+    monkeypatch.setattr(pdf_render, "_render_task", fake_task)
+
+    pages = list(
+        pdf_render.iter_rendered_pages(
+            None, b"%PDF", range(1, 41), {"zoom": 1.0}, parallel="true"
+        )
+    )
+
+    assert [n for n, _ in pages] == list(range(1, 41))
+    assert pages[4] == (5, [(None, b"png-5", None)])
+
+
+def test_parallel_render_error_names_the_failing_page(monkeypatch, thread_pool):
+    def fake_task(pdf_bytes, page_numbers, spec):
+        if 7 in page_numbers:
+            raise pdf_render.PageRenderError(7)
+        return [(n, b"png") for n in page_numbers]
+
+    monkeypatch.setattr(pdf_render, "_render_task", fake_task)
+
+    with pytest.raises(pdf_render.PageRenderError) as exc_info:
+        list(
+            pdf_render.iter_rendered_pages(
+                None, b"%PDF", range(1, 21), {"zoom": 1.0}, parallel="true"
+            )
+        )
+
+    assert exc_info.value.page_number == 7
+
+
+def test_render_targets_label_each_requested_size():
+    spec = {"zoom": 2.0, "sizes": [("width", 320), ("dpi", 150)]}
+
+    assert pdf_render.render_targets(spec) == [
+        ("320w", ("width", 320)),
+        ("150dpi", ("dpi", 150)),
+    ]
+    assert pdf_render.render_targets({"zoom": 2.0}) == [(None, ("dpi", 144))]
+
+
+def test_parse_sizes_accepts_dpis_and_widths():
+    from blueprints.pdf import _parse_sizes
+
+    assert _parse_sizes("320w, 150,150") == [("width", 320), ("dpi", 150)]
+
+    for bad in ("", "10", "abc", "5w", "72,96,150,200,300,600"):
+        with pytest.raises(ValueError):
+            _parse_sizes(bad)
+
+
+def test_parallel_previews_use_the_preview_task(monkeypatch, thread_pool):
+    def fake_preview_task(pdf_bytes, page_numbers, options):
+        return [(n, f"jpeg-{n}".encode(), options["width"], 200) for n in page_numbers]
+
+    monkeypatch.setattr(pdf_render, "_preview_task", fake_preview_task)
+    monkeypatch.setattr(
+        pdf_render, "_render_task", lambda *args: pytest.fail("full render used")
+    )
+
+    previews = list(
+        pdf_render.iter_previews(
+            None,
+            b"%PDF",
+            range(1, 31),
+            {"width": 120, "format": "jpeg", "quality": 50},
+            parallel="true",
+        )
+    )
+
+    assert [n for n, *_ in previews] == list(range(1, 31))
+    assert previews[2] == (3, b"jpeg-3", 120, 200)
+
+
+@pytest.mark.parametrize(
+    "form, message",
+    [
+        ({"format": "gif"}, "Invalid format"),
+        ({"width": "8"}, "Width must be between"),
+        ({"quality": "high"}, "Invalid width or quality"),
+        ({"parallel": "maybe"}, "Invalid parallel value"),
+    ],
+)
+def test_preview_rejects_invalid_options(client, form, message):
+    response = client.post(
+        "/previewPdf",
+        data={"file": (io.BytesIO(b"%PDF-1.4\n"), "doc.pdf"), **form},
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 400
+    assert message in response.get_json()["message"]
+
+
+class _FakeRect:
+    width = 600
+    height = 800
+
+
+class _FakeDoc:
+    def load_page(self, index):
+        page = type("Page", (), {})()
+        page.rect = _FakeRect()
+        if index == 0:
+            # A landscape cover ahead of portrait pages.
+            page.rect.width, page.rect.height = 800, 600
+        return page
+
+
+def test_grid_layout_takes_cell_aspect_from_the_first_page_of_the_range():
+    grid = pdf_render.grid_layout(_FakeDoc(), range(2, 12), 4, 150)
+
+    gap = pdf_render.GRID_GAP
+    assert grid["cell_height"] == 200
+    assert grid["width"] == gap + 4 * (150 + gap)
+    assert grid["height"] == gap + 3 * (200 + gap)
+    assert pdf_render.grid_layout(_FakeDoc(), range(1, 11), 4, 150)["cell_height"] == 112
+
+
+def test_grid_layout_never_has_more_columns_than_pages():
+    grid = pdf_render.grid_layout(_FakeDoc(), range(1, 3), 8, 100, 100)
+
+    assert grid["columns"] == 2
+
+
+def test_parse_grid_validates_columns_and_cells():
+    from blueprints.pdf import _parse_grid
+
+    assert _parse_grid({"columns": "5", "cell_width": "120"}) == (5, 120, None)
+
+    for bad in ({"columns": "0"}, {"columns": "x"}, {"cell_width": "8"}, {"cell_height": "5000"}):
+        with pytest.raises(ValueError):
+            _parse_grid(bad)
+
+
+def test_grid_layout_cannot_be_combined_with_sizes(client):
+    response = client.post(
+        "/convertPng",
+        data={
+            "file": (io.BytesIO(b"%PDF-1.4\n"), "doc.pdf"),
+            "layout": "grid",
+            "sizes": "72,150",
+        },
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 400
+    assert "layout=grid" in response.get_json()["message"]
+
+
+def test_parse_render_profile_applies_overrides_to_the_preset():
+    from blueprints.pdf import _parse_render_profile
+
+    assert _parse_render_profile({}) == pdf_render.RENDER_PROFILES["default"]
+    assert _parse_render_profile({"render_profile": "draft", "annots": "true", "aa": "6"}) == {
+        "colorspace": "gray",
+        "aa": 6,
+        "annots": True,
+    }
+
+    for bad in (
+        {"render_profile": "fancy"},
+        {"colorspace": "cmyk"},
+        {"aa": "9"},
+        {"aa": "low"},
+        {"annots": "maybe"},
+    ):
+        with pytest.raises(ValueError):
+            _parse_render_profile(bad)
+
+
+def test_reduced_anti_aliasing_needs_the_pool(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 1)
+    assert pdf_render.effective_aa_level(2) == pdf_render.DEFAULT_AA_LEVEL
+
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 4)
+    assert pdf_render.effective_aa_level(2) == 2
+
+
+def test_render_token_keeps_default_keys_and_separates_variants():
+    assert pdf_render.render_token({"zoom": 1.0}) == "rgb"
+    assert pdf_render.render_token({"colorspace": "gray", "aa": 8, "annots": True}) == "gray"
+    assert pdf_render.render_token({"colorspace": "rgb", "aa": 2, "annots": False}) == "rgb-aa2-noannots"
+
+
+def test_single_page_reduced_aa_render_goes_to_the_pool(monkeypatch, thread_pool):
+    def fake_task(pdf_bytes, page_numbers, spec):
+        return [(n, [(None, b"pool", None)]) for n in page_numbers]
+
+    monkeypatch.setattr(pdf_render, "_render_task", fake_task)
+
+    pages = list(
+        pdf_render.iter_rendered_pages(
+            object(), b"%PDF", [1], {"zoom": 1.0, "aa": 2}, parallel="false"
+        )
+    )
+
+    assert pages == [(1, [(None, b"pool", None)])]
+
+
+def test_parse_budget_reads_limits_and_dpi_ceiling():
+    from blueprints.pdf import _parse_budget
+
+    assert _parse_budget({}, 600) is None
+    assert _parse_budget({"max_width": "1200", "max_megapixels": "2.5"}, 300) == (
+        1200,
+        None,
+        2_500_000,
+        300,
+    )
+
+    for bad in ({"max_width": "8"}, {"max_height": "tall"}, {"max_megapixels": "0"}, {"max_megapixels": "1000"}):
+        with pytest.raises(ValueError):
+            _parse_budget(bad, 600)
+
+
+def test_budget_renders_one_unlabelled_target_with_a_stable_cache_token():
+    spec = {"zoom": 1.0, "budget": (1000, None, 2_000_000, 600)}
+
+    assert pdf_render.render_targets(spec) == [(None, ("budget", (1000, None, 2_000_000, 600)))]
+    assert pdf_render._size_token(("budget", (1000, None, 2_000_000, 600))) == "fit-1000-x-2000000-600"
+
+
+def test_parse_clip_reads_points_and_fractions():
+    from blueprints.pdf import _parse_clip
+
+    assert _parse_clip({}) is None
+    assert _parse_clip({"clip": "72, 144, 144, 216"}) == ("pt", 72.0, 144.0, 144.0, 216.0)
+    assert _parse_clip({"clip": "0.5,0,1,0.25", "clip_units": "fraction"}) == (
+        "fraction",
+        0.5,
+        0.0,
+        1.0,
+        0.25,
+    )
+
+    for bad in (
+        {"clip": "1,2,3"},
+        {"clip": "a,b,c,d"},
+        {"clip": "10,10,5,20"},
+        {"clip": "0,0,2,1", "clip_units": "fraction"},
+        {"clip": "0,0,1,1", "clip_units": "inches"},
+        {"clip": "-5,0,10,10"},
+    ):
+        with pytest.raises(ValueError):
+            _parse_clip(bad)
+
+
+def test_render_token_separates_clipped_renders():
+    assert pdf_render.render_token({"clip": ("pt", 72.0, 144.0, 144.0, 216.0)}) == "rgb-clip-pt-72-144-144-216"
+    assert pdf_render.render_token(
+        {"colorspace": "gray", "aa": 2, "annots": True, "clip": ("fraction", 0.5, 0.0, 1.0, 0.25)}
+    ) == "gray-aa2-clip-fraction-0.5-0-1-0.25"
+
+
+def test_page_render_error_carries_a_reason():
+    assert pdf_render.PageRenderError(3).reason == "The page may be corrupted or unsupported."
+    assert pdf_render.PageRenderError(3, "Outside.").reason == "Outside."
+
+
+def test_grid_layout_cannot_be_combined_with_a_clip(client):
+    response = client.post(
+        "/convertPng",
+        data={
+            "file": (io.BytesIO(b"%PDF-1.4\n"), "doc.pdf"),
+            "layout": "grid",
+            "clip": "0,0,72,72",
+        },
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 400
+    assert "layout=grid" in response.get_json()["message"]
+
+
+class _FakePdf:
+    """Just enough of a fitz.Document's object table for page fingerprints."""
+
+    def __init__(self, pages, objects, streams):
+        self.pages = pages
+        self.objects = objects
+        self.streams = streams
+
+    def page_xref(self, index):
+        return self.pages[index]
+
+    def xref_get_key(self, xref, key):
+        value = self.objects[xref].get(key)
+        return ("null", "null") if value is None else ("xref", value)
+
+    def xref_object(self, xref, compressed=False):
+        return str(self.objects[xref])
+
+    def xref_stream_raw(self, xref):
+        return self.streams[xref]
+
+    def xref_is_stream(self, xref):
+        return xref in self.streams
+
+
+def _form_pdf():
+    objects = {
+        1: {"MediaBox": "[0 0 612 792]", "Resources": "2 0 R"},
+        2: {"Font": "<</F1 3 0 R>>"},
+        9: {"Font": "<</F1 3 0 R>>"},
+        10: {"Font": "<</F1 4 0 R>>"},
+        20: {},
+        21: {},
+        22: {},
+    }
+    pages = [
+        {"Contents": "20 0 R"},  # cover
+        {"Resources": "9 0 R"},  # blank separator
+        {"Contents": "21 0 R"},  # body
+        {"Resources": "10 0 R"},  # blank separator, other resources
+        {"Contents": "22 0 R", "Resources": "9 0 R"},  # cover again
+        {"Contents": "20 0 R", "Resources": "10 0 R"},  # cover text, other font
+        {"Contents": "20 0 R", "Annots": "[30 0 R]"},  # cover with a note
+    ]
+    for number, page in enumerate(pages):
+        objects[100 + number] = {"Parent": "1 0 R", **page}
+
+    streams = {20: b"BT (Cover) Tj ET", 21: b"BT (Body) Tj ET", 22: b"BT (Cover) Tj ET"}
+    return _FakePdf([100 + n for n in range(len(pages))], objects, streams)
+
+
+def test_duplicate_pages_match_content_resources_and_annotations():
+    doc = _form_pdf()
+
+    assert pdf_render.duplicate_pages(doc, range(1, 8)) == {4: 2, 5: 1}
+    assert pdf_render.duplicate_pages(doc, range(1, 8), annots=False) == {4: 2, 5: 1, 7: 1}
+
+
+def test_duplicate_pages_follow_indirect_contents_arrays():
+    pymupdf = pytest.importorskip("pymupdf")
+    doc = pymupdf.open()
+    for text in ("First page", "Second page"):
+        doc.new_page(width=200, height=150).insert_text((20, 60), text)
+    doc.new_page(width=200, height=150)
+    shared_resources = doc.xref_get_key(doc[0].xref, "Resources")[1]
+    arrays = []
+    for page in doc:
+        # /Contents 10 0 R, where object 10 is [6 0 R]
+        contents = page.get_contents() or doc[0].get_contents()
+        array = doc.get_new_xref()
+        doc.update_object(array, "[" + " ".join(f"{xref} 0 R" for xref in contents) + "]")
+        arrays.append(array)
+    for page, array in zip(doc, [arrays[0], arrays[1], arrays[0]]):
+        doc.xref_set_key(page.xref, "Contents", f"{array} 0 R")
+        doc.xref_set_key(page.xref, "Resources", shared_resources)
+    doc = pymupdf.open(stream=doc.tobytes(), filetype="pdf")
+
+    assert pdf_render.duplicate_pages(doc, [1, 2, 3]) == {3: 1}
+
+
+def test_duplicate_pages_are_rendered_once(monkeypatch):
+    rendered = []
+
+    def fake_render(doc, page_numbers, spec, pdf_bytes=None):
+        for n in page_numbers:
+            rendered.append(n)
+            yield n, [(None, f"png-{n}".encode(), {"render_ms": 5.0, "encode_ms": 1.0})]
+
+    monkeypatch.setattr(pdf_render, "_render_page_numbers", fake_render)
+    stats = {}
+
+    pages = list(
+        pdf_render.iter_rendered_pages(
+            _form_pdf(), b"%PDF", range(1, 8), {"zoom": 1.0}, parallel="false", stats=stats
+        )
+    )
+
+    assert rendered == [1, 2, 3, 6, 7]
+    assert stats["dedup_hits"] == 2
+    assert pages[4] == (5, [(None, b"png-1", {"render_ms": 0.0, "encode_ms": 0.0, "duplicate_of": 1})])
+    assert pages[3][1][0][1] == b"png-2"
+
+
+def test_manifest_reports_the_dedup_rate():
+    from blueprints.pdf import _encode_report, _manifest
+
+    reports = [
+        _encode_report(1, "page_1.png", b"a", {"render_ms": 5.0, "encode_ms": 1.0}),
+        _encode_report(2, "page_2.png", b"a", {"render_ms": 0.0, "encode_ms": 0.0, "duplicate_of": 1}),
+        _encode_report(3, "page_3.png", b"b", None),
+        _encode_report(4, "page_4.png", b"a", {"render_ms": 0.0, "encode_ms": 0.0, "duplicate_of": 1}),
+    ]
+
+    manifest = _manifest("default", reports)
+
+    assert manifest["dedup_hits"] == 2
+    assert manifest["dedup_rate"] == 0.5
+    assert manifest["images"][1]["duplicate_of"] == 1
+
+
+class _CrashingPool:
+    """Executor whose workers die whenever `crasher` is in flight."""
+
+    def __init__(self, crasher):
+        self.crasher = crasher
+        self.shut_down = False
+
+    def submit(self, fn, pdf_bytes, *args):
+        future = concurrent.futures.Future()
+        if pdf_bytes == self.crasher:
+            self.shut_down = True
+        if self.shut_down:
+            future.set_exception(pdf_render.BrokenProcessPool("worker died"))
+        else:
+            future.set_result({"pages": [], "page_count": 1, "source": pdf_bytes})
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def test_a_document_that_kills_the_pool_fails_alone(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 2)
+    monkeypatch.setattr(pdf_render, "_get_pool", lambda: _CrashingPool(b"%PDF-3"))
+    monkeypatch.setattr(pdf_render, "_discard_pool", lambda pool: None)
+    documents = [f"%PDF-{n}".encode() for n in range(8)]
+
+    results = list(pdf_render.iter_rendered_documents(documents, 1, None, {"zoom": 1.0}, 100))
+
+    assert [index for index, _ in results] == list(range(8))
+    assert isinstance(results[3][1], pdf_render.DocumentError)
+    assert [result["source"] for index, result in results if index != 3] == [
+        document for index, document in enumerate(documents) if index != 3
+    ]
+
+
+def test_batch_zip_has_a_folder_per_document_and_a_manifest():
+    from blueprints.pdf import _batch_zip_entries
+
+    def rendered():
+        yield 0, {"page_count": 2, "dedup_hits": 0, "pages": [(1, [(None, b"a", None)]), (2, [(None, b"b", None)])]}
+        yield 1, pdf_render.DocumentError("This PDF is password-protected and cannot be converted.")
+        yield 2, {"page_count": 1, "dedup_hits": 0, "pages": [(1, [(None, b"c", None)])]}
+
+    documents = [
+        ("report.pdf", None),
+        ("locked.pdf", None),
+        ("notes.txt", "Invalid file format. Please upload a PDF file."),
+        ("dir/report.pdf", None),
+    ]
+
+    entries = list(_batch_zip_entries(documents, rendered(), "default"))
+
+    assert [name for name, *_ in entries] == [
+        "report/page_1.png",
+        "report/page_2.png",
+        "report-2/page_1.png",
+        "manifest.json",
+    ]
+    manifest = json.loads(entries[-1][1])
+    assert (manifest["documents_ok"], manifest["documents_failed"]) == (2, 2)
+    assert [record["status"] for record in manifest["documents"]] == ["ok", "error", "error", "ok"]
+    assert manifest["documents"][1]["message"].startswith("This PDF is password-protected")
+    assert manifest["documents"][3]["images"][0]["name"] == "report-2/page_1.png"
+    assert entries[-1][2] == zipfile.ZIP_DEFLATED
+
+
+def test_batch_requires_files(client):
+    response = client.post("/convertPngBatch", data={}, content_type="multipart/form-data")
+
+    assert response.status_code == 400
+    assert "No files provided" in response.get_json()["message"]
+
+
+class _RecordingPool:
+    """Executor that runs tasks inline and keeps their arguments."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append(args)
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def test_parallel_ranges_keep_a_bounded_number_of_chunks_in_flight(monkeypatch):
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 2)
+    pool = _RecordingPool()
+    monkeypatch.setattr(pdf_render, "_get_pool", lambda: pool)
+
+    def fake_task(pdf_bytes, page_numbers, spec):
+        return [(n, []) for n in page_numbers]
+
+    pages = pdf_render._iter_parallel(b"%PDF", list(range(1, 201)), {}, fake_task)
+
+    assert next(pages) == (1, [])
+    assert len(pool.calls) == 2 * pdf_render.TASKS_AHEAD_PER_WORKER
+    assert [n for n, _ in pages] == list(range(2, 201))
+    assert len(pool.calls) == len(pdf_render._split_into_tasks(list(range(1, 201))))
+
+
+def test_pool_bands_of_a_request_share_one_spool_file(monkeypatch):
+    pymupdf = pytest.importorskip("pymupdf")
+    opened = []
+
+    class _Fitz:
+        def __getattr__(self, name):
+            return getattr(pymupdf, name)
+
+        def open(self, *args, **kwargs):
+            opened.append(pymupdf.open(*args, **kwargs))
+            return opened[-1]
+
+    monkeypatch.setattr(pdf_render, "fitz", _Fitz())
+    monkeypatch.setattr(
+        pdf_render,
+        "_FITZ_COLORSPACES",
+        {"rgb": pymupdf.csRGB, "gray": pymupdf.csGRAY, "mono": pymupdf.csGRAY},
+    )
+    monkeypatch.setattr(pdf_render, "RENDER_WORKERS", 2)
+    monkeypatch.setattr(pdf_render, "TILE_PIXELS", 5000)
+    pool = _RecordingPool()
+    monkeypatch.setattr(pdf_render, "_get_pool", lambda: pool)
+
+    doc = pymupdf.open()
+    for text in ("First banded page", "Second banded page"):
+        doc.new_page(width=200, height=150).insert_text((20, 60), text)
+    pdf_bytes = doc.tobytes()
+
+    pages = list(
+        pdf_render._render_page_numbers(doc, [1, 2], {"zoom": 1.0, "tiled": "true"}, pdf_bytes)
+    )
+
+    for page_num, images in pages:
+        assert images[0][1] == pdf_render.render_page_tiled(doc.load_page(page_num - 1), 1.0)
+    assert len(pool.calls) > 2
+    spool_paths = {args[0] for args in pool.calls}
+    assert len(spool_paths) == 1
+    assert not any(isinstance(arg, bytes) for args in pool.calls for arg in args)
+    assert not os.path.exists(spool_paths.pop())
+    # Each task closed the document it opened.
+    assert opened and all(task_doc.is_closed for task_doc in opened)
+
+
+def test_unreadable_batch_documents_raise_a_document_error(monkeypatch):
+    pymupdf = pytest.importorskip("pymupdf")
+    monkeypatch.setattr(pdf_render, "fitz", pymupdf)
+
+    with pytest.raises(pdf_render.DocumentError, match="corrupted or unreadable"):
+        pdf_render.render_document(b"not a pdf", 1, None, {"zoom": 1.0}, 10)
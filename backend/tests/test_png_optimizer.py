@@ -0,0 +1,107 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+from utils import png_optimizer
+
+
+def _decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def _text_on_transparency():
+    # Antialiased text: one RGB value under many alpha levels.
+    image = Image.new("RGBA", (600, 240), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for row in range(3):
+        draw.text((5, 5 + row * 75), "Palette me", fill=(200, 30, 30, 255), font_size=60)
+    return image
+
+
+def test_few_colours_are_palettized_losslessly():
+    image = _text_on_transparency()
+
+    data = png_optimizer.optimize_png(image)
+
+    decoded = _decode(data)
+    assert decoded.mode == "P"
+    assert decoded.convert("RGBA").tobytes() == image.tobytes()
+    assert len(data) < len(png_optimizer._encode_plain(image))
+
+
+@pytest.mark.parametrize("bits, colors", [(1, 2), (2, 4), (4, 9)])
+def test_unfiltered_palette_encodes_use_the_smallest_bit_depth(bits, colors):
+    image = Image.new("RGB", (33, 7), (0, 0, 255))
+    for x in range(33):
+        image.putpixel((x, x % 7), (x % colors * 20, 0, 255))
+    indexed = png_optimizer._palettized(image)
+
+    data = png_optimizer._encode_unfiltered(indexed, float("inf"), strategy=0)
+
+    assert data[24] == bits  # IHDR bit depth
+    assert _decode(data).convert("RGB").tobytes() == image.tobytes()
+
+
+def test_lossless_reductions_keep_every_pixel():
+    gray = Image.effect_noise((64, 48), 50).convert("RGB")
+    assert png_optimizer._reduced(gray).mode == "L"
+    gray.putalpha(Image.linear_gradient("L").resize(gray.size))
+    assert png_optimizer._reduced(gray).mode == "LA"
+
+    opaque = Image.effect_noise((64, 48), 50).convert("RGBA")
+    data = png_optimizer.optimize_png(opaque)
+    assert _decode(data).convert("RGBA").tobytes() == opaque.tobytes()
+
+
+def test_colors_quantizes_the_image():
+    photo = Image.effect_mandelbrot((200, 150), (-2, -1.2, 1, 1.2), 100).convert("RGB")
+
+    decoded = _decode(png_optimizer.optimize_png(photo, colors=16))
+
+    assert decoded.mode == "P"
+    assert len(decoded.getcolors(256)) <= 16
+
+
+def test_an_exhausted_budget_returns_pillows_optimized_encode():
+    image = _text_on_transparency()
+    buf = io.BytesIO()
+    image.save(buf, format="PNG", optimize=True)
+
+    assert png_optimizer.optimize_png(image, budget_ms=0) == buf.getvalue()
+
+
+def test_the_search_is_never_larger_than_pillows_optimized_encode():
+    image = Image.effect_noise((120, 80), 40).convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, format="PNG", optimize=True)
+
+    assert len(png_optimizer.optimize_png(image)) <= len(buf.getvalue())
+
+
+def test_compress_rejects_an_invalid_colour_count(client):
+    buf = io.BytesIO()
+    _text_on_transparency().save(buf, format="PNG")
+    form = {"image": (io.BytesIO(buf.getvalue()), "logo.png"), "format": "png", "colors": "300"}
+
+    response = client.post("/compress", data=form, content_type="multipart/form-data")
+
+    assert response.status_code == 400
+    assert "colors must be between" in response.get_json()["message"]
+
+
+def test_no_image_is_saved_by_two_trials_at_once(monkeypatch, save_overlaps):
+    monkeypatch.setattr(png_optimizer, "PNG_OPTIMIZE_WORKERS", 4)
+    monkeypatch.setattr(png_optimizer, "_pool", None)
+    photo = Image.effect_mandelbrot((200, 150), (-2, -1.2, 1, 1.2), 100).convert("RGB")
+
+    try:
+        data = png_optimizer.optimize_png(photo)
+    finally:
+        png_optimizer._pool.shutdown()
+
+    assert save_overlaps == []
+    assert getattr(photo, "encoderinfo", {}) == {}
+    assert _decode(data).convert("RGB").tobytes() == photo.tobytes()
@@ -0,0 +1,55 @@
+import io
+import itertools
+import os
+import zlib
+
+from PIL import Image
+
+from utils import pdf_render
+from utils.png_stream import PngBandEncoder, adler32_combine, deflate_band
+
+
+def test_adler32_combine_matches_a_single_pass():
+    first, second = os.urandom(70000), os.urandom(12345)
+
+    combined = adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+
+    assert combined == zlib.adler32(first + second)
+
+
+def test_bands_assemble_into_the_original_image():
+    image = Image.effect_noise((37, 53), 64).convert("RGB")
+    raw = image.tobytes()
+    stride = 37 * 3
+
+    encoder = PngBandEncoder(37, 53, 3)
+    parts = [encoder.header()]
+    for row0, row1 in [(0, 20), (20, 21), (21, 53)]:
+        band = raw[row0 * stride:row1 * stride]
+        parts.append(encoder.segment(*deflate_band(band, stride)))
+    parts.append(encoder.finish())
+
+    decoded = Image.open(io.BytesIO(b"".join(parts)))
+    decoded.load()
+
+    assert decoded.size == (37, 53)
+    assert decoded.tobytes() == raw
+
+
+def test_band_rows_cover_the_page_without_overlap(monkeypatch):
+    monkeypatch.setattr(pdf_render, "TILE_PIXELS", 1000)
+
+    bands = pdf_render._band_rows(30, 101)
+
+    assert bands[0] == (0, 33)
+    assert bands[-1][1] == 101
+    assert all(a[1] == b[0] for a, b in itertools.pairwise(bands))
+
+
+def test_use_tiles_auto_switches_on_pixel_count(monkeypatch):
+    monkeypatch.setattr(pdf_render, "TILE_THRESHOLD_PIXELS", 100)
+
+    assert pdf_render.use_tiles("auto", 10, 11) is True
+    assert pdf_render.use_tiles(None, 10, 10) is False
+    assert pdf_render.use_tiles("true", 1, 1) is True
+    assert pdf_render.use_tiles("false", 100, 100) is False
@@ -0,0 +1,99 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from utils import pdf_render, poppler_render
+
+
+@pytest.fixture
+def fake_pdftoppm(monkeypatch):
+    """Stand in for pdf2image: one solid image per page, 8.5x11in at the DPI."""
+    calls = []
+
+    def convert_from_path(pdf_path, output_folder=None, first_page=None, last_page=None, **options):
+        calls.append((first_page, last_page, options))
+        dpi = options["dpi"]
+        size = options["size"]
+        width = size[0] if size else int(8.5 * dpi)
+        height = int(width * 11 / 8.5)
+        mode = "L" if options["grayscale"] else "RGB"
+        extension = {"png": "png", "jpeg": "jpg", "ppm": "ppm"}[options["fmt"]]
+
+        paths = []
+        for page_num in range(first_page, last_page + 1):
+            path = os.path.join(output_folder, f"out-{len(calls)}-{page_num:04d}.{extension}")
+            Image.new(mode, (width, height), page_num).save(path)
+            paths.append(path)
+        return paths
+
+    monkeypatch.setattr(poppler_render, "convert_from_path", convert_from_path)
+    return calls
+
+
+def test_page_runs_split_at_gaps_and_chunk_size():
+    assert poppler_render._page_runs([1, 2, 3, 5, 6, 9], 2) == [[1, 2], [3], [5, 6], [9]]
+
+
+def test_poppler_pages_come_back_in_order_with_one_image_per_size(fake_pdftoppm):
+    targets = [("100w", ("width", 100)), ("72dpi", ("dpi", 72))]
+
+    pages = list(poppler_render.iter_poppler_pages(b"%PDF", [2, 3, 7], targets, "default"))
+
+    assert [page_num for page_num, _ in pages] == [2, 3, 7]
+    label, data, info = pages[1][1][0]
+    assert label == "100w"
+    assert Image.open(io.BytesIO(data)).size == (100, 129)
+    assert (info["width"], info["dpi"]) == (100, None)
+    assert pages[1][1][1][2]["dpi"] == 72
+    # Two runs (2-3 and 7), one pdftoppm pass per size each.
+    assert [(first, last) for first, last, _ in fake_pdftoppm] == [(2, 3), (2, 3), (7, 7), (7, 7)]
+
+
+def test_poppler_reencodes_profiles_pdftoppm_cannot_write(fake_pdftoppm):
+    pages = list(
+        poppler_render.iter_poppler_pages(
+            b"%PDF", [1], [(None, ("dpi", 72))], "lossy-web", colorspace="gray", annots=False
+        )
+    )
+
+    _, data, info = pages[0][1][0]
+    assert Image.open(io.BytesIO(data)).format == "WEBP"
+    assert info["raw_bytes"] == info["width"] * info["height"]
+    options = fake_pdftoppm[0][2]
+    assert (options["fmt"], options["grayscale"], options["hide_annotations"]) == ("ppm", True, True)
+
+
+def test_poppler_unsupported_names_what_pdftoppm_lacks():
+    assert pdf_render.poppler_unsupported({"zoom": 1.0, "colorspace": "gray", "aa": 8}) is None
+    assert pdf_render.poppler_unsupported({"clip": ("pt", 0, 0, 72, 72)}) == "clip"
+    assert pdf_render.poppler_unsupported({"colorspace": "mono"}) == "colorspace=mono"
+    assert pdf_render.poppler_unsupported({"aa": 2}) == "reduced anti-aliasing"
+
+
+def test_render_token_separates_backends():
+    assert pdf_render.render_token({"backend": "pymupdf"}) == "rgb"
+    assert pdf_render.render_token({"backend": "poppler"}) == "rgb-poppler"
+
+
+def test_requested_poppler_backend_must_be_usable(monkeypatch):
+    from blueprints import pdf
+
+    monkeypatch.setattr(pdf, "poppler_available", lambda: False)
+    with pytest.raises(ValueError, match="not available"):
+        pdf._parse_backend({"backend": "poppler"}, {"zoom": 1.0})
+    with pytest.raises(ValueError, match="does not support clip"):
+        pdf._parse_backend({"backend": "poppler"}, {"clip": ("pt", 0, 0, 1, 1)})
+    with pytest.raises(ValueError, match="Invalid backend"):
+        pdf._parse_backend({"backend": "ghostscript"}, {})
+
+
+def test_poppler_deployment_default_falls_back_to_pymupdf(monkeypatch):
+    from blueprints import pdf
+
+    monkeypatch.setattr(pdf, "DEFAULT_RENDER_BACKEND", "poppler")
+    monkeypatch.setattr(pdf, "poppler_available", lambda: True)
+
+    assert pdf._parse_backend({}, {"zoom": 1.0}) == "poppler"
+    assert pdf._parse_backend({}, {"budget": (100, None, None, 600)}) == "pymupdf"
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from utils import pdf_render
+from utils.render_cache import RenderCache, _file_name, page_key
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = RenderCache(max_memory_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.get("a")
+    cache.put("c", b"1234")
+
+    assert cache.contains("a")
+    assert not cache.contains("b")
+    assert cache.contains("c")
+
+
+def test_disk_tier_survives_a_new_cache_and_evicts_by_size(tmp_path):
+    cache = RenderCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    cache.put("c", b"cccc")
+
+    reopened = RenderCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=10)
+
+    assert reopened.get("c") == b"cccc"
+    assert reopened.get("a") is None
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= 10
+
+
+def test_disk_tier_is_shared_by_caches_in_other_workers(tmp_path):
+    first = RenderCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=10)
+    second = RenderCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=10)
+
+    first.put("a", b"aaaa")
+    assert second.contains("a")
+    assert second.get("a") == b"aaaa"
+
+    # The size limit covers what every worker wrote, not just this one.
+    first.put("b", b"bbbb")
+    os.utime(tmp_path / _file_name("a"), (0, 0))
+    second.put("c", b"cccc")
+
+    assert not first.contains("a")
+    assert first.get("c") == b"cccc"
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= 10
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = RenderCache(max_memory_bytes=1024 * 1024)
+    monkeypatch.setattr(pdf_render, "render_cache", cache)
+    return cache
+
+
+def test_fully_cached_range_never_opens_the_document(monkeypatch, cache):
+    for n in range(1, 4):
+        cache.put(page_key("doc", n - 1, 72), f"png-{n}".encode())
+
+    def fail_open(*args, **kwargs):
+        raise AssertionError("MuPDF should not be touched")
+
+    monkeypatch.setattr(pdf_render.fitz, "open", fail_open)
+    stats = {}
+
+    pages = list(
+        pdf_render.iter_rendered_pages(
+            None, b"%PDF", range(1, 4), {"zoom": 1.0}, pdf_key="doc", stats=stats
+        )
+    )
+
+    assert pages == [(n, [(None, f"png-{n}".encode(), None)]) for n in range(1, 4)]
+    assert stats == {"cache_hits": 3, "cache_misses": 0, "dedup_hits": 0}
+
+
+def test_only_misses_are_rendered_and_then_cached(monkeypatch, cache):
+    cache.put(page_key("doc", 0, 72), b"cached-1")
+    rendered = []
+
+    def fake_render(doc, page_numbers, spec, pdf_bytes=None):
+        for n in page_numbers:
+            rendered.append(n)
+            yield n, [(None, f"fresh-{n}".encode(), {"encode_ms": 1.0})]
+
+    monkeypatch.setattr(pdf_render, "_render_page_numbers", fake_render)
+    stats = {}
+
+    pages = list(
+        pdf_render.iter_rendered_pages(
+            object(), b"%PDF", range(1, 4), {"zoom": 1.0}, pdf_key="doc", stats=stats
+        )
+    )
+
+    assert [(n, images[0][1]) for n, images in pages] == [
+        (1, b"cached-1"),
+        (2, b"fresh-2"),
+        (3, b"fresh-3"),
+    ]
+    assert rendered == [2, 3]
+    assert cache.contains(page_key("doc", 2, 72))
+    assert stats == {"cache_hits": 1, "cache_misses": 2, "dedup_hits": 0}
+
+
+def test_multi_size_pages_are_cached_per_size(monkeypatch, cache):
+    spec = {"zoom": 1.0, "sizes": [("width", 100), ("dpi", 150)]}
+    cache.put(page_key("doc", 0, "100w"), b"thumb")
+    rendered = []
+
+    def fake_render(doc, page_numbers, spec, pdf_bytes=None):
+        for n in page_numbers:
+            rendered.append(n)
+            yield n, [("100w", b"thumb", {}), ("150dpi", b"full", {})]
+
+    monkeypatch.setattr(pdf_render, "_render_page_numbers", fake_render)
+
+    list(pdf_render.iter_rendered_pages(object(), b"%PDF", [1], spec, pdf_key="doc"))
+    pages = list(
+        pdf_render.iter_rendered_pages(object(), b"%PDF", [1], spec, pdf_key="doc")
+    )
+
+    # One size cached is still a miss; after that render both sizes are hits.
+    assert rendered == [1]
+    assert pages == [(1, [("100w", b"thumb", None), ("150dpi", b"full", None)])]
@@ -0,0 +1,79 @@
+import io
+import json
+import zipfile
+
+import pytest
+from PIL import Image
+
+from utils import image_batch, image_ops
+
+
+def _post(client, **form):
+    buf = io.BytesIO()
+    Image.effect_mandelbrot((400, 300), (-2, -1.2, 1, 1.2), 50).convert("RGB").save(buf, format="PNG")
+    form["image"] = (io.BytesIO(buf.getvalue()), "hero.png")
+    return client.post("/responsiveImages", data=form, content_type="multipart/form-data")
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_responsive_set_resizes_down_a_chain_and_zips_every_format(client, monkeypatch, workers):
+    monkeypatch.setattr(image_batch, "IMAGE_BATCH_WORKERS", workers)
+    resized_from = []
+    real_resized = image_ops.resized
+
+    def recording_resized(img, width, height, box=None):
+        resized_from.append((img.size, (width, height)))
+        return real_resized(img, width, height, box)
+
+    monkeypatch.setattr(image_batch, "resized", recording_resized)
+
+    response = _post(client, widths="100,800,200", formats="jpeg,webp")
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    manifest = json.loads(archive.read("manifest.json"))
+
+    # 800 is wider than the upload, so it is served at the upload's width.
+    assert resized_from == [((400, 300), (400, 300)), ((400, 300), (200, 150)), ((200, 150), (100, 75))]
+    assert [(image["name"], image["status"]) for image in manifest["images"]] == [
+        ("hero_400w.jpg", "ok"),
+        ("hero_400w.webp", "ok"),
+        ("hero_200w.jpg", "ok"),
+        ("hero_200w.webp", "ok"),
+        ("hero_100w.jpg", "ok"),
+        ("hero_100w.webp", "ok"),
+    ]
+    assert manifest["srcset"]["webp"] == "hero_400w.webp 400w, hero_200w.webp 200w, hero_100w.webp 100w"
+    assert (manifest["width"], manifest["height"]) == (400, 300)
+    assert Image.open(archive.open("hero_100w.webp")).size == (100, 75)
+    assert Image.open(archive.open("hero_200w.jpg")).format == "JPEG"
+
+
+@pytest.mark.parametrize(
+    "form, message",
+    [
+        ({"widths": "320,wide"}, "widths must be"),
+        ({"widths": ",".join(["10"] * 13)}, "Too many widths"),
+        ({"formats": "webp,gif"}, "Invalid formats"),
+    ],
+)
+def test_responsive_set_rejects_invalid_options(client, form, message):
+    response = _post(client, **form)
+
+    assert response.status_code == 400
+    assert message in response.get_json()["message"]
+
+
+def test_formats_of_one_size_never_save_the_same_image(monkeypatch, save_overlaps):
+    monkeypatch.setattr(image_batch, "IMAGE_BATCH_WORKERS", 2)
+    img = Image.effect_mandelbrot((120, 90), (-2, -1.2, 1, 1.2), 50).convert("RGB")
+    steps = [((120, 90), None), ((60, 45), None)]
+
+    def encode(image, output_format):
+        return image_ops.encode_responsive(image, output_format, 80)
+
+    results = list(image_batch.iter_image_set(img, steps, ["webp", "jpeg"], encode))
+
+    assert save_overlaps == []
+    assert len(results) == 4
+    assert getattr(img, "encoderinfo", {}) == {}
@@ -49,4 +49,19 @@ def test_absolute_path_removed(app):
 
         header = response.headers["Content-Disposition"]
 
-        assert "/etc/passwd" not in header
\ No newline at end of file
+        assert "/etc/passwd" not in header
+
+def test_bytes_body_is_readable_after_request_hooks(app):
+    # The in-memory buffer used to be closed by an after_request hook, before
+    # the server had read the body from it.
+    @app.route("/_bytes")
+    def _bytes():
+        return send_file_and_cleanup(
+            b"Hello",
+            mimetype="text/plain",
+            download_name="hello.txt",
+        )
+
+    response = app.test_client().get("/_bytes")
+
+    assert response.data == b"Hello"
@@ -0,0 +1,194 @@
+import io
+
+import pytest
+from PIL import Image
+
+from utils import image_ops, target_size
+
+
+def _sized_encode(bytes_per_quality):
+    """A stand-in encoder whose output grows with pixels and quality."""
+    calls = []
+
+    def encode(image, quality):
+        calls.append((image.size, quality))
+        per_pixel = bytes_per_quality * (quality if quality is not None else 50)
+        return b"x" * int(image.width * image.height * per_pixel)
+
+    return encode, calls
+
+
+def _jpeg(image, quality):
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def parallel_pool(monkeypatch):
+    monkeypatch.setattr(target_size, "TARGET_SIZE_WORKERS", 4)
+    monkeypatch.setattr(target_size, "_pool", None)
+    yield
+    if target_size._pool is not None:
+        target_size._pool.shutdown()
+
+
+def test_fit_to_size_finds_the_highest_quality_that_fits_in_bounded_encodes():
+    img = Image.new("RGB", (1000, 1000))
+    encode, calls = _sized_encode(0.001)
+
+    data, report = target_size.fit_to_size(img, encode, 42_500)
+
+    # 1000 bytes per quality step: 42 is the best fit, 40 is close enough.
+    assert 42 - target_size.QUALITY_TOLERANCE <= report["quality"] <= 42
+    assert len(data) <= 42_500
+    assert report["target_met"] is True and report["scale"] == 1.0
+    assert report["encodes"] == len(calls)
+    full_encodes = [quality for size, quality in calls if size == img.size]
+    assert len(full_encodes) <= target_size.MAX_FULL_ENCODES + 1
+    assert len(calls) - len(full_encodes) == len(target_size.PROXY_QUALITIES)
+
+
+def test_fit_to_size_returns_the_smallest_encode_when_nothing_fits():
+    img = Image.new("RGB", (100, 100))
+    encode, _ = _sized_encode(1)
+
+    data, report = target_size.fit_to_size(img, encode, 100)
+
+    assert report["quality"] == target_size.MIN_QUALITY
+    assert report["target_met"] is False
+    assert len(data) == 100 * 100 * target_size.MIN_QUALITY
+
+
+def test_fit_to_size_scales_down_instead_of_below_the_resize_quality_floor():
+    img = Image.new("RGB", (400, 400))
+    encode, calls = _sized_encode(0.01)
+
+    data, report = target_size.fit_to_size(img, encode, 20_000, allow_resize=True)
+
+    assert report["target_met"] is True
+    assert report["scale"] < 1
+    assert report["quality"] >= target_size.RESIZE_MIN_QUALITY
+    assert len(data) <= 20_000
+    assert min(quality for _, quality in calls) >= target_size.RESIZE_MIN_QUALITY
+
+
+def _photo():
+    buf = io.BytesIO()
+    Image.effect_noise((300, 200), 60).convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _compress(client, **form):
+    form["image"] = (io.BytesIO(_photo()), "photo.png")
+    return client.post("/compress", data=form, content_type="multipart/form-data")
+
+
+def test_compress_to_a_target_size_reports_the_search(client):
+    response = _compress(client, format="jpeg", target_bytes="20000")
+
+    assert response.status_code == 200
+    assert len(response.get_data()) <= 20_000
+    assert 5 <= int(response.headers["X-Compress-Quality"]) <= 95
+    assert int(response.headers["X-Compress-Encodes"]) > 1
+    assert response.headers["X-Compress-Target-Met"] == "true"
+
+
+def test_compress_rejects_unusable_targets(client):
+    response = _compress(client, format="jpeg", target_bytes="10")
+    assert response.status_code == 400
+    assert "target_bytes" in response.get_json()["message"]
+
+    response = _compress(client, format="png", target_bytes="20000")
+    assert response.status_code == 400
+    assert "allow_resize" in response.get_json()["message"]
+
+
+def _scored_encode(monkeypatch):
+    """A stand-in encoder and SSIM: an encode at quality q scores q / 100."""
+    calls = []
+
+    def encode(image, quality):
+        calls.append((image.size, quality))
+        return bytes([quality])
+
+    monkeypatch.setattr(target_size, "_reference", lambda image: None)
+    monkeypatch.setattr(target_size, "_similarity", lambda reference, data: data[0] / 100)
+    return encode, calls
+
+
+def test_fit_to_ssim_finds_the_lowest_quality_that_scores_high_enough(monkeypatch):
+    img = Image.new("RGB", (2000, 1000))
+    encode, calls = _scored_encode(monkeypatch)
+
+    data, report = target_size.fit_to_ssim(img, encode, 0.42)
+
+    assert data == bytes([42])
+    assert report == {"quality": 42, "ssim": 0.42, "encodes": len(calls), "target_met": True}
+    # Only the final encode is made at full size.
+    assert [quality for size, quality in calls if size == img.size] == [42]
+    assert len(calls) <= len(target_size.SSIM_QUALITIES) + target_size.MAX_SSIM_REFINEMENTS + 1
+
+
+def test_fit_to_ssim_falls_back_to_the_highest_quality(monkeypatch):
+    encode, _ = _scored_encode(monkeypatch)
+
+    data, report = target_size.fit_to_ssim(Image.new("RGB", (50, 50)), encode, 0.99)
+
+    assert data == bytes([target_size.MAX_QUALITY])
+    assert report["target_met"] is False
+
+
+def test_ssim_mosaic_samples_block_aligned_tiles_at_full_resolution():
+    img = Image.effect_noise((3000, 2000), 60).convert("RGB")
+
+    mosaic = target_size._mosaic(img)
+
+    tile = target_size.SSIM_TILE
+    assert mosaic.width % tile == 0 and mosaic.height % tile == 0
+    assert mosaic.width * mosaic.height <= target_size.SSIM_PROXY_PIXELS
+    # Corners of the image land in the corners of the mosaic, unscaled.
+    assert mosaic.crop((0, 0, tile, tile)).tobytes() == img.crop((0, 0, tile, tile)).tobytes()
+    last = ((img.width - tile) // 16 * 16, (img.height - tile) // 16 * 16)
+    corner = (mosaic.width - tile, mosaic.height - tile, mosaic.width, mosaic.height)
+    assert mosaic.crop(corner).tobytes() == img.crop((*last, last[0] + tile, last[1] + tile)).tobytes()
+
+
+def test_compress_rejects_unusable_ssim_targets(client):
+    for form, message in [
+        ({"format": "jpeg", "min_ssim": "0.2"}, "min_ssim must be"),
+        ({"format": "webp", "min_ssim": "high"}, "min_ssim must be"),
+        ({"format": "jpeg", "min_ssim": "0.9", "target_bytes": "20000"}, "not both"),
+        ({"format": "png", "min_ssim": "0.9"}, "lossless"),
+    ]:
+        response = _compress(client, **form)
+        assert response.status_code == 400
+        assert message in response.get_json()["message"]
+
+
+def test_parallel_size_trials_each_save_their_own_image(parallel_pool, save_overlaps):
+    img = Image.effect_noise((300, 200), 60).convert("RGB")
+    target = len(_jpeg(img, 50))
+
+    data, report = image_ops.encode_compressed(img, "JPEG", 80, target_bytes=target)
+
+    assert save_overlaps == []
+    assert report["target_met"] is True
+    assert 50 - target_size.QUALITY_TOLERANCE <= report["quality"] <= 50
+    # Every encode used its own settings, including the full-size ones.
+    assert data == _jpeg(img.copy(), report["quality"])
+
+
+def test_parallel_ssim_trials_each_save_their_own_image(parallel_pool, save_overlaps, monkeypatch):
+    img = Image.effect_noise((300, 200), 60).convert("RGB")
+    # Scored by size, which grows with quality, in place of the NumPy SSIM.
+    floor = len(_jpeg(img, 60))
+    monkeypatch.setattr(target_size, "_reference", lambda image: None)
+    monkeypatch.setattr(target_size, "_similarity", lambda reference, data: len(data) / floor)
+
+    data, report = image_ops.encode_compressed(img, "JPEG", 80, min_ssim=1.0)
+
+    assert save_overlaps == []
+    assert report["target_met"] is True
+    assert data == _jpeg(img.copy(), report["quality"])
+    assert len(data) >= floor
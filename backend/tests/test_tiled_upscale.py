@@ -0,0 +1,67 @@
+import io
+
+import pytest
+from PIL import Image, ImageCms
+
+from utils import image_ops, tiled_upscale
+
+
+def _source(mode):
+    img = Image.effect_mandelbrot((37, 23), (-2, -1.2, 1, 1.2), 60).convert(mode)
+    if "A" in mode:
+        img.putalpha(Image.linear_gradient("L").resize(img.size))
+    return img
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("mode, scale", [("RGB", 1), ("RGB", 3), ("RGBA", 2), ("L", 4), ("LA", 1)])
+def test_tiles_match_the_whole_image_upscale(monkeypatch, workers, mode, scale):
+    monkeypatch.setattr(tiled_upscale, "UPSCALE_WORKERS", workers)
+    monkeypatch.setattr(tiled_upscale, "UPSCALE_TILE_PIXELS", 200)
+    img = _source(mode)
+
+    data = b"".join(tiled_upscale.iter_upscaled_png(img, scale))
+
+    result = Image.open(io.BytesIO(data))
+    assert result.mode == mode
+    assert result.tobytes() == image_ops.upscaled(img, scale).tobytes()
+
+
+def test_only_large_outputs_are_tiled(monkeypatch):
+    monkeypatch.setattr(tiled_upscale, "UPSCALE_TILE_THRESHOLD_PIXELS", 37 * 23 * 4)
+
+    assert not tiled_upscale.can_tile(_source("RGB"), 2)
+    assert tiled_upscale.can_tile(_source("RGB"), 3)
+    assert not tiled_upscale.can_tile(_source("RGB").convert("P"), 3)
+
+
+def test_upscale_streams_large_outputs(client, monkeypatch):
+    monkeypatch.setattr(tiled_upscale, "UPSCALE_TILE_THRESHOLD_PIXELS", 0)
+    monkeypatch.setattr(tiled_upscale, "UPSCALE_TILE_PIXELS", 500)
+    img = _source("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    form = {"image": (io.BytesIO(buf.getvalue()), "fractal.png"), "scale": "4"}
+
+    response = client.post("/upscale", data=form, content_type="multipart/form-data")
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert "fractal_upscaled_4x.png" in response.headers["Content-Disposition"]
+    result = Image.open(io.BytesIO(response.get_data()))
+    assert result.tobytes() == image_ops.upscaled(img, 4).tobytes()
+
+
+@pytest.mark.parametrize("mode, key", [("RGB", (12, 34, 56)), ("L", 7), ("RGBA", None)])
+def test_tiles_keep_the_profile_and_transparent_colour(mode, key):
+    img = _source(mode)
+    img.info["icc_profile"] = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    if key is not None:
+        img.info["transparency"] = key
+    whole = Image.open(io.BytesIO(image_ops.optimize_png(image_ops.upscaled(img, 2))))
+
+    tiled = Image.open(io.BytesIO(b"".join(tiled_upscale.iter_upscaled_png(img, 2))))
+
+    assert tiled.info["icc_profile"] == whole.info["icc_profile"] == img.info["icc_profile"]
+    assert tiled.info.get("transparency") == whole.info.get("transparency") == key
+    assert tiled.tobytes() == whole.tobytes()
@@ -0,0 +1,51 @@
+import io
+import zipfile
+
+from utils.helpers import send_stream
+from utils.zip_stream import iter_zip
+
+
+def test_iter_zip_builds_a_valid_archive_in_entry_order():
+    entries = [(f"page_{n}.png", f"png-{n}".encode() * 100) for n in range(1, 6)]
+
+    archive = b"".join(iter_zip(entries))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        assert zip_file.namelist() == [name for name, _ in entries]
+        assert zip_file.read("page_3.png") == b"png-3" * 100
+
+
+def test_iter_zip_consumes_entries_lazily():
+    produced = []
+
+    def entries():
+        for n in range(1, 4):
+            produced.append(n)
+            yield f"page_{n}.png", b"data"
+
+    chunks = iter_zip(entries())
+    next(chunks)
+
+    # Only the first entry has been pulled when the first chunk goes out.
+    assert produced == [1]
+
+
+def test_iter_zip_honours_per_entry_compression():
+    entries = [
+        ("page_1.jpg", b"jpeg" * 100, zipfile.ZIP_STORED),
+        ("manifest.json", b"{}" * 100),
+    ]
+
+    archive = b"".join(iter_zip(entries))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        assert zip_file.getinfo("page_1.jpg").compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo("manifest.json").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_send_stream_sanitises_download_name(app):
+    with app.test_request_context():
+        response = send_stream(iter([b"a", b"b"]), "application/zip", "../../x.zip")
+
+        assert response.is_streamed
+        assert "../" not in response.headers["Content-Disposition"]
@@ -0,0 +1,94 @@
+"""
+Choosing an output format by encoding in all of them at once.
+
+Which format is smallest depends on the image far more than on the settings:
+flat graphics are a fraction of the size as PNG, photos as JPEG or WebP.
+race() runs one encode per candidate format concurrently and keeps the
+smallest. Each encode is given the size to beat, read while it runs, and
+writes through a RaceBuffer (or checks the size itself) so that it stops
+as soon as it grows past the leader instead of finishing a result that
+cannot win. That only saves time for encoders that write as they go, such
+as PNG: Pillow's WebP encoder, and its JPEG encoder with optimize or
+progressive set, write the whole file at the end, so such an encode runs to
+completion and is only then discarded.
+"""
+import concurrent.futures
+import io
+import os
+import threading
+
+# The encodes run in C without the GIL, or wait on their own pools, and
+# only race if they run side by side: by default, room for one three-way
+# race per core.
+FORMAT_RACE_WORKERS = int(os.getenv("FORMAT_RACE_WORKERS", str(3 * (os.cpu_count() or 1))))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RaceLost(Exception):
+    """Raised inside an encode that has grown past the smallest result."""
+
+
+class RaceBuffer(io.BytesIO):
+    """
+    A BytesIO whose writes fail once it would outgrow `max_bytes()`.
+
+    The check runs on each write, so it stops an encode early only if the
+    encoder writes incrementally. Pillow's WebP encoder, and its JPEG
+    encoder with optimize or progressive set, make one write at the end,
+    where the buffer can only reject the finished file.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self._max_bytes = max_bytes
+
+    def write(self, data):
+        limit = self._max_bytes()
+        if limit is not None and self.tell() + len(data) > limit:
+            raise RaceLost()
+        return super().write(data)
+
+
+def _get_pool():
+    # Separate from the pools the encodes themselves use (PNG trials,
+    # quality searches), which would otherwise wait on each other.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=FORMAT_RACE_WORKERS,
+                thread_name_prefix="format-race",
+            )
+        return _pool
+
+
+def race(candidates):
+    """
+    Run `candidates`, {name: encode(max_bytes)}, concurrently. Each encode
+    returns (data, report), or None (or raises RaceLost) once it cannot come
+    in under `max_bytes()`, the size of the smallest result so far less one.
+    Returns {name: (data, report) or None}, in the order of `candidates`;
+    encodes that finished before the leader did are kept even if larger.
+    """
+    lock = threading.Lock()
+    best = None
+
+    def max_bytes():
+        return None if best is None else best - 1
+
+    def run(encode):
+        nonlocal best
+        try:
+            result = encode(max_bytes)
+        except RaceLost:
+            return None
+        if result is not None:
+            with lock:
+                if best is None or len(result[0]) < best:
+                    best = len(result[0])
+        return result
+
+    futures = {name: _get_pool().submit(run, encode) for name, encode in candidates.items()}
+    return {name: future.result() for name, future in futures.items()}
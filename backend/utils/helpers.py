@@ -3,7 +3,7 @@ import logging
 import os
 import re
 
-from flask import after_this_request, jsonify, send_file
+from flask import Response, after_this_request, jsonify, send_file, stream_with_context
 from werkzeug.utils import secure_filename
 
 logger = logging.getLogger(__name__)
@@ -116,18 +116,17 @@ def send_file_and_cleanup(filename, **kwargs):
             response = send_file(bio, **kwargs)
             safe_gc_collect()
 
-            @after_this_request
-            def cleanup_buffer(response):
-                """Close in-memory buffer after the response."""
+            def cleanup_buffer():
+                """Close in-memory buffer once the body has been sent."""
                 try:
                     bio.close()
                 except Exception:
                     # Log cleanup failures without interrupting the response.
                     logger.exception("Failed to close in-memory buffer.")
 
-                safe_gc_collect()
-                return response
-
+            # The body is read after after_request hooks run, so closing the
+            # buffer there would hand the server a closed file.
+            response.call_on_close(cleanup_buffer)
             return response
 
         # Handle file-like objects.
@@ -177,4 +176,24 @@ def send_file_and_cleanup(filename, **kwargs):
             return response
         except Exception:
             logger.exception("Fallback send_file also failed.")
-            raise
\ No newline at end of file
+            raise
+
+
+def stream_response(chunks, mimetype):
+    """Stream an iterable of byte chunks as the response body, unbuffered."""
+    return Response(stream_with_context(chunks), mimetype=mimetype)
+
+
+def send_stream(chunks, mimetype, download_name):
+    """
+    Stream an iterable of byte chunks as a file download.
+
+    Unlike send_file_and_cleanup(), nothing is buffered: each chunk goes to
+    the client as soon as the iterable produces it. The download name is
+    sanitized the same way.
+    """
+    download_name = secure_filename(download_name) or "download"
+
+    response = stream_response(chunks, mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    return response
@@ -0,0 +1,189 @@
+"""
+Worker pool for the image blueprint's batch routes.
+
+Each upload is decoded, converted and encoded on a shared thread pool.
+Pillow releases the GIL while it decodes, resamples, converts and encodes, so
+threads run those steps in parallel without pickling every upload over to a
+worker process. Results come back as each image finishes, not in upload order,
+so one slow image never holds back the ones queued behind it.
+
+The same pool encodes the sizes of a responsive image set
+(iter_image_set()), where one decoded upload is resized down a chain of
+widths and every size is encoded in several formats.
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from utils.image_ops import load_image, open_image, plan_decode, resized
+
+logger = logging.getLogger(__name__)
+
+IMAGE_BATCH_WORKERS = int(os.getenv("IMAGE_BATCH_WORKERS", str(os.cpu_count() or 1)))
+
+# Images submitted per worker ahead of the results being consumed, which
+# also bounds how many decoded images are held at once.
+IMAGES_PER_WORKER = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ImageError(Exception):
+    """One image in a batch could not be processed; the batch carries on."""
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=IMAGE_BATCH_WORKERS,
+                thread_name_prefix="image-batch",
+            )
+        return _pool
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def process_image(filename, image_bytes, convert, options):
+    """
+    Decode `image_bytes`, as small as `convert` allows, and run
+    `convert(img, filename, **options)` on it. Returns a result dict with
+    the output, its sizes and timings and the operation's report, or an
+    ImageError describing why the image failed.
+    """
+    img = None
+    try:
+        started = time.perf_counter()
+        img = open_image(image_bytes)
+        # The stored size, before a shrink-on-load decode changes it.
+        width, height = img.size
+        options = plan_decode(convert, img, options)
+        load_image(img)
+        decode_ms = _elapsed_ms(started)
+
+        started = time.perf_counter()
+        data, mimetype, download_name, report = convert(img, filename, **options)
+        convert_ms = _elapsed_ms(started)
+
+        return {
+            "name": download_name,
+            "data": data,
+            "mimetype": mimetype,
+            "format": img.format,
+            "width": width,
+            "height": height,
+            "input_bytes": len(image_bytes),
+            "output_bytes": len(data),
+            "decode_ms": decode_ms,
+            "convert_ms": convert_ms,
+            **report,
+        }
+    except ValueError as exc:
+        return ImageError(str(exc))
+    except Exception:
+        logger.exception("Batch image %s failed.", filename)
+        return ImageError("The image could not be processed.")
+    finally:
+        if img is not None:
+            img.close()
+
+
+def iter_processed_images(images, convert, options):
+    """
+    Yield (index, result) for each (filename, image_bytes) in `images`, as
+    each finishes, where result is what process_image() returns. At most
+    IMAGES_PER_WORKER per worker are in flight; closing the generator cancels
+    the rest.
+    """
+    if IMAGE_BATCH_WORKERS <= 1:
+        for index, (filename, image_bytes) in enumerate(images):
+            yield index, process_image(filename, image_bytes, convert, options)
+        return
+
+    pool = _get_pool()
+    window = IMAGE_BATCH_WORKERS * IMAGES_PER_WORKER
+    queued = iter(enumerate(images))
+    in_flight = {}
+
+    def submit_next():
+        item = next(queued, None)
+        if item is not None:
+            index, (filename, image_bytes) = item
+            in_flight[pool.submit(process_image, filename, image_bytes, convert, options)] = index
+
+    try:
+        for _ in range(window):
+            submit_next()
+
+        while in_flight:
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in sorted(done, key=in_flight.get):
+                index = in_flight.pop(future)
+                submit_next()
+                yield index, future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def _encode_one(encode, image, output_format):
+    started = time.perf_counter()
+    try:
+        data = encode(image, output_format)
+    except ValueError as exc:
+        return ImageError(str(exc))
+    except Exception:
+        logger.exception("Encoding a %s at %sx%s failed.", output_format, *image.size)
+        return ImageError("The image could not be encoded.")
+    return {"data": data, "encode_ms": _elapsed_ms(started)}
+
+
+def iter_image_set(img, steps, formats, encode):
+    """
+    Resize `img` down through `steps`, a list of ((width, height), box)
+    largest first, each size from the one before it, and run
+    `encode(image, output_format)` for every size and format on the pool.
+    Yield ((width, height), output_format, result) as each encode finishes,
+    where result is {"data", "encode_ms"} or an ImageError. Resizing the
+    next size overlaps the encodes of the previous ones, and the formats of a
+    size are encoded side by side, so `encode` must save a copy (see
+    image_ops.encode_copy()). Closing the generator cancels the encodes not
+    yet started.
+    """
+    pool = _get_pool() if IMAGE_BATCH_WORKERS > 1 else None
+    pending = {}
+    sizes = []
+    current = img
+
+    try:
+        for size, box in steps:
+            current = resized(current, *size, box=box)
+            sizes.append(current)
+            for output_format in formats:
+                if pool is None:
+                    yield size, output_format, _encode_one(encode, current, output_format)
+                else:
+                    future = pool.submit(_encode_one, encode, current, output_format)
+                    pending[future] = (size, output_format)
+
+            for future in [future for future in pending if future.done()]:
+                yield (*pending.pop(future), future.result())
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            yield (*pending.pop(future), future.result())
+    finally:
+        for future in pending:
+            future.cancel()
+        # Encodes already running still read their image.
+        concurrent.futures.wait(pending)
+        for image in sizes:
+            if image is not img:
+                image.close()
@@ -0,0 +1,742 @@
+"""
+Image conversions behind the image blueprint's routes.
+
+Each operation takes a decoded Pillow image and the upload's filename, plus
+its already-validated options, and returns (data, mimetype, download_name,
+report), where report holds extra facts about the output worth returning to
+the client, such as the quality a target-size compression settled on.
+Nothing here touches the request, so the single-image routes and their batch
+variants share one implementation, and operations can run on worker threads.
+
+The pixel work behind the operations is also exposed as transforms, which
+take and return a Pillow image without encoding it, so run_pipeline() can
+chain several of them between a single decode and a single encode.
+
+PNG output goes through utils.png_optimizer, which searches palette, filter
+and zlib strategy combinations for the smallest encoding within a budget.
+Compression's format=auto encodes PNG, WebP and JPEG at once through
+utils.format_race and keeps the smallest. Large upscales are made in tiles
+by utils.tiled_upscale, which streams them into a PNG without ever holding
+the whole output.
+
+Operations that shrink the image can plan its decode (plan_decode()): the
+target size is known from the stored dimensions before any pixel is read,
+so a JPEG is decoded straight to 1/2, 1/4 or 1/8 scale in the DCT domain and
+the rest of the way is covered by reduce() and a short LANCZOS pass.
+"""
+import concurrent.futures
+import io
+import os
+import threading
+import time
+
+from PIL import Image, ImageEnhance, UnidentifiedImageError
+
+from utils.format_race import RaceBuffer, race
+from utils.png_optimizer import optimize_png
+from utils.target_size import fit_to_size, fit_to_ssim
+from utils.tiled_upscale import can_tile, iter_upscaled_png
+
+# Output formats the compressor can emit, keyed by the value accepted in the
+# request. "original" is handled separately: it keeps the uploaded format, as
+# is "auto": it races all of them.
+COMPRESSION_FORMATS = {"jpeg": "JPEG", "webp": "WEBP", "png": "PNG"}
+# The formats "auto" races, preferred in this order on equal sizes (lossless
+# PNG first). JPEG only runs for images without transparency.
+AUTO_FORMATS = ("png", "webp", "jpeg")
+COMPRESSION_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+COMPRESSION_MIMETYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png",
+}
+
+RESIZE_FORMATS = {
+    "PNG": ("PNG", "image/png", ".png"),
+    "JPEG": ("JPEG", "image/jpeg", ".jpg"),
+    "WEBP": ("WEBP", "image/webp", ".webp"),
+}
+
+MIN_UPSCALE = 1
+MAX_UPSCALE = 4
+
+# WebP encoder effort, slowest first, with the encode time each costs per
+# megapixel on one core for a typical photo. to_webp() uses the slowest
+# setting whose estimate fits the latency budget, or the last one. Lossy
+# entries are (method, ms/MP); lossless ones are (method, quality, ms/MP),
+# as Pillow's quality is effort too for lossless WebP.
+WEBP_LOSSY_EFFORTS = ((6, 470), (5, 175), (2, 75), (0, 45))
+WEBP_LOSSLESS_EFFORTS = ((6, 100, 7600), (4, 75, 400), (0, 0, 60))
+# Content moves those costs about 5x either way (noise is slowest, flat
+# graphics fastest), so to_webp() first times a crop this size from the
+# middle of the image at the fastest setting and scales the table by how
+# that compares with its estimate.
+WEBP_PROBE_SIZE = 256
+# Slower settings are encoded on a pool of this many workers while the
+# request waits out its budget; an encode still running then is left to
+# finish there, and the fastest setting is encoded instead.
+WEBP_WORKERS = int(os.getenv("WEBP_WORKERS", str(os.cpu_count() or 1)))
+# Lossy quality by pixel count: large images are mostly viewed scaled down,
+# where their artifacts shrink too.
+WEBP_QUALITIES = ((4_000_000, 85), (16_000_000, 80), (None, 75))
+WEBP_LATENCY_BUDGET_MS = int(os.getenv("WEBP_LATENCY_BUDGET_MS", "2000"))
+WEBP_MODES = ("lossy", "lossless", "near_lossless")
+# Output formats of a responsive image set, keyed by the value accepted in
+# the request, with their Pillow format and extension.
+RESPONSIVE_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+
+# near_lossless rounds colour values to this step before a lossless encode,
+# so no channel moves by more than half of it.
+NEAR_LOSSLESS_STEP = 4
+
+# How much larger than the output a shrink-on-load decode, and the reduce()
+# before LANCZOS, keep the image. At 3 the result is indistinguishable from
+# a full-resolution LANCZOS resize.
+REDUCING_GAP = 3.0
+
+ROTATE_FLIP_TRANSPOSES = {
+    "rotate_left": Image.Transpose.ROTATE_90,
+    "rotate_right": Image.Transpose.ROTATE_270,
+    "flip_h": Image.Transpose.FLIP_LEFT_RIGHT,
+    "flip_v": Image.Transpose.FLIP_TOP_BOTTOM,
+}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ImageDecodeError(ValueError):
+    """Raised when uploaded bytes are not an image Pillow can load."""
+
+
+def open_image(data):
+    """
+    Read an image's header from bytes without decoding its pixels. Raises
+    ImageDecodeError with the same messages as validators.validate_image_file().
+    """
+    try:
+        return Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise ImageDecodeError(
+            "Image resolution exceeds maximum allowed size (40 megapixels). "
+            "Please use a smaller image."
+        )
+    except (UnidentifiedImageError, OSError):
+        raise ImageDecodeError("Invalid or corrupted image file provided")
+
+
+def load_image(img):
+    """Decode an opened image's pixels. Raises ImageDecodeError."""
+    try:
+        img.load()
+    except OSError:
+        raise ImageDecodeError("Invalid or corrupted image file provided")
+    return img
+
+
+def _save(img, **kwargs):
+    buf = io.BytesIO()
+    try:
+        img.save(buf, **kwargs)
+        return buf.getvalue()
+    finally:
+        buf.close()
+
+
+def encode_copy(img, buffer=None, **params):
+    """
+    Save a copy of `img` with `params` into `buffer` (a new BytesIO by
+    default) and return the bytes. Encodes that may run alongside another
+    save of the same image go through this: Pillow's save() keeps its
+    parameters on the image while it runs, so concurrent saves of one image
+    would swap settings, and leave stale ones behind for later saves.
+    """
+    copy = img.copy()
+    try:
+        if buffer is None:
+            return _save(copy, **params)
+        copy.save(buffer, **params)
+        return buffer.getvalue()
+    finally:
+        copy.close()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=WEBP_WORKERS,
+                thread_name_prefix="webp-encode",
+            )
+        return _pool
+
+
+def _close_copy(copy, img):
+    if copy is not None and copy is not img:
+        copy.close()
+
+
+def _base(filename):
+    return os.path.splitext(filename)[0]
+
+
+def convert_alpha_to_rgb(img):
+    if img.mode in ("RGBA", "LA") or (
+        img.mode == "P" and "transparency" in img.info
+    ):
+        rgba_image = img.convert("RGBA")
+        background = Image.new("RGB", rgba_image.size, (255, 255, 255))
+        background.paste(rgba_image, mask=rgba_image.getchannel("A"))
+        return background
+
+    if img.mode != "RGB":
+        return img.convert("RGB")
+
+    return img
+
+
+def _webp_efforts(pixels, mode):
+    """(method, quality, ms/MP) for each WebP effort in `mode`, slowest first."""
+    if mode == "lossy":
+        quality = next(q for limit, q in WEBP_QUALITIES if limit is None or pixels <= limit)
+        return [(method, quality, cost) for method, cost in WEBP_LOSSY_EFFORTS]
+    return list(WEBP_LOSSLESS_EFFORTS)
+
+
+def _webp_options(mode, method, quality):
+    return {"lossless": mode != "lossy", "quality": quality, "method": method}
+
+
+def webp_settings(pixels, mode="lossy", latency_budget_ms=None, cost_factor=1.0):
+    """
+    Pillow save options for a WebP of `pixels` pixels in `mode` (one of
+    WEBP_MODES) expected to encode within `latency_budget_ms` (default
+    WEBP_LATENCY_BUDGET_MS) once the table's costs are scaled by
+    `cost_factor`. The estimate is no promise; to_webp() enforces the budget.
+    """
+    budget_ms = WEBP_LATENCY_BUDGET_MS if latency_budget_ms is None else latency_budget_ms
+    megapixels = pixels / 1_000_000 * cost_factor
+    efforts = _webp_efforts(pixels, mode)
+
+    method, quality, _ = next(
+        (effort for effort in efforts if effort[2] * megapixels <= budget_ms), efforts[-1]
+    )
+    return _webp_options(mode, method, quality)
+
+
+def _webp_cost_factor(img, mode):
+    """
+    How many times the table's estimate an encode of `img` is likely to
+    take, from timing a WEBP_PROBE_SIZE crop of its middle at the fastest
+    setting.
+    """
+    width, height = min(WEBP_PROBE_SIZE, img.width), min(WEBP_PROBE_SIZE, img.height)
+    left, top = (img.width - width) // 2, (img.height - height) // 2
+    method, quality, cost = _webp_efforts(img.width * img.height, mode)[-1]
+    with img.crop((left, top, left + width, top + height)) as sample:
+        start = time.perf_counter()
+        _save(sample, format="WEBP", **_webp_options(mode, method, quality))
+        probe_ms = (time.perf_counter() - start) * 1000
+    return probe_ms / (cost * width * height / 1_000_000)
+
+
+def _near_lossless(img):
+    step = NEAR_LOSSLESS_STEP
+    rounded = [min(255, round(value / step) * step) for value in range(256)]
+    # Alpha is left exact: rounding it shows as fringes on edges.
+    identity = list(range(256))
+    return img.point(rounded * 3 + (identity if img.mode == "RGBA" else []))
+
+
+def _encode_webp(img, mode, latency_budget_ms):
+    """
+    Encode `img` with the effort webp_settings() picks for its size, content
+    and the budget. An encode slower than the fastest setting runs on the
+    pool; if it is still running when the budget is nearly spent, it is
+    abandoned (Pillow cannot stop a WebP encode, so it finishes unused) and
+    the fastest setting is encoded instead. Returns (data, settings).
+    """
+    start = time.perf_counter()
+    budget_ms = WEBP_LATENCY_BUDGET_MS if latency_budget_ms is None else latency_budget_ms
+    pixels = img.width * img.height
+    cost_factor = _webp_cost_factor(img, mode)
+    settings = webp_settings(pixels, mode, budget_ms, cost_factor)
+    method, quality, cost = _webp_efforts(pixels, mode)[-1]
+    fastest = _webp_options(mode, method, quality)
+
+    if settings != fastest:
+        # Leave room to encode the fastest setting within the budget.
+        fastest_ms = cost * pixels / 1_000_000 * cost_factor
+        wait_ms = budget_ms - fastest_ms - (time.perf_counter() - start) * 1000
+        future = _get_pool().submit(encode_copy, img, format="WEBP", **settings)
+        try:
+            return future.result(timeout=max(0, wait_ms) / 1000), settings
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+    return _save(img, format="WEBP", **fastest), fastest
+
+
+def to_webp(img, filename, mode="lossy", latency_budget_ms=None):
+    """
+    Encode as WebP with the most effort that fits the latency budget, as
+    _encode_webp() chooses it. Reports the "mode", "method" and "quality"
+    used and the "encode_ms" the encode took.
+    """
+    converted = img if img.mode in ("RGB", "RGBA") else img.convert("RGBA")
+    encodable = _near_lossless(converted) if mode == "near_lossless" else converted
+    try:
+        start = time.perf_counter()
+        data, settings = _encode_webp(encodable, mode, latency_budget_ms)
+        encode_ms = round((time.perf_counter() - start) * 1000)
+    finally:
+        _close_copy(encodable, converted)
+        _close_copy(converted, img)
+    report = {
+        "mode": mode,
+        "method": settings["method"],
+        "quality": settings["quality"],
+        "encode_ms": encode_ms,
+    }
+    return data, "image/webp", f"{_base(filename)}.webp", report
+
+
+def to_jpeg(img, filename):
+    converted = img if img.mode == "RGB" else img.convert("RGB")
+    try:
+        data = _save(converted, format="JPEG", quality=90, optimize=True)
+    finally:
+        _close_copy(converted, img)
+    return data, "image/jpeg", f"{_base(filename)}.jpg", {}
+
+
+def to_grayscale(img, filename):
+    grayscale_img = img.convert("L")
+    try:
+        data = optimize_png(grayscale_img)
+    finally:
+        _close_copy(grayscale_img, img)
+    return data, "image/png", f"{_base(filename)}_grayscale.png", {}
+
+
+def compression_format(source_format, output_format):
+    """
+    Pillow format for `output_format`: "original" or a key of
+    COMPRESSION_FORMATS. None for "auto", which is only settled by encoding.
+    """
+    if output_format == "auto":
+        return None
+    if output_format == "original":
+        # Keep the uploaded format, falling back to JPEG for anything the
+        # compressor cannot re-encode.
+        return source_format if source_format in COMPRESSION_EXTENSIONS else "JPEG"
+    return COMPRESSION_FORMATS[output_format]
+
+
+def _encodable(img, img_format):
+    # JPEG has no alpha channel, so transparency is flattened onto white
+    # instead of turning black. WebP only accepts RGB/RGBA input.
+    if img_format == "JPEG":
+        return convert_alpha_to_rgb(img)
+    if img_format == "WEBP" and img.mode not in ("RGB", "RGBA"):
+        return img.convert("RGBA")
+    return img
+
+
+def _encode(img, img_format, quality, colors=None):
+    # PNG has no quality setting; it is optimized instead, and only loses
+    # detail when quantized to `colors`.
+    if img_format == "PNG":
+        return optimize_png(img, colors)
+    return _save(img, format=img_format, optimize=True, quality=quality)
+
+
+def _trial_encoder(img_format, colors=None):
+    """_encode() as utils.target_size calls it, with trials side by side."""
+
+    def encode(image, quality):
+        if img_format == "PNG":
+            # Searched by size only, one encode at a time.
+            return optimize_png(image, colors)
+        return encode_copy(image, format=img_format, optimize=True, quality=quality)
+
+    return encode
+
+
+def _has_transparency(img):
+    if img.mode in ("RGBA", "LA", "PA"):
+        return img.getchannel("A").getextrema()[0] < 255
+    return "transparency" in img.info
+
+
+def _race_candidate(img, img_format, quality, min_ssim, colors):
+    """A format_race encode of `img` as `img_format`, as encode_compressed() would."""
+
+    def encode(max_bytes):
+        if img_format == "PNG":
+            # Lossless (unless quantized), so it always meets min_ssim. The
+            # other legs, running alongside, save copies of `img`.
+            data = optimize_png(img, colors, max_bytes=max_bytes)
+            return None if data is None else (data, {})
+
+        output_img = _encodable(img, img_format)
+        try:
+            if min_ssim:
+                # The quality search is not capped: its trial encodes are
+                # of a proxy, whose size says little about the final one.
+                data, report = fit_to_ssim(output_img, _trial_encoder(img_format), min_ssim)
+                return (data, report) if report["target_met"] else None
+            with RaceBuffer(max_bytes) as buffer:
+                data = encode_copy(
+                    output_img, buffer, format=img_format, optimize=True, quality=quality
+                )
+                return data, {}
+        finally:
+            _close_copy(output_img, img)
+
+    return encode
+
+
+def encode_auto(img, quality, min_ssim=None, colors=None):
+    """
+    Encode `img` in each of AUTO_FORMATS concurrently, lossy ones at
+    `quality` (or at the lowest quality scoring `min_ssim`), and keep the
+    smallest. Encodes that write as they go (PNG) stop early once they
+    outgrow the smallest so far; WebP and JPEG finish before they can lose.
+    Returns (data, report), with the chosen COMPRESSION_FORMATS key in
+    report["format"] and each candidate's size, or "lost", in
+    report["candidates"].
+    """
+    formats = [
+        name for name in AUTO_FORMATS if name != "jpeg" or not _has_transparency(img)
+    ]
+    results = race({
+        name: _race_candidate(img, COMPRESSION_FORMATS[name], quality, min_ssim, colors)
+        for name in formats
+    })
+
+    finished = [name for name in formats if results[name] is not None]
+    if not finished:
+        raise ValueError(f"No format reached min_ssim {min_ssim}.")
+    chosen = min(finished, key=lambda name: len(results[name][0]))
+    data, report = results[chosen]
+    candidates = ", ".join(
+        f"{name}={len(results[name][0]) if results[name] is not None else 'lost'}"
+        for name in formats
+    )
+    return data, {"format": chosen, **report, "candidates": candidates}
+
+
+def encode_compressed(
+    img,
+    img_format,
+    quality,
+    target_bytes=None,
+    allow_resize=False,
+    min_ssim=None,
+    colors=None,
+):
+    """
+    Encode as `img_format` (a COMPRESSION_EXTENSIONS key) at `quality`
+    (1-100), or with `target_bytes`, at the highest quality that fits, also
+    scaling the image down when `allow_resize`, or with `min_ssim`, at the
+    lowest quality that still scores `min_ssim`. PNG output may be quantized
+    to at most `colors` colours. An `img_format` of None picks the smallest
+    format; see encode_auto(). Returns (data, report).
+    """
+    if img_format is None:
+        if target_bytes:
+            raise ValueError(
+                "format=auto picks the smallest format; it cannot be combined with target_bytes."
+            )
+        return encode_auto(img, quality, min_ssim, colors)
+    if target_bytes and img_format == "PNG" and not allow_resize:
+        raise ValueError(
+            "PNG has no quality setting to lower; use a lossy format or allow_resize=true "
+            "with target_bytes."
+        )
+    if min_ssim and img_format == "PNG":
+        raise ValueError("PNG is lossless; min_ssim needs jpeg or webp output.")
+
+    output_img = _encodable(img, img_format)
+    try:
+        if min_ssim:
+            return fit_to_ssim(output_img, _trial_encoder(img_format), min_ssim)
+        if not target_bytes:
+            return _encode(output_img, img_format, quality, colors), {}
+        return fit_to_size(
+            output_img,
+            _trial_encoder(img_format, colors),
+            target_bytes,
+            lossy=img_format != "PNG",
+            allow_resize=allow_resize,
+        )
+    finally:
+        _close_copy(output_img, img)
+
+
+def compress(
+    img,
+    filename,
+    quality,
+    output_format,
+    target_bytes=None,
+    allow_resize=False,
+    min_ssim=None,
+    colors=None,
+):
+    """
+    Re-encode at `quality` (1-100) as `output_format`: "original", "auto"
+    (the smallest of AUTO_FORMATS) or a key of COMPRESSION_FORMATS. With
+    `target_bytes` or `min_ssim`, quality is searched instead; see
+    encode_compressed().
+    """
+    img_format = compression_format(img.format, output_format)
+    data, report = encode_compressed(
+        img, img_format, quality, target_bytes, allow_resize, min_ssim, colors
+    )
+    img_format = img_format or COMPRESSION_FORMATS[report["format"]]
+    extension = COMPRESSION_EXTENSIONS[img_format]
+    return data, COMPRESSION_MIMETYPES[img_format], f"{_base(filename)}_compressed{extension}", report
+
+
+def resize_size(size, width, height, box=None):
+    """
+    Output size of resized() for an image of `size`. `box` is accepted so
+    resized()'s options can be passed straight through.
+    """
+    if height is None:
+        height = round(width * size[1] / size[0])
+        if height <= 0:
+            raise ValueError("Calculated height must be a positive pixel value")
+    return width, height
+
+
+def shrink_on_load(img, size):
+    """
+    Before load(): have the decoder scale the image down by 1/2, 1/4 or 1/8
+    while keeping it REDUCING_GAP times larger than `size`. Only JPEG can;
+    for other formats this does nothing. Returns the region of the smaller
+    image that covers the stored one (its last row and column may be
+    partial), for resized()'s `box`, or None.
+    """
+    drafted = img.draft(None, (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+    if drafted is None or drafted[1][2:] == img.size:
+        return None
+    return drafted[1]
+
+
+def resized(img, width, height, box=None):
+    """
+    Transform: LANCZOS resize to `width` x `height`, or to `width` keeping
+    the aspect ratio. Large reductions start with reduce(). `box` is the
+    source region, when shrink_on_load() decoded the image smaller.
+    """
+    return img.resize(
+        resize_size(img.size, width, height),
+        Image.Resampling.LANCZOS,
+        box=box,
+        reducing_gap=REDUCING_GAP,
+    )
+
+
+def _plan_resize(img, width, height, box=None):
+    # The aspect ratio comes from the stored size, which draft() changes.
+    width, height = resize_size(img.size, width, height)
+    return {"width": width, "height": height, "box": shrink_on_load(img, (width, height))}
+
+
+def resize(img, filename, width, height, box=None):
+    """
+    Resize to `width` x `height` pixels, keeping the uploaded format. A
+    `height` of None keeps the aspect ratio.
+    """
+    if img.format not in RESIZE_FORMATS:
+        raise ValueError("Unsupported image format. Please use PNG, JPG, JPEG, or WEBP.")
+
+    output_format, mimetype, default_ext = RESIZE_FORMATS[img.format]
+    original_ext = os.path.splitext(filename)[1].lower()
+    output_ext = original_ext if original_ext in {".png", ".jpg", ".jpeg", ".webp"} else default_ext
+
+    resized_img = resized(img, width, height, box)
+    output_img = convert_alpha_to_rgb(resized_img) if output_format == "JPEG" else resized_img
+    try:
+        data = _save(output_img, format=output_format)
+    finally:
+        _close_copy(output_img, resized_img)
+        _close_copy(resized_img, img)
+
+    base = _base(filename) or "image"
+    return data, mimetype, f"{base}_resized{output_ext}", {}
+
+
+def responsive_sizes(size, widths):
+    """
+    (width, height) for each of `widths`, largest first, keeping the aspect
+    ratio of `size`. Widths beyond the source are served at its own width.
+    """
+    source_width, source_height = size
+    return [
+        (width, max(1, round(source_height * width / source_width)))
+        for width in sorted({min(width, source_width) for width in widths}, reverse=True)
+    ]
+
+
+def encode_responsive(img, output_format, quality):
+    """
+    Encode one size of a responsive set as a RESPONSIVE_FORMATS key. The
+    formats of a size are encoded side by side, each from a copy.
+    """
+    img_format, _ = RESPONSIVE_FORMATS[output_format]
+    encodable = _encodable(img, img_format)
+    try:
+        if img_format == "WEBP":
+            method = webp_settings(img.width * img.height)["method"]
+            return encode_copy(encodable, format="WEBP", quality=quality, method=method)
+        return encode_copy(
+            encodable, format="JPEG", quality=quality, optimize=True, progressive=True
+        )
+    finally:
+        _close_copy(encodable, img)
+
+
+def upscale_size(size, scale):
+    return size[0] * scale, size[1] * scale
+
+
+def upscaled(img, scale):
+    """Transform: upscale by a whole `scale` factor with LANCZOS, then sharpen."""
+    enlarged = img.resize(upscale_size(img.size, scale), resample=Image.Resampling.LANCZOS)
+    try:
+        return ImageEnhance.Sharpness(enlarged).enhance(1.5)
+    finally:
+        _close_copy(enlarged, img)
+
+
+def _upscale_name(filename, scale):
+    return f"{_base(filename)}_upscaled_{scale}x.png"
+
+
+def upscale(img, filename, scale):
+    """Upscale by a whole `scale` factor with LANCZOS, then sharpen."""
+    if can_tile(img, scale):
+        # Pixels are only ever held a few tiles at a time; the PNG is whole.
+        data = b"".join(iter_upscaled_png(img, scale))
+        return data, "image/png", _upscale_name(filename, scale), {}
+
+    sharpened = upscaled(img, scale)
+    try:
+        data = optimize_png(sharpened)
+    finally:
+        _close_copy(sharpened, img)
+    return data, "image/png", _upscale_name(filename, scale), {}
+
+
+def upscale_stream(img, filename, scale):
+    """
+    upscale() for outputs large enough to tile (see can_tile()), as
+    (chunks, mimetype, download_name): the PNG is made tile by tile as
+    `chunks` is iterated, and `img` must stay open until it is exhausted or
+    closed.
+    """
+    return iter_upscaled_png(img, scale), "image/png", _upscale_name(filename, scale)
+
+
+def rotate_flip_size(size, action):
+    return (size[1], size[0]) if action.startswith("rotate") else size
+
+
+def rotate_flip(img, action):
+    """Transform: one of the ROTATE_FLIP_TRANSPOSES actions; lossless."""
+    return img.transpose(ROTATE_FLIP_TRANSPOSES[action])
+
+
+def grayscale_size(size):
+    return size
+
+
+def grayscale(img):
+    """Transform: convert to 8-bit grayscale."""
+    return img.convert("L")
+
+
+# Transforms run_pipeline() can chain, by step name, and the size each one
+# produces, so an oversized result is refused before it is allocated.
+PIPELINE_TRANSFORMS = {
+    "resize": (resized, resize_size),
+    "rotateFlip": (rotate_flip, rotate_flip_size),
+    "grayscale": (grayscale, grayscale_size),
+    "upscale": (upscaled, upscale_size),
+}
+
+
+def run_pipeline(
+    img,
+    filename,
+    steps,
+    quality,
+    output_format,
+    target_bytes=None,
+    allow_resize=False,
+    min_ssim=None,
+    colors=None,
+):
+    """
+    Apply `steps`, a list of (name, options) for PIPELINE_TRANSFORMS, to the
+    decoded image in order and encode the result once, as compress() does,
+    including its target-size and min_ssim modes.
+    Lossy formats therefore lose quality once, however many steps there are.
+    """
+    # Transforms return new images without a format, so "original" is
+    # resolved against the upload before any of them runs.
+    img_format = compression_format(img.format, output_format)
+    current = img
+
+    try:
+        for name, options in steps:
+            transform, output_size = PIPELINE_TRANSFORMS[name]
+            width, height = output_size(current.size, **options)
+            if width * height > Image.MAX_IMAGE_PIXELS:
+                raise ValueError(
+                    f"The {name} step would exceed the maximum image size "
+                    f"({Image.MAX_IMAGE_PIXELS // 1_000_000} megapixels)."
+                )
+
+            result = transform(current, **options)
+            _close_copy(current, img)
+            current = result
+
+        data, report = encode_compressed(
+            current, img_format, quality, target_bytes, allow_resize, min_ssim, colors
+        )
+    finally:
+        _close_copy(current, img)
+
+    img_format = img_format or COMPRESSION_FORMATS[report["format"]]
+    extension = COMPRESSION_EXTENSIONS[img_format]
+    return data, COMPRESSION_MIMETYPES[img_format], f"{_base(filename)}_processed{extension}", report
+
+
+def _plan_pipeline(img, steps, **encode_options):
+    # Only a leading resize is planned: its box is in the stored orientation.
+    if steps and steps[0][0] == "resize":
+        steps = [("resize", _plan_resize(img, **steps[0][1]))] + list(steps[1:])
+    return {"steps": steps, **encode_options}
+
+
+# Operations that can plan their decode, and how.
+_DECODE_PLANS = {
+    resize: _plan_resize,
+    run_pipeline: _plan_pipeline,
+}
+
+
+def plan_decode(convert, img, options):
+    """
+    Between open_image() and load_image(): let `convert` shrink the decode
+    of `img` to what it needs, from the stored size. Returns the options to
+    call `convert` with, which may be pinned to the stored size.
+    """
+    plan = _DECODE_PLANS.get(convert)
+    return plan(img, **options) if plan else options
@@ -0,0 +1,61 @@
+"""
+Streamed JSON bodies for responses that carry binary data as base64.
+
+A data URL of a multi-page ZIP can run to hundreds of megabytes once encoded.
+Building it with b64encode(), an f-string and jsonify() keeps the raw bytes,
+the base64 text, the data URL and the serialized body alive at the same time.
+These helpers encode block by block as the body is written to the socket, so
+only one block of base64 exists at a time.
+"""
+import base64
+import json
+
+# Bytes of input encoded per yielded block. A multiple of 3, so every block
+# but the last encodes without padding and blocks concatenate cleanly.
+BASE64_BLOCK_BYTES = 3 * 16 * 1024
+
+
+def iter_base64(chunks, block_size=BASE64_BLOCK_BYTES):
+    """Base64-encode an iterable of byte chunks, yielding ASCII bytes."""
+    pending = b""
+
+    for chunk in chunks:
+        data = pending + chunk if pending else chunk
+        view = memoryview(data)
+        usable = len(data) - len(data) % 3
+
+        for offset in range(0, usable, block_size):
+            yield base64.b64encode(view[offset:min(offset + block_size, usable)])
+
+        pending = bytes(view[usable:])
+
+    if pending:
+        yield base64.b64encode(pending)
+
+
+def iter_success_data_url(chunks, mimetype, message, data=None):
+    """
+    Yield the JSON body success() would produce for
+    {**data, "image_data": "data:<mimetype>;base64,..."}, encoding `chunks`
+    into the data URL as they arrive.
+    """
+    body = json.dumps(
+        {
+            "success": True,
+            "message": message,
+            "data": {**(data or {}), "image_data": ""},
+        }
+    )
+    # image_data is the last key, so the body ends with its empty value:
+    # '""}}'. Split between the quotes and stream the payload in the middle.
+    # Base64 never needs JSON escaping.
+    head, tail = body[:-3], body[-3:]
+
+    yield f"{head}data:{mimetype};base64,".encode()
+    yield from iter_base64(chunks)
+    yield tail.encode("utf-8")
+
+
+def ndjson_line(record):
+    """Serialize one NDJSON record, newline included."""
+    return (json.dumps(record) + "\n").encode("utf-8")
@@ -0,0 +1,98 @@
+"""
+Encoder profiles for rendered PDF pages.
+
+A profile picks the image format and compression effort for each page, and
+the ZIP method used when pages are archived. PNG output from MuPDF is a
+filter-less deflate at level 6, so "fast" trades size for a lower level and
+"small" pays for Pillow's adaptive row filters at level 9. JPEG and WebP are
+encoded through Pillow straight from the pixmap samples.
+"""
+import io
+import zipfile
+
+from PIL import Image
+
+from utils.png_stream import PngBandEncoder, deflate_band
+
+# "zip" is the method for the profile's ZIP entries. JPEG and WebP data does
+# not shrink any further; sparse PNG pages still lose a surprising share to a
+# second deflate pass, at well under a millisecond per page.
+ENCODER_PROFILES = {
+    "default": {"format": "png", "level": None, "zip": zipfile.ZIP_DEFLATED},
+    "fast": {"format": "png", "level": 1, "zip": zipfile.ZIP_STORED},
+    "small": {"format": "png", "level": 9, "filters": True, "zip": zipfile.ZIP_DEFLATED},
+    "lossy-web": {"format": "webp", "quality": 80, "zip": zipfile.ZIP_STORED},
+    "jpeg": {"format": "jpeg", "quality": 85, "zip": zipfile.ZIP_STORED},
+}
+
+DEFAULT_PROFILE = "default"
+
+FILE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def profile_format(profile):
+    return ENCODER_PROFILES[profile]["format"]
+
+
+def profile_extension(profile):
+    return FILE_EXTENSIONS[profile_format(profile)]
+
+
+def profile_mimetype(profile):
+    return MIMETYPES[profile_format(profile)]
+
+
+def profile_zip_compression(profile):
+    return ENCODER_PROFILES[profile]["zip"]
+
+
+def png_band_level(profile):
+    """zlib level for band-encoded (tiled) PNG pages under `profile`."""
+    level = ENCODER_PROFILES[profile].get("level")
+    return 6 if level is None else level
+
+
+def pixmap_image(pix, mode="RGB"):
+    """Wrap a pixmap's samples in a Pillow image without an extra conversion."""
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples, "raw", mode, pix.stride)
+
+
+def encode_image(image, profile):
+    """Encode a Pillow image under a lossy or filtered-PNG profile."""
+    settings = ENCODER_PROFILES[profile]
+    output = io.BytesIO()
+
+    if settings["format"] == "png":
+        level = 6 if settings["level"] is None else settings["level"]
+        image.save(output, format="PNG", compress_level=level)
+    elif settings["format"] == "webp":
+        image.save(output, format="WEBP", quality=settings["quality"])
+    else:
+        image.save(output, format="JPEG", quality=settings["quality"])
+
+    return output.getvalue()
+
+
+def encode_pixmap(pix, profile=DEFAULT_PROFILE, mono=False):
+    """
+    Encode an RGB or gray pixmap to image bytes under `profile`. With `mono`,
+    a gray pixmap is thresholded to a 1-bit PNG; JPEG and WebP have no 1-bit
+    form and stay gray.
+    """
+    settings = ENCODER_PROFILES[profile]
+    mode = "L" if pix.n == 1 else "RGB"
+
+    if mono and settings["format"] == "png":
+        image = pixmap_image(pix, "L").convert("1", dither=Image.Dither.NONE)
+        return encode_image(image, profile)
+
+    if settings["format"] == "png" and settings["level"] is None:
+        return pix.tobytes(output="png")
+
+    if settings["format"] == "png" and not settings.get("filters"):
+        encoder = PngBandEncoder(pix.width, pix.height, pix.n)
+        segment = deflate_band(pix.samples_mv, pix.stride, settings["level"])
+        return encoder.header() + encoder.segment(*segment) + encoder.finish()
+
+    return encode_image(pixmap_image(pix, mode), profile)
@@ -0,0 +1,86 @@
+"""
+PDFs uploaded to the batch route as one ZIP archive.
+
+A ZIP's headers are written by the client, so nothing in them is trusted: the
+sizes it declares only decide what is rejected up front, and every member is
+read with a hard cap on the bytes that actually come out of the decompressor.
+A small archive that would inflate to gigabytes fails on the first member
+that crosses a limit instead of filling the worker's memory.
+"""
+import io
+import os
+import posixpath
+import zipfile
+
+# Bounds on one archive: member count, the size of one extracted PDF, the
+# size of everything extracted, and the compression ratio a member may
+# declare. PDFs are compressed internally, so honest ones rarely shrink by
+# more than a few times.
+MAX_ARCHIVE_MEMBERS = int(os.getenv("BATCH_MAX_ARCHIVE_MEMBERS", "1000"))
+MAX_ARCHIVE_MEMBER_BYTES = int(os.getenv("BATCH_MAX_ARCHIVE_MEMBER_BYTES", str(25 * 1024 * 1024)))
+MAX_ARCHIVE_TOTAL_BYTES = int(os.getenv("BATCH_MAX_ARCHIVE_TOTAL_BYTES", str(100 * 1024 * 1024)))
+MAX_ARCHIVE_RATIO = 100
+
+
+class ArchiveError(ValueError):
+    """Raised when an uploaded archive is unreadable or exceeds a limit."""
+
+
+def _is_pdf_member(info):
+    name = info.filename
+    base = posixpath.basename(name)
+    # Folders, and the resource forks macOS adds to archives it creates.
+    if info.is_dir() or name.startswith("__MACOSX/") or base.startswith("."):
+        return False
+    return base.lower().endswith(".pdf")
+
+
+def read_pdf_archive(data):
+    """
+    Return [(member_name, pdf_bytes)] for the .pdf members of a ZIP archive,
+    in archive order; other members are skipped. Raises ArchiveError.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        raise ArchiveError("Invalid archive. Upload a ZIP file of PDFs.")
+
+    with archive:
+        members = [info for info in archive.infolist() if _is_pdf_member(info)]
+        if not members:
+            raise ArchiveError("The archive contains no PDF files.")
+        if len(members) > MAX_ARCHIVE_MEMBERS:
+            raise ArchiveError(
+                f"The archive contains too many PDFs ({len(members)}). Maximum allowed: "
+                f"{MAX_ARCHIVE_MEMBERS}."
+            )
+
+        documents = []
+        total = 0
+
+        for info in members:
+            if info.file_size > MAX_ARCHIVE_MEMBER_BYTES or (
+                info.compress_size and info.file_size / info.compress_size > MAX_ARCHIVE_RATIO
+            ):
+                raise ArchiveError(f"{info.filename} is too large once extracted.")
+
+            # Read one byte past the cap: headers can understate the size.
+            limit = min(MAX_ARCHIVE_MEMBER_BYTES, MAX_ARCHIVE_TOTAL_BYTES - total)
+            try:
+                with archive.open(info) as member:
+                    pdf_bytes = member.read(limit + 1)
+            except (RuntimeError, NotImplementedError, zipfile.BadZipFile, OSError):
+                # Encrypted members, unsupported methods and corrupt data.
+                raise ArchiveError(f"{info.filename} could not be extracted.")
+
+            if len(pdf_bytes) > limit:
+                raise ArchiveError(
+                    f"The archive is too large once extracted. Maximum allowed: "
+                    f"{MAX_ARCHIVE_TOTAL_BYTES // (1024 * 1024)} MB in total, "
+                    f"{MAX_ARCHIVE_MEMBER_BYTES // (1024 * 1024)} MB per PDF."
+                )
+
+            total += len(pdf_bytes)
+            documents.append((info.filename, pdf_bytes))
+
+    return documents
@@ -0,0 +1,1362 @@
+"""
+Page rasterization shared by the PDF routes.
+
+Pages can be rendered in the calling thread or spread across a bounded pool
+of worker processes. Each worker opens its own fitz.Document from the PDF
+bytes, so MuPDF never shares a document between threads and a long page
+range scales with the number of cores instead of tying up one gthread worker.
+Rendered pages go through the content-addressed render cache, so repeat
+requests for the same document skip MuPDF entirely. Oversized pages are
+rendered in horizontal bands that stream into the PNG encoder, so memory is
+bounded by the band size rather than the page size. Pages that draw exactly
+the same thing, such as the blank separators of a generated form, are
+rendered once per request and shared by every copy.
+
+PyMuPDF is the default engine; poppler's pdftoppm (see poppler_render) can
+render plain page ranges instead, chosen per deployment or per request.
+
+Batches of documents are rendered one document per pool task, several at a
+time, with each document's failure kept to that document.
+
+Low-fidelity previews (grayscale, no annotations, reduced anti-aliasing) are
+encoded as JPEG or WebP thumbnails for page grids, and a page range can be
+laid out server-side as a single grid image.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+from PIL import Image, ImageChops
+
+from utils.page_encoders import (
+    DEFAULT_PROFILE,
+    encode_image,
+    encode_pixmap,
+    pixmap_image,
+    png_band_level,
+    profile_format,
+)
+from utils.png_stream import PngBandEncoder, deflate_band
+from utils.poppler_render import POPPLER_COLORSPACES, iter_poppler_pages
+from utils.render_cache import page_key, render_cache
+
+logger = logging.getLogger(__name__)
+
+# Worker processes available for parallel rendering. 0 or 1 disables the pool
+# and every page is rendered in the request thread.
+RENDER_WORKERS = int(
+    os.getenv("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+
+# Ranges shorter than this stay in-process in "auto" mode: handing two or
+# three pages to the pool costs more in PDF transfer and parsing than it saves.
+PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "4"))
+
+# Pages whose pixmap would exceed this many pixels are rendered in horizontal
+# bands in "auto" tiling mode. An A4 page at 600 DPI is about 35 Mpx.
+TILE_THRESHOLD_PIXELS = int(os.getenv("PDF_TILE_THRESHOLD_PIXELS", "24000000"))
+
+# Pixels per band in a tiled render. Peak memory of a tiled page is roughly
+# this many pixels per busy worker, whatever the size of the page.
+TILE_PIXELS = int(os.getenv("PDF_TILE_PIXELS", "4000000"))
+
+# Upper bound on pages per pool task. Small tasks keep results flowing back in
+# page order; larger ones amortise the per-task document parse.
+MAX_PAGES_PER_TASK = 16
+
+# Page runs handed to the pool ahead of the one being streamed, per worker.
+# Each holds its rendered pages until the response reaches it.
+TASKS_AHEAD_PER_WORKER = 2
+
+# Batches: documents handed to the pool ahead of the one being streamed, per
+# worker. Each holds its rendered pages until the response reaches it.
+BATCH_DOCUMENTS_PER_WORKER = 2
+
+# Pixel budgets: the largest zoom a budget may pick when the request gives no
+# DPI ceiling of its own, so a small page is not blown up beyond 600 DPI.
+MAX_BUDGET_DPI = 600
+
+# Grid images: pixels between and around cells, and the gray level behind
+# them, dark enough that white pages stand apart from each other.
+GRID_GAP = 8
+GRID_BACKGROUND = 224
+
+# Rasterization engines. "pymupdf" renders in-process (or on the pool);
+# "poppler" runs pdftoppm processes that write pages to disk. Grids, previews
+# and everything pdftoppm cannot do (see poppler_unsupported()) use PyMuPDF.
+RENDER_BACKENDS = ("pymupdf", "poppler")
+DEFAULT_RENDER_BACKEND = os.getenv("PDF_RENDER_BACKEND", "pymupdf")
+
+# MuPDF anti-aliasing levels (0-8). The level is process-global, so a lower
+# level is only applied inside pool workers, where each task sets the level it
+# needs; a render in the web process keeps full anti-aliasing rather than
+# degrading full-quality renders running on other threads.
+DEFAULT_AA_LEVEL = 8
+PREVIEW_AA_LEVEL = 2
+
+# Render profiles: output colorspace ("rgb", "gray", "mono" for 1-bit, or
+# "auto" for gray unless the page has colour), anti-aliasing level and
+# whether annotations are drawn. Requests may override each field.
+RENDER_PROFILES = {
+    "default": {"colorspace": "rgb", "aa": DEFAULT_AA_LEVEL, "annots": True},
+    "document": {"colorspace": "auto", "aa": DEFAULT_AA_LEVEL, "annots": True},
+    "draft": {"colorspace": "gray", "aa": 4, "annots": False},
+    "bw": {"colorspace": "mono", "aa": 0, "annots": True},
+}
+COLORSPACES = ("rgb", "gray", "mono", "auto")
+
+# "auto" colorspace: pages are probed at this width, and count as gray when
+# no pixel's channels differ by more than GRAY_TOLERANCE.
+GRAY_PROBE_WIDTH = 128
+GRAY_TOLERANCE = 8
+
+_FITZ_COLORSPACES = {"rgb": fitz.csRGB, "gray": fitz.csGRAY, "mono": fitz.csGRAY}
+
+# Clip rectangles: "pt" coordinates are PDF points from the top-left corner of
+# the page as displayed; "fraction" coordinates are shares of its width and
+# height, so one clip fits a range of differently sized pages.
+CLIP_UNITS = ("pt", "fraction")
+
+# Page dictionary entries that decide how a page renders, besides its content
+# streams and annotations. The inheritable ones may sit on an ancestor in the
+# page tree.
+_INHERITED_PAGE_KEYS = ("Resources", "MediaBox", "CropBox", "Rotate")
+_PAGE_KEYS = ("Group", "UserUnit")
+_MAX_PAGE_TREE_DEPTH = 64
+_REFERENCE = re.compile(r"(\d+) 0 R")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_worker_aa_level = DEFAULT_AA_LEVEL
+
+
+class PageRenderError(Exception):
+    """Raised when a single page cannot be rasterized."""
+
+    def __init__(self, page_number, reason=None):
+        super().__init__(page_number, reason)
+        self.page_number = page_number
+        self.reason = reason or "The page may be corrupted or unsupported."
+
+
+class ClipOutsidePage(Exception):
+    """Raised when a clip rectangle does not overlap the page."""
+
+
+class DocumentError(Exception):
+    """Raised when one document of a batch cannot be rendered."""
+
+
+def _get_pool():
+    """Return the shared render pool, creating it on first use."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork: the web worker is multi-threaded, and
+            # forking it can copy a lock held by another thread into the child.
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop a pool whose worker died so the next request starts a fresh one."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def use_parallel(mode, page_count):
+    """
+    Decide whether a page range should be rendered on the process pool.
+
+    `mode` is the raw request value: "true", "false" or "auto" (default).
+    """
+    if RENDER_WORKERS <= 1 or page_count <= 1:
+        return False
+
+    mode = (mode or "auto").lower()
+    if mode == "true":
+        return True
+    if mode == "false":
+        return False
+
+    return page_count >= PARALLEL_MIN_PAGES
+
+
+def use_tiles(mode, width, height):
+    """
+    Decide whether a page of width x height pixels is rendered in bands.
+
+    `mode` is the raw request value: "true", "false" or "auto" (default).
+    """
+    mode = (mode or "auto").lower()
+    if mode == "true":
+        return True
+    if mode == "false":
+        return False
+
+    return width * height > TILE_THRESHOLD_PIXELS
+
+
+def _pixel_size(rect, matrix):
+    irect = (rect * matrix).irect
+    return int(irect.width), int(irect.height)
+
+
+def _band_rows(width, height):
+    rows = max(1, TILE_PIXELS // max(1, width))
+    return [(row, min(height, row + rows)) for row in range(0, height, rows)]
+
+
+def _get_pixmap(source, matrix, colorspace="rgb", annots=True, clip=None):
+    """
+    Rasterize a Page or DisplayList. A display list fixed its annotations
+    when it was recorded, so only a Page takes the `annots` switch.
+    """
+    kwargs = {"matrix": matrix, "colorspace": _FITZ_COLORSPACES[colorspace], "alpha": False}
+    if clip is not None:
+        kwargs["clip"] = clip
+    if hasattr(source, "get_displaylist"):
+        kwargs["annots"] = annots
+
+    return source.get_pixmap(**kwargs)
+
+
+def _band_pixmap(source, zoom, row0, row1, colorspace="rgb", annots=True, area=None):
+    """
+    Render pixel rows [row0, row1) of a page, or of `area` within it when
+    given. `source` is a Page or a DisplayList.
+    """
+    rect = source.rect if area is None else fitz.Rect(area)
+    # get_pixmap() rounds the transformed clip to whole pixels, so a clip
+    # edge at row / zoom lands exactly on that row and bands never overlap.
+    clip = fitz.Rect(rect.x0, rect.y0 + row0 / zoom, rect.x1, rect.y0 + row1 / zoom)
+    return _get_pixmap(source, fitz.Matrix(zoom, zoom), colorspace, annots, clip)
+
+
+def _render_band(source, zoom, row0, row1, level=6, colorspace="rgb", annots=True, area=None):
+    """Render pixel rows [row0, row1) of a page and deflate them."""
+    pix = _band_pixmap(source, zoom, row0, row1, colorspace, annots, area)
+    try:
+        return deflate_band(pix.samples_mv, pix.stride, level)
+    finally:
+        pix = None
+
+
+def _band_task(
+    spool_path, page_number, zoom, bands, level=6, colorspace="rgb", annots=True, area=None
+):
+    """
+    Pool entry point: render a run of `bands`, (row0, row1) pairs, of one
+    page of the PDF spooled at `spool_path` (see _Spool).
+    """
+    _set_worker_aa_level(DEFAULT_AA_LEVEL)
+    with _task_document(spool_path) as doc:
+        page = doc.load_page(page_number - 1)
+        return [
+            _render_band(page, zoom, row0, row1, level, colorspace, annots, area)
+            for row0, row1 in bands
+        ]
+
+
+@contextlib.contextmanager
+def _task_document(pdf):
+    """
+    The PDF (bytes, or the path of a spool file) open for one pool task.
+    It is closed when the task ends, so an idle worker holds no document.
+    """
+    if isinstance(pdf, bytes):
+        doc = fitz.open(stream=pdf, filetype="pdf")
+    else:
+        doc = fitz.open(pdf, filetype="pdf")
+    try:
+        yield doc
+    finally:
+        doc.close()
+
+
+class _Spool:
+    """
+    A request's PDF bytes, written to a temporary file the first time its
+    path() is asked for, and removed on close(). Band tasks get the path:
+    task arguments are pickled, so the bytes would be copied to the pool
+    with every task, and a file is written once however many oversized
+    pages the request has.
+    """
+
+    def __init__(self, pdf_bytes):
+        self._pdf_bytes = pdf_bytes
+        self._path = None
+
+    def path(self):
+        if self._path is None:
+            fd, path = tempfile.mkstemp(prefix="pdf-bands-", suffix=".pdf")
+            try:
+                with os.fdopen(fd, "wb") as spool:
+                    spool.write(self._pdf_bytes)
+            except OSError:
+                os.unlink(path)
+                raise
+            self._path = path
+        return self._path
+
+    def close(self):
+        if self._path is not None:
+            os.unlink(self._path)
+            self._path = None
+
+
+def _set_worker_aa_level(level):
+    global _worker_aa_level
+
+    if _worker_aa_level != level:
+        fitz.TOOLS.set_aa_level(level)
+        _worker_aa_level = level
+
+
+def render_page_tiled(
+    source,
+    zoom,
+    spool_path=None,
+    page_number=None,
+    level=6,
+    colorspace="rgb",
+    annots=True,
+    area=None,
+):
+    """
+    Render one page (a Page or DisplayList) to PNG bytes band by band, at
+    zlib `level`. "mono" pages come out as 8-bit gray. `area` limits the
+    render to a clip rectangle already snapped to whole pixels (see
+    snap_rect()).
+
+    Only one band's pixels exist at a time per renderer. Given the
+    `spool_path` of the PDF (see _Spool), the 1-indexed `page_number` and a
+    pool, runs of bands render and compress on separate worker processes,
+    each opening the PDF from the spool file.
+    """
+    mat = fitz.Matrix(zoom, zoom)
+    width, height = _pixel_size(source.rect if area is None else area, mat)
+    encoder = PngBandEncoder(width, height, 3 if colorspace == "rgb" else 1)
+    bands = _band_rows(width, height)
+    parts = [encoder.header()]
+
+    if spool_path is not None and RENDER_WORKERS > 1 and len(bands) > 1:
+        pool = _get_pool()
+        futures = [
+            pool.submit(
+                _band_task,
+                spool_path,
+                page_number,
+                zoom,
+                run,
+                level,
+                colorspace,
+                annots,
+                None if area is None else tuple(area),
+            )
+            for run in _split_into_tasks(bands)
+        ]
+        try:
+            for future in futures:
+                for segment in future.result():
+                    parts.append(encoder.segment(*segment))
+        except BrokenProcessPool:
+            logger.exception("PDF render worker died; recreating the pool.")
+            _discard_pool(pool)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+    else:
+        for row0, row1 in bands:
+            parts.append(
+                encoder.segment(
+                    *_render_band(source, zoom, row0, row1, level, colorspace, annots, area)
+                )
+            )
+
+    parts.append(encoder.finish())
+    return b"".join(parts)
+
+
+def render_page_banded_image(source, zoom, profile, colorspace="rgb", annots=True, area=None):
+    """
+    Render an oversized page band by band into one Pillow image and encode it
+    under a JPEG or WebP profile. Lossy encoders need the whole image, so this
+    bounds MuPDF's pixmaps rather than the total memory of the page.
+    """
+    width, height = _pixel_size(source.rect if area is None else area, fitz.Matrix(zoom, zoom))
+    mode = "RGB" if colorspace == "rgb" else "L"
+    image = Image.new(mode, (width, height))
+
+    for row0, row1 in _band_rows(width, height):
+        pix = _band_pixmap(source, zoom, row0, row1, colorspace, annots, area)
+        image.paste(pixmap_image(pix, mode), (0, row0))
+        pix = None
+
+    return encode_image(image, profile)
+
+
+def render_page_image(
+    source, matrix, profile=DEFAULT_PROFILE, colorspace="rgb", annots=True, clip=None
+):
+    """
+    Render one page (a Page or DisplayList), or only its `clip` rectangle,
+    and encode it under `profile`. Returns (image_bytes, info), where info
+    holds the render and encode times in milliseconds, the colorspace and the
+    size of the raw pixels.
+    """
+    started = time.perf_counter()
+    pix = _get_pixmap(source, matrix, colorspace, annots, clip)
+    rendered = time.perf_counter()
+    try:
+        data = encode_pixmap(pix, profile, mono=colorspace == "mono")
+        info = _image_info(
+            colorspace,
+            int(pix.width),
+            int(pix.height),
+            int(pix.height) * int(pix.stride),
+            _elapsed_ms(started, rendered),
+            _elapsed_ms(rendered, time.perf_counter()),
+        )
+        return data, info
+    finally:
+        pix = None
+
+
+def _image_info(colorspace, width, height, raw_bytes, render_ms, encode_ms):
+    return {
+        "render_ms": render_ms,
+        "encode_ms": encode_ms,
+        "width": width,
+        "height": height,
+        "colorspace": colorspace,
+        "raw_bytes": raw_bytes,
+        # Against the RGB pixmap the page would have needed by default.
+        "raw_bytes_saved": max(0, width * height * 3 - raw_bytes),
+    }
+
+
+def _elapsed_ms(start, end):
+    return round((end - start) * 1000, 2)
+
+
+def render_targets(spec):
+    """
+    Return the (label, size) pairs a spec asks for, where size is ("dpi", n),
+    ("width", pixels) or ("budget", (max_width, max_height, max_pixels,
+    max_dpi)). A plain single-size render has the label None.
+    """
+    if spec.get("budget"):
+        return [(None, ("budget", tuple(spec["budget"])))]
+
+    sizes = spec.get("sizes")
+    if not sizes:
+        return [(None, ("dpi", round(spec["zoom"] * 72)))]
+
+    return [
+        (f"{value}dpi" if kind == "dpi" else f"{value}w", (kind, value))
+        for kind, value in sizes
+    ]
+
+
+def _size_token(size):
+    kind, value = size
+    if kind == "budget":
+        return "fit-" + "-".join("x" if limit is None else str(limit) for limit in value)
+    return value if kind == "dpi" else f"{value}w"
+
+
+def budget_zoom(rect, max_width=None, max_height=None, max_pixels=None, max_dpi=MAX_BUDGET_DPI):
+    """
+    Return the largest zoom at which a page of `rect` fits every given limit:
+    a width and height in pixels, a total pixel count, and a DPI ceiling.
+    """
+    width, height = float(rect.width), float(rect.height)
+    zoom = max_dpi / 72.0
+    if max_width:
+        zoom = min(zoom, max_width / width)
+    if max_height:
+        zoom = min(zoom, max_height / height)
+    if max_pixels:
+        zoom = min(zoom, math.sqrt(max_pixels / (width * height)))
+
+    # Pixel edges round outward, which can overshoot a limit by a row or a
+    # column; shrink until the rounded size fits.
+    for _ in range(4):
+        irect = (rect * fitz.Matrix(zoom, zoom)).irect
+        pixel_width, pixel_height = int(irect.width), int(irect.height)
+        scale = min(
+            1.0,
+            max_width / pixel_width if max_width else 1.0,
+            max_height / pixel_height if max_height else 1.0,
+            math.sqrt(max_pixels / (pixel_width * pixel_height)) if max_pixels else 1.0,
+        )
+        if scale >= 1.0:
+            break
+        zoom *= scale * 0.999
+
+    return zoom
+
+
+def _target_zoom(size, rect):
+    kind, value = size
+    if kind == "width":
+        return value / float(rect.width)
+    if kind == "budget":
+        return budget_zoom(rect, *value)
+
+    return value / 72.0
+
+
+def clip_area(page_rect, clip):
+    """
+    Resolve a spec's clip, (units, x0, y0, x1, y1) with units from
+    CLIP_UNITS, to a Rect in page coordinates, trimmed to the page. Returns
+    None without a clip; raises ClipOutsidePage when nothing is left.
+    """
+    if not clip:
+        return None
+
+    units, x0, y0, x1, y1 = clip
+    if units == "fraction":
+        width, height = float(page_rect.width), float(page_rect.height)
+        x0, x1 = x0 * width, x1 * width
+        y0, y1 = y0 * height, y1 * height
+
+    area = fitz.Rect(
+        page_rect.x0 + x0, page_rect.y0 + y0, page_rect.x0 + x1, page_rect.y0 + y1
+    ) & page_rect
+    if area.is_empty:
+        raise ClipOutsidePage("The clip rectangle lies outside the page.")
+    return area
+
+
+def snap_rect(rect, zoom):
+    """
+    Widen `rect` to whole pixels at `zoom`. Bands are cut at row / zoom from
+    the top edge, which only lands on pixel rows when that edge does.
+    """
+    irect = (rect * fitz.Matrix(zoom, zoom)).irect
+    return fitz.Rect(irect) * fitz.Matrix(1 / zoom, 1 / zoom)
+
+
+def page_is_gray(page, annots=True, clip=None):
+    """
+    Report whether a page, or its `clip` rectangle, renders without colour,
+    from a small probe render.
+    """
+    rect = page.rect if clip is None else clip
+    zoom = GRAY_PROBE_WIDTH / float(rect.width)
+    kwargs = {"matrix": fitz.Matrix(zoom, zoom), "alpha": False, "annots": annots}
+    if clip is not None:
+        kwargs["clip"] = clip
+    pix = page.get_pixmap(**kwargs)
+    red, green, blue = pixmap_image(pix).split()
+
+    def differs(a, b):
+        diff = ImageChops.difference(a, b).point(lambda v: 255 if v > GRAY_TOLERANCE else 0)
+        return diff.getbbox() is not None
+
+    return not (differs(red, green) or differs(green, blue))
+
+
+def _render_page(page, spec, spool=None):
+    """
+    Render every size a spec asks for from one page, as [(label, data, info)];
+    see render_page_image() for info.
+
+    Several sizes share one display list, so the page's content stream is
+    interpreted once however many images come out of it. With a "clip" in the
+    spec (see clip_area()) MuPDF only rasterizes that part of the page, and
+    width and budget sizes apply to the clipped area.
+    """
+    targets = render_targets(spec)
+    profile = spec.get("profile") or DEFAULT_PROFILE
+    annots = spec.get("annots", True)
+    clip = clip_area(page.rect, spec.get("clip"))
+    colorspace = spec.get("colorspace") or "rgb"
+    if colorspace == "auto":
+        colorspace = "gray" if page_is_gray(page, annots, clip) else "rgb"
+
+    source = page.get_displaylist(annots=annots) if len(targets) > 1 else page
+    images = []
+
+    for label, size in targets:
+        zoom = _target_zoom(size, page.rect if clip is None else clip)
+        mat = fitz.Matrix(zoom, zoom)
+        area = None if clip is None else snap_rect(clip, zoom)
+        width, height = _pixel_size(page.rect if area is None else area, mat)
+
+        if use_tiles(spec.get("tiled"), width, height):
+            # Banded pages encode while they render, so only the total time
+            # is known; it is reported as render time.
+            # Banded pages have no 1-bit path; "mono" comes out as gray.
+            band_colorspace = "rgb" if colorspace == "rgb" else "gray"
+            started = time.perf_counter()
+            if profile_format(profile) != "png":
+                data = render_page_banded_image(
+                    source, zoom, profile, band_colorspace, annots, area
+                )
+            elif spool is not None and RENDER_WORKERS > 1:
+                # Pool bands re-load the page in each worker; the display
+                # list only pays off when the bands are rendered here.
+                data = render_page_tiled(
+                    page,
+                    zoom,
+                    spool.path(),
+                    page.number + 1,
+                    png_band_level(profile),
+                    band_colorspace,
+                    annots,
+                    area,
+                )
+            else:
+                data = render_page_tiled(
+                    source,
+                    zoom,
+                    level=png_band_level(profile),
+                    colorspace=band_colorspace,
+                    annots=annots,
+                    area=area,
+                )
+            info = _image_info(
+                band_colorspace,
+                width,
+                height,
+                width * height * (3 if band_colorspace == "rgb" else 1),
+                _elapsed_ms(started, time.perf_counter()),
+                None,
+            )
+        else:
+            data, info = render_page_image(source, mat, profile, colorspace, annots, area)
+
+        info["dpi"] = round(zoom * 72, 2)
+
+        images.append((label, data, info))
+
+    return images
+
+
+def _render_page_numbers(doc, page_numbers, spec, pdf_bytes=None):
+    """
+    Render pages from an open document. `pdf_bytes` lets oversized pages
+    spread their bands over the pool, from one spool file for all of them;
+    pool workers leave it out.
+    """
+    spool = _Spool(pdf_bytes) if pdf_bytes is not None else None
+    try:
+        for page_num in page_numbers:
+            try:
+                page = doc.load_page(page_num - 1)
+                images = _render_page(page, spec, spool)
+            except BrokenProcessPool:
+                raise
+            except ClipOutsidePage as exc:
+                raise PageRenderError(page_num, str(exc)) from exc
+            except Exception as exc:
+                raise PageRenderError(page_num) from exc
+
+            yield page_num, images
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def _render_task(pdf_bytes, page_numbers, spec):
+    """Pool entry point: render a contiguous run of pages from PDF bytes."""
+    _set_worker_aa_level(spec.get("aa", DEFAULT_AA_LEVEL))
+    with _task_document(pdf_bytes) as doc:
+        return list(_render_page_numbers(doc, page_numbers, spec))
+
+
+def _split_into_tasks(page_numbers):
+    """
+    Cut a page (or band) list into contiguous chunks, about two per worker so
+    a slow chunk does not leave the rest of the pool idle.
+    """
+    target_tasks = max(1, RENDER_WORKERS * 2)
+    size = -(-len(page_numbers) // target_tasks)
+    size = max(1, min(MAX_PAGES_PER_TASK, size))
+
+    return [
+        page_numbers[i:i + size]
+        for i in range(0, len(page_numbers), size)
+    ]
+
+
+def _iter_parallel(pdf_bytes, page_numbers, spec, task=None):
+    pool = _get_pool()
+    task = task or _render_task
+    chunks = collections.deque(_split_into_tasks(page_numbers))
+    window = RENDER_WORKERS * TASKS_AHEAD_PER_WORKER
+    in_flight = collections.deque()
+
+    try:
+        # Futures are consumed in submission order, so pages come back in
+        # order while later chunks are still rendering on other cores. A new
+        # chunk is submitted only as one is consumed, so a slow client holds
+        # at most `window` chunks of rendered pages.
+        while chunks or in_flight:
+            while chunks and len(in_flight) < window:
+                in_flight.append(pool.submit(task, pdf_bytes, chunks.popleft(), spec))
+            yield from in_flight.popleft().result()
+    except BrokenProcessPool:
+        logger.exception("PDF render worker died; recreating the pool.")
+        _discard_pool(pool)
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def effective_aa_level(level):
+    """
+    Return the anti-aliasing level a render at `level` actually gets: lower
+    levels need a pool worker (see DEFAULT_AA_LEVEL).
+    """
+    return level if RENDER_WORKERS > 1 else DEFAULT_AA_LEVEL
+
+
+def render_token(spec):
+    """Cache-key component for the render settings beyond size and encoder."""
+    colorspace = spec.get("colorspace") or "rgb"
+    aa = spec.get("aa", DEFAULT_AA_LEVEL)
+    annots = spec.get("annots", True)
+    clip = spec.get("clip")
+
+    token = colorspace
+    if aa != DEFAULT_AA_LEVEL or not annots:
+        token += f"-aa{aa}" + ("" if annots else "-noannots")
+    if clip:
+        units, *coords = clip
+        token += f"-clip-{units}-" + "-".join(f"{value:g}" for value in coords)
+    if spec.get("backend", "pymupdf") != "pymupdf":
+        # Engines differ in anti-aliasing and font hinting.
+        token += f"-{spec['backend']}"
+    return token
+
+
+def _page_entry(doc, xref, key):
+    kind, value = doc.xref_get_key(xref, key)
+    return None if kind == "null" else value
+
+
+def _content_streams(doc, xref):
+    """
+    The xrefs of a page's content streams. /Contents is a stream, an array of
+    streams, or a reference to such an array. Raises ValueError for anything
+    else, so the page is not deduplicated on a partial fingerprint.
+    """
+    streams = []
+    for ref in _REFERENCE.findall(_page_entry(doc, xref, "Contents") or ""):
+        ref = int(ref)
+        if doc.xref_is_stream(ref):
+            streams.append(ref)
+            continue
+        array = doc.xref_object(ref, compressed=True).strip()
+        if not array.startswith("["):
+            raise ValueError(f"Contents object {ref} is neither a stream nor an array")
+        for item in _REFERENCE.findall(array):
+            if not doc.xref_is_stream(int(item)):
+                raise ValueError(f"Contents object {item} is not a stream")
+            streams.append(int(item))
+    return streams
+
+
+def page_fingerprint(doc, page_number, annots=True, stream_digests=None):
+    """
+    Return a digest of everything that decides how a 1-indexed page renders:
+    the bytes of its content streams, its resources and page boxes (inherited
+    ones included) and, when annotations are drawn, its annotations. Pages
+    with equal fingerprints render to identical pixels.
+
+    A resource dictionary is compared by its own text, so per-page copies of
+    one dictionary match, but the objects it points to are compared by
+    reference. Pages without content streams draw nothing, whatever their
+    resources. `stream_digests` caches content stream hashes by xref across
+    calls.
+    """
+    digests = stream_digests if stream_digests is not None else {}
+    xref = doc.page_xref(page_number - 1)
+    parts = []
+
+    for stream_xref in _content_streams(doc, xref):
+        if stream_xref not in digests:
+            digest = hashlib.sha256(doc.xref_stream_raw(stream_xref) or b"")
+            digest.update(str(_page_entry(doc, stream_xref, "Filter")).encode("utf-8"))
+            digests[stream_xref] = digest.hexdigest()
+        parts.append(digests[stream_xref])
+    has_content = bool(parts)
+
+    for key in _INHERITED_PAGE_KEYS:
+        node = xref
+        for _ in range(_MAX_PAGE_TREE_DEPTH):
+            value = _page_entry(doc, node, key)
+            parent = _page_entry(doc, node, "Parent")
+            if value is not None or parent is None:
+                break
+            node = int(parent.split()[0])
+        if key == "Resources":
+            if not has_content:
+                continue
+            if value is not None and _REFERENCE.fullmatch(value):
+                value = doc.xref_object(int(value.split()[0]), compressed=True)
+        parts.append(f"{key}={value}")
+
+    keys = _PAGE_KEYS + ("Annots",) if annots else _PAGE_KEYS
+    parts.extend(f"{key}={_page_entry(doc, xref, key)}" for key in keys)
+
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def duplicate_pages(doc, page_numbers, annots=True):
+    """
+    Map each page that renders identically to an earlier page in
+    `page_numbers` onto that earlier page (see page_fingerprint()). Pages that
+    cannot be fingerprinted are left out, and so rendered on their own.
+    """
+    originals = {}
+    first_seen = {}
+    stream_digests = {}
+
+    for page_num in page_numbers:
+        try:
+            fingerprint = page_fingerprint(doc, page_num, annots, stream_digests)
+        except Exception:
+            logger.debug("Could not fingerprint page %s; rendering it.", page_num, exc_info=True)
+            continue
+
+        if fingerprint in first_seen:
+            originals[page_num] = first_seen[fingerprint]
+        else:
+            first_seen[fingerprint] = page_num
+
+    return originals
+
+
+def _duplicate_info(info, original):
+    if info is None:
+        return None
+    return {**info, "render_ms": 0.0, "encode_ms": 0.0, "duplicate_of": original}
+
+
+def poppler_unsupported(spec):
+    """
+    Name the first setting in `spec` the poppler backend cannot render, or
+    return None when it can render all of them.
+    """
+    if spec.get("budget"):
+        return "pixel budgets"
+    if spec.get("clip"):
+        return "clip"
+    if (spec.get("colorspace") or "rgb") not in POPPLER_COLORSPACES:
+        return f"colorspace={spec['colorspace']}"
+    if spec.get("aa", DEFAULT_AA_LEVEL) != DEFAULT_AA_LEVEL:
+        return "reduced anti-aliasing"
+    return None
+
+
+def _iter_poppler(pdf_bytes, page_numbers, spec, workers):
+    """Render pages through pdftoppm, naming the page a failure stopped at."""
+    pages = iter_poppler_pages(
+        pdf_bytes,
+        page_numbers,
+        render_targets(spec),
+        spec.get("profile") or DEFAULT_PROFILE,
+        spec.get("colorspace") or "rgb",
+        spec.get("annots", True),
+        workers,
+    )
+
+    try:
+        for page_num in page_numbers:
+            try:
+                item = next(pages)
+            except Exception as exc:
+                logger.exception("pdftoppm failed at page %s.", page_num)
+                raise PageRenderError(page_num) from exc
+            yield item
+    finally:
+        pages.close()
+
+
+def _render_misses(doc, pdf_bytes, page_numbers, spec, parallel):
+    if spec.get("backend") == "poppler":
+        # pdftoppm brings its own processes; the pool is not involved.
+        workers = RENDER_WORKERS if use_parallel(parallel, len(page_numbers)) else 1
+        return _iter_poppler(pdf_bytes, page_numbers, spec, workers)
+
+    # A reduced anti-aliasing level is only safe in a worker process.
+    needs_worker = spec.get("aa", DEFAULT_AA_LEVEL) != DEFAULT_AA_LEVEL and RENDER_WORKERS > 1
+
+    if page_numbers and (needs_worker or use_parallel(parallel, len(page_numbers))):
+        return _iter_parallel(pdf_bytes, page_numbers, spec)
+
+    return _render_page_numbers(doc, page_numbers, spec, pdf_bytes)
+
+
+def _render_unique(doc, pdf_bytes, page_numbers, spec, parallel, stats):
+    """
+    Render pages as _render_misses() does, but render each set of identical
+    pages (see duplicate_pages()) once and hand its images to every copy.
+    The number of copies is written to stats["dedup_hits"].
+    """
+    originals = (
+        duplicate_pages(doc, page_numbers, spec.get("annots", True))
+        if len(page_numbers) > 1
+        else {}
+    )
+    stats["dedup_hits"] = len(originals)
+
+    rendered = _render_misses(
+        doc,
+        pdf_bytes,
+        [n for n in page_numbers if n not in originals],
+        spec,
+        parallel,
+    )
+    return _share_duplicates(rendered, page_numbers, originals)
+
+
+def _share_duplicates(rendered, page_numbers, originals):
+    # Images are only held while a later copy still needs them.
+    pending = collections.Counter(originals.values())
+    kept = {}
+
+    try:
+        for page_num in page_numbers:
+            original = originals.get(page_num)
+            if original is None:
+                _, images = next(rendered)
+                if pending[page_num]:
+                    kept[page_num] = images
+            else:
+                images = [
+                    (label, data, _duplicate_info(info, original))
+                    for label, data, info in kept[original]
+                ]
+                pending[original] -= 1
+                if not pending[original]:
+                    del kept[original]
+
+            yield page_num, images
+    finally:
+        rendered.close()
+
+
+def iter_rendered_pages(
+    doc,
+    pdf_bytes,
+    page_numbers,
+    spec,
+    parallel=None,
+    pdf_key=None,
+    stats=None,
+):
+    """
+    Yield (page_number, images) for each 1-indexed page, in page order, where
+    images is a list of (label, data, info) as described by render_targets()
+    and render_page_image(). Pages served from the cache have info None.
+
+    `spec` describes the render: "zoom" (DPI / 72) or "sizes" (a list of
+    ("dpi", n) / ("width", pixels) pairs), "tiled", the request's mode string
+    for use_tiles(), "profile", a name from page_encoders.ENCODER_PROFILES,
+    the render profile fields "colorspace", "aa" and "annots" (see
+    RENDER_PROFILES), an optional "clip" (see clip_area()) and the "backend"
+    from RENDER_BACKENDS. Pass "aa" through effective_aa_level() first.
+
+    With a `pdf_key` (see render_cache.document_key) pages already in the
+    render cache are served from it and MuPDF only sees the misses; `doc` may
+    then be None and is only opened if something actually needs rendering.
+    `parallel` is the request's mode string for use_parallel(), applied to the
+    pages that miss the cache. Among those, duplicates of an earlier page are
+    not rendered again; their info carries "duplicate_of". Cache hit and miss
+    counts and the number of such duplicates ("dedup_hits") are written to
+    `stats` before the first page is yielded.
+
+    Raises PageRenderError naming the first page that failed.
+    """
+    page_numbers = list(page_numbers)
+    stats = stats if stats is not None else {}
+
+    if pdf_key is None or not render_cache.enabled:
+        stats.update(cache_hits=0, cache_misses=len(page_numbers))
+        if doc is None:
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            try:
+                yield from _render_unique(doc, pdf_bytes, page_numbers, spec, parallel, stats)
+            finally:
+                doc.close()
+        else:
+            yield from _render_unique(doc, pdf_bytes, page_numbers, spec, parallel, stats)
+        return
+
+    targets = render_targets(spec)
+    profile = spec.get("profile") or DEFAULT_PROFILE
+    token = render_token(spec)
+
+    def keys_for(page_num):
+        return [
+            page_key(pdf_key, page_num - 1, _size_token(size), token, profile)
+            for _, size in targets
+        ]
+
+    misses = [
+        n for n in page_numbers
+        if not all(render_cache.contains(key) for key in keys_for(n))
+    ]
+    stats.update(cache_hits=len(page_numbers) - len(misses), cache_misses=len(misses))
+
+    own_doc = None
+    if misses and doc is None:
+        doc = own_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+    try:
+        rendered = _render_unique(doc, pdf_bytes, misses, spec, parallel, stats)
+        miss_set = set(misses)
+
+        for page_num in page_numbers:
+            keys = keys_for(page_num)
+
+            if page_num in miss_set:
+                _, images = next(rendered)
+            else:
+                cached = [render_cache.get(key) for key in keys]
+                if all(data is not None for data in cached):
+                    yield page_num, [
+                        (label, data, None) for (label, _), data in zip(targets, cached)
+                    ]
+                    continue
+
+                # Evicted since the lookup above: render it on the spot.
+                if doc is None:
+                    doc = own_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+                _, images = next(
+                    _render_page_numbers(doc, [page_num], spec, pdf_bytes)
+                )
+
+            for key, (_, data, _) in zip(keys, images):
+                render_cache.put(key, data)
+            yield page_num, images
+    finally:
+        if own_doc is not None:
+            own_doc.close()
+
+
+def render_document(pdf_bytes, first_page, last_page, spec, max_pages):
+    """
+    Render pages first_page..last_page of one PDF of a batch, to its last
+    page when `last_page` is None, as iter_rendered_pages() would without the
+    cache. Returns {"page_count", "pages": [(page_number, images)],
+    "dedup_hits"}. Raises DocumentError with a message for the client.
+    """
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except (RuntimeError, ValueError) as exc:
+        # MuPDF's FileDataError (empty or damaged files) is a RuntimeError.
+        raise DocumentError("The PDF file appears to be corrupted or unreadable.") from exc
+
+    try:
+        if doc.needs_pass:
+            raise DocumentError("This PDF is password-protected and cannot be converted.")
+
+        page_count = doc.page_count
+        if page_count == 0:
+            raise DocumentError("Empty PDF")
+        if first_page > page_count:
+            raise DocumentError(f"start_page exceeds total pages ({page_count}).")
+
+        end = page_count if last_page is None else min(last_page, page_count)
+        page_numbers = list(range(first_page, end + 1))
+        if len(page_numbers) > max_pages:
+            raise DocumentError(
+                f"Too many pages requested ({len(page_numbers)}). A batch renders at most "
+                f"{max_pages} pages per document."
+            )
+
+        originals = (
+            duplicate_pages(doc, page_numbers, spec.get("annots", True))
+            if len(page_numbers) > 1
+            else {}
+        )
+        unique = [n for n in page_numbers if n not in originals]
+        rendered = (
+            _iter_poppler(pdf_bytes, unique, spec, 1)
+            if spec.get("backend") == "poppler"
+            else _render_page_numbers(doc, unique, spec)
+        )
+        try:
+            pages = list(_share_duplicates(rendered, page_numbers, originals))
+        except PageRenderError as exc:
+            raise DocumentError(f"Failed to render page {exc.page_number}. {exc.reason}")
+
+        return {"page_count": page_count, "pages": pages, "dedup_hits": len(originals)}
+    finally:
+        doc.close()
+
+
+def _document_task(pdf_bytes, first_page, last_page, spec, max_pages):
+    """Pool entry point: render one document of a batch."""
+    _set_worker_aa_level(spec.get("aa", DEFAULT_AA_LEVEL))
+    return render_document(pdf_bytes, first_page, last_page, spec, max_pages)
+
+
+def _document_result(future):
+    try:
+        return future.result()
+    except DocumentError as exc:
+        return exc
+
+
+def iter_rendered_documents(documents, first_page, last_page, spec, max_pages):
+    """
+    Yield (index, result) for each PDF in `documents` (a list of bytes), in
+    order, where result is what render_document() returns or the
+    DocumentError it raised. Pass "aa" through effective_aa_level() first.
+
+    With a pool, documents render concurrently, at most
+    BATCH_DOCUMENTS_PER_WORKER per worker ahead of the one being yielded.
+    Closing the generator cancels the rest.
+    """
+    if RENDER_WORKERS <= 1:
+        for index, pdf_bytes in enumerate(documents):
+            try:
+                yield index, render_document(pdf_bytes, first_page, last_page, spec, max_pages)
+            except DocumentError as exc:
+                yield index, exc
+        return
+
+    window = RENDER_WORKERS * BATCH_DOCUMENTS_PER_WORKER
+    args = (first_page, last_page, spec, max_pages)
+    in_flight = collections.deque()
+    next_index = 0
+
+    try:
+        while in_flight or next_index < len(documents):
+            pool = _get_pool()
+            while next_index < len(documents) and len(in_flight) < window:
+                in_flight.append(
+                    (next_index, pool.submit(_document_task, documents[next_index], *args))
+                )
+                next_index += 1
+
+            index, future = in_flight.popleft()
+            try:
+                yield index, _document_result(future)
+                continue
+            except BrokenProcessPool:
+                logger.exception("PDF render worker died; recreating the pool.")
+                _discard_pool(pool)
+
+            # Any document in flight may have killed the worker. Each one is
+            # retried alone, so only a document that does it again fails.
+            retry = [index] + [i for i, _ in in_flight]
+            in_flight.clear()
+            for index in retry:
+                pool = _get_pool()
+                try:
+                    result = _document_result(pool.submit(_document_task, documents[index], *args))
+                except BrokenProcessPool:
+                    logger.exception("Batch document %s crashed a render worker.", index)
+                    _discard_pool(pool)
+                    result = DocumentError("The document crashed the renderer.")
+                yield index, result
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+def render_preview(page, options):
+    """
+    Render a low-fidelity thumbnail of one page, as (image_bytes, width, height).
+
+    `options` holds the thumbnail "width" in pixels, the "format" ("jpeg" or
+    "webp") and the encoder "quality". The page is rasterized straight to
+    grayscale without annotations, which is several times cheaper than a full
+    colour render and plenty for a page grid.
+    """
+    zoom = options["width"] / float(page.rect.width)
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom),
+        colorspace=fitz.csGRAY,
+        alpha=False,
+        annots=False,
+    )
+    image = pixmap_image(pix, "L")
+
+    output = io.BytesIO()
+    if options["format"] == "webp":
+        # method=0 is the fastest WebP encoder setting.
+        image.save(output, format="WEBP", quality=options["quality"], method=0)
+    else:
+        image.save(output, format="JPEG", quality=options["quality"])
+
+    return output.getvalue(), pix.width, pix.height
+
+
+def _preview_page_numbers(doc, page_numbers, options):
+    for page_num in page_numbers:
+        try:
+            preview = render_preview(doc.load_page(page_num - 1), options)
+        except Exception as exc:
+            raise PageRenderError(page_num) from exc
+
+        yield (page_num, *preview)
+
+
+def _preview_task(pdf_bytes, page_numbers, options):
+    """Pool entry point: render previews of a run of pages at reduced anti-aliasing."""
+    _set_worker_aa_level(PREVIEW_AA_LEVEL)
+    with _task_document(pdf_bytes) as doc:
+        return list(_preview_page_numbers(doc, page_numbers, options))
+
+
+def iter_previews(doc, pdf_bytes, page_numbers, options, parallel=None):
+    """
+    Yield (page_number, image_bytes, width, height) for each 1-indexed page,
+    in page order. See render_preview() for `options`; `parallel` is the
+    request's mode string for use_parallel().
+
+    Previews bypass the render cache: they cost less to render than the
+    full-size pages the cache is there to protect.
+
+    Raises PageRenderError naming the first page that failed.
+    """
+    page_numbers = list(page_numbers)
+
+    if use_parallel(parallel, len(page_numbers)):
+        yield from _iter_parallel(pdf_bytes, page_numbers, options, _preview_task)
+    else:
+        yield from _preview_page_numbers(doc, page_numbers, options)
+
+
+def grid_layout(doc, page_numbers, columns, cell_width, cell_height=None, aa=DEFAULT_AA_LEVEL, annots=True):
+    """
+    Describe a grid with a cell for each of the 1-indexed `page_numbers`, in
+    `columns` columns. Without a `cell_height`, cells take the aspect ratio
+    of the first of those pages. Cells are always RGB; `aa` (see
+    effective_aa_level()) and `annots` come from the render profile.
+    """
+    page_count = len(page_numbers)
+    if cell_height is None:
+        rect = doc.load_page(page_numbers[0] - 1).rect
+        cell_height = max(1, round(cell_width * float(rect.height) / float(rect.width)))
+
+    columns = min(columns, page_count)
+    rows = -(-page_count // columns)
+
+    return {
+        "columns": columns,
+        "cell_width": cell_width,
+        "cell_height": cell_height,
+        "width": GRID_GAP + columns * (cell_width + GRID_GAP),
+        "height": GRID_GAP + rows * (cell_height + GRID_GAP),
+        "aa": aa,
+        "annots": annots,
+    }
+
+
+def _render_grid_cell(page, layout):
+    """Render a page scaled to fit inside one grid cell."""
+    rect = page.rect
+    zoom = min(
+        layout["cell_width"] / float(rect.width),
+        layout["cell_height"] / float(rect.height),
+    )
+    return _get_pixmap(page, fitz.Matrix(zoom, zoom), annots=layout.get("annots", True))
+
+
+def _grid_cell_page_numbers(doc, page_numbers, layout):
+    for page_num in page_numbers:
+        try:
+            pix = _render_grid_cell(doc.load_page(page_num - 1), layout)
+        except Exception as exc:
+            raise PageRenderError(page_num) from exc
+
+        yield page_num, pix
+
+
+def _grid_cell_task(pdf_bytes, page_numbers, layout):
+    """Pool entry point: render grid cells, returned as raw RGB samples."""
+    _set_worker_aa_level(layout.get("aa", DEFAULT_AA_LEVEL))
+    with _task_document(pdf_bytes) as doc:
+        return [
+            (page_num, pix.width, pix.height, pix.samples)
+            for page_num, pix in _grid_cell_page_numbers(doc, page_numbers, layout)
+        ]
+
+
+def render_grid_image(doc, pdf_bytes, page_numbers, layout, profile=DEFAULT_PROFILE, parallel=None):
+    """
+    Lay out pages as one grid image, left to right and top to bottom, and
+    encode it under `profile`. Returns (image_bytes, info) like
+    render_page_image().
+
+    Every cell is copied straight into one shared target pixmap, centred in
+    its cell, so no per-page image is ever encoded. On the pool, cells travel
+    back as raw samples. Raises PageRenderError naming the first failed page.
+    """
+    page_numbers = list(page_numbers)
+    started = time.perf_counter()
+
+    target = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, layout["width"], layout["height"]), False)
+    target.clear_with(GRID_BACKGROUND)
+
+    needs_worker = layout.get("aa", DEFAULT_AA_LEVEL) != DEFAULT_AA_LEVEL and RENDER_WORKERS > 1
+
+    if needs_worker or use_parallel(parallel, len(page_numbers)):
+        cells = (
+            (page_num, fitz.Pixmap(fitz.csRGB, width, height, samples, False))
+            for page_num, width, height, samples in _iter_parallel(
+                pdf_bytes, page_numbers, layout, _grid_cell_task
+            )
+        )
+    else:
+        cells = _grid_cell_page_numbers(doc, page_numbers, layout)
+
+    for index, (_, pix) in enumerate(cells):
+        row, column = divmod(index, layout["columns"])
+        x = GRID_GAP + column * (layout["cell_width"] + GRID_GAP)
+        y = GRID_GAP + row * (layout["cell_height"] + GRID_GAP)
+
+        pix.set_origin(
+            x + (layout["cell_width"] - pix.width) // 2,
+            y + (layout["cell_height"] - pix.height) // 2,
+        )
+        target.copy(pix, pix.irect)
+
+    rendered = time.perf_counter()
+    data = encode_pixmap(target, profile)
+    info = _image_info(
+        "rgb",
+        layout["width"],
+        layout["height"],
+        int(target.height) * int(target.stride),
+        _elapsed_ms(started, rendered),
+        _elapsed_ms(rendered, time.perf_counter()),
+    )
+
+    return data, info
@@ -0,0 +1,324 @@
+"""
+Smallest-PNG search for the routes that emit PNG.
+
+Pillow always picks row filters adaptively and deflates with one strategy,
+which is rarely the smallest encoding: indexed images and flat graphics
+usually compress better unfiltered, and some images favour run-length
+matching. optimize_png() encodes a handful of variants in parallel and keeps
+the smallest:
+
+- the image itself, after lossless reductions (an opaque alpha channel is
+  dropped, gray RGB is stored as L);
+- an equivalent palette image when it has 256 colours or fewer, at 1, 2, 4
+  or 8 bits per pixel;
+- with `colors`, a quantized palette image (lossy, dithered);
+
+each through Pillow's adaptive filters and through unfiltered rows (via
+utils.png_stream), under a few zlib strategies.
+
+The search runs to a deadline. Pillow's optimize=True encode of the image,
+as the routes made it before the search, is always made and is the answer
+if nothing smaller finishes in time, so the output is never larger than
+it was; other trials are abandoned once the deadline passes, at their next
+write, so the search costs about the budget or that one encode, whichever
+is longer. Given a
+size to beat (`max_bytes`, as in the format race of utils.format_race),
+trials are also abandoned as soon as they outgrow it.
+"""
+import concurrent.futures
+import functools
+import io
+import os
+import threading
+import time
+import zlib
+
+from PIL import Image, ImageChops, features
+
+from utils.png_stream import PngBandEncoder
+
+PNG_OPTIMIZE_WORKERS = int(os.getenv("PNG_OPTIMIZE_WORKERS", str(os.cpu_count() or 1)))
+PNG_OPTIMIZE_BUDGET_MS = int(os.getenv("PNG_OPTIMIZE_BUDGET_MS", "2000"))
+
+# (row filters, zlib strategy) per trial, in the order they are queued.
+# Run-length matching after Pillow's adaptive filters is fast and wins for
+# most photos; plain deflate of unfiltered rows wins for palettes and flat
+# graphics; Pillow's own choice (-1, Z_FILTERED) is the slowest and wins
+# the rest. Other pairings were never the smallest on the images measured.
+_PILLOW_STRATEGY = -1
+TRIALS = ((True, zlib.Z_RLE), (False, zlib.Z_DEFAULT_STRATEGY), (True, _PILLOW_STRATEGY))
+
+# Raw bytes deflated between deadline checks in unfiltered trials.
+_ROWS_CHUNK_BYTES = 1 << 20
+
+# Channels per mode the unfiltered encoder writes; other modes only go
+# through Pillow.
+_UNFILTERED_CHANNELS = {"L": 1, "LA": 2, "RGB": 3, "RGBA": 4, "P": 1}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class _Expired(Exception):
+    """Raised inside a trial encode that ran past the deadline or size cap."""
+
+
+def _no_limit():
+    return None
+
+
+def _over(size, max_bytes):
+    limit = max_bytes()
+    return limit is not None and size > limit
+
+
+class _DeadlineBuffer(io.BytesIO):
+    """
+    A BytesIO whose writes fail after `deadline`, or once it would outgrow
+    `max_bytes()`, aborting Pillow's save.
+    """
+
+    def __init__(self, deadline, max_bytes=_no_limit):
+        super().__init__()
+        self._deadline = deadline
+        self._max_bytes = max_bytes
+
+    def write(self, data):
+        if time.monotonic() > self._deadline or _over(self.tell() + len(data), self._max_bytes):
+            raise _Expired()
+        return super().write(data)
+
+
+def _get_pool():
+    # Separate from the image batch pool, whose workers wait on these trials.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=PNG_OPTIMIZE_WORKERS,
+                thread_name_prefix="png-optimize",
+            )
+        return _pool
+
+
+def _reduced(img):
+    """`img` without an opaque alpha channel, and with gray RGB stored as L."""
+    if img.mode in ("RGBA", "LA") and img.getchannel("A").getextrema() == (255, 255):
+        img = img.convert("RGB" if img.mode == "RGBA" else "L")
+    if img.mode in ("RGB", "RGBA"):
+        red, green, blue = img.split()[:3]
+        if ImageChops.difference(red, green).getbbox() is None and (
+            ImageChops.difference(green, blue).getbbox() is None
+        ):
+            return red if img.mode == "RGB" else Image.merge("LA", (red, img.getchannel("A")))
+    return img
+
+
+def _palettized(img):
+    """
+    An indexed image with exactly `img`'s pixels, or None when `img` has more
+    than 256 colours (or so few bits per pixel already that a palette
+    cannot help).
+    """
+    if img.mode == "LA":
+        img = img.convert("RGBA")
+    if img.mode not in ("L", "RGB", "RGBA"):
+        return None
+    colors = img.getcolors(256)
+    if colors is None or (img.mode == "L" and len(colors) > 16):
+        return None
+
+    if img.mode == "RGBA":
+        # Pillow only quantizes RGBA approximately, but median cut is exact
+        # on three channels with few colours. Drop the one channel whose
+        # loss keeps every colour distinct, and restore it in the palette.
+        bands = img.split()
+        for dropped in range(4):
+            key = Image.merge("RGB", [band for i, band in enumerate(bands) if i != dropped])
+            if len(key.getcolors(256) or ()) == len(colors):
+                break
+        else:
+            return None
+        full_colors = {
+            tuple(v for i, v in enumerate(color) if i != dropped): color for _, color in colors
+        }
+        indexed = key.quantize(len(colors), Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        key_palette = indexed.getpalette("RGB")
+        palette = [
+            value
+            for i in range(0, len(key_palette), 3)
+            for value in full_colors[tuple(key_palette[i:i + 3])]
+        ]
+        indexed.putpalette(palette, "RGBA")
+    else:
+        indexed = img.quantize(len(colors), Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+
+    if indexed.convert(img.mode).tobytes() != img.tobytes():
+        return None
+    return indexed
+
+
+def _quantized(img, colors):
+    """`img` dithered down to a palette of at most `colors` colours."""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    if features.check("libimagequant"):
+        method = Image.Quantize.LIBIMAGEQUANT
+    elif img.mode == "RGBA":
+        method = Image.Quantize.FASTOCTREE
+    else:
+        method = Image.Quantize.MEDIANCUT
+    return img.quantize(colors, method, dither=Image.Dither.FLOYDSTEINBERG)
+
+
+def _encode_filtered(img, deadline, strategy, max_bytes=_no_limit):
+    """Pillow's adaptive row filters, deflated at level 9 with `strategy`."""
+    # Imported here: utils.image_ops imports this module.
+    from utils.image_ops import encode_copy
+
+    with _DeadlineBuffer(deadline, max_bytes) as buffer:
+        return encode_copy(img, buffer, format="PNG", optimize=True, compress_type=strategy)
+
+
+def _palette_chunks(img):
+    """(rgb, alpha, bit_depth) for an indexed image's PLTE and tRNS chunks."""
+    palette_mode = img.palette.mode
+    entries = img.getpalette(palette_mode)
+    if palette_mode == "RGBA":
+        rgb = bytes(v for i, v in enumerate(entries) if i % 4 != 3)
+        alpha = bytes(entries[3::4]).rstrip(b"\xff")
+    else:
+        rgb, alpha = bytes(entries), b""
+
+    count = len(rgb) // 3
+    bit_depth = 1 if count <= 2 else 2 if count <= 4 else 4 if count <= 16 else 8
+    return rgb, alpha, bit_depth
+
+
+def _encode_unfiltered(img, deadline, strategy, max_bytes=_no_limit):
+    """Every row with filter type None, deflated at level 9 with `strategy`."""
+    if img.mode == "P":
+        palette, transparency, bit_depth = _palette_chunks(img)
+        rawmode = "P" if bit_depth == 8 else f"P;{bit_depth}"
+    else:
+        palette, transparency, bit_depth = None, None, 8
+        rawmode = img.mode
+
+    channels = _UNFILTERED_CHANNELS[img.mode]
+    stride = (img.width * channels * bit_depth + 7) // 8
+    samples = memoryview(img.tobytes("raw", rawmode))
+    rows_per_chunk = max(1, _ROWS_CHUNK_BYTES // stride)
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, strategy)
+    segment = []
+    written = 0
+    adler = 1
+    for start in range(0, img.height * stride, rows_per_chunk * stride):
+        if time.monotonic() > deadline or _over(written, max_bytes):
+            raise _Expired()
+        end = min(start + rows_per_chunk * stride, img.height * stride)
+        raw = b"".join(
+            b"\x00" + samples[offset:offset + stride] for offset in range(start, end, stride)
+        )
+        adler = zlib.adler32(raw, adler)
+        segment.append(compressor.compress(raw))
+        written += len(segment[-1])
+    segment.append(compressor.flush(zlib.Z_FULL_FLUSH))
+
+    encoder = PngBandEncoder(img.width, img.height, channels, bit_depth, palette, transparency)
+    raw_length = img.height * (stride + 1)
+    return encoder.header() + encoder.segment(b"".join(segment), adler, raw_length) + encoder.finish()
+
+
+def _can_encode_unfiltered(img):
+    # Chunks Pillow would carry over (colour profile, transparency key) are
+    # left to the Pillow trials.
+    if img.mode not in _UNFILTERED_CHANNELS or "icc_profile" in img.info:
+        return False
+    if img.mode == "P":
+        return "transparency" not in img.info and img.palette.mode in ("RGB", "RGBA")
+    return "transparency" not in img.info
+
+
+def _variants(img, colors):
+    """Yield the forms of `img` worth encoding, likeliest winners first."""
+    if "icc_profile" in img.info or "transparency" in img.info:
+        # The reductions below would drop the profile or transparent colour.
+        yield img
+        return
+
+    reduced = _reduced(img)
+    palette = _palettized(reduced)
+    if colors and (palette is None or len(palette.getcolors(256)) > colors):
+        # Asked for, and nearly always the smallest: queued first.
+        yield _quantized(reduced, colors)
+    # An exact palette is usually far smaller, but its PLTE and tRNS chunks
+    # can outweigh the saving on small images.
+    if palette is not None:
+        yield palette
+    yield reduced
+
+
+def _encoders(img, max_bytes=_no_limit, pillow_default=True):
+    """
+    The trial encodes for `img`, each called as encode(img, deadline),
+    leaving out Pillow's own optimize=True encode unless `pillow_default`.
+    """
+    for filtered, strategy in TRIALS:
+        if filtered and strategy == _PILLOW_STRATEGY and not pillow_default:
+            continue
+        if filtered:
+            yield functools.partial(_encode_filtered, strategy=strategy, max_bytes=max_bytes)
+        elif _can_encode_unfiltered(img):
+            yield functools.partial(_encode_unfiltered, strategy=strategy, max_bytes=max_bytes)
+
+
+def _encode_plain(img, max_bytes=_no_limit):
+    """Pillow's optimize=True encode, as the routes made before the search."""
+    with _DeadlineBuffer(float("inf"), max_bytes) as buffer:
+        img.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+
+def optimize_png(img, colors=None, budget_ms=None, max_bytes=None):
+    """
+    Encode `img` as the smallest PNG found within `budget_ms` (default
+    PNG_OPTIMIZE_BUDGET_MS). Lossless unless `colors` (2-256) is given, in
+    which case a palette quantized to that many colours is tried as well.
+
+    `max_bytes`, if given, is called during the search for the size to beat
+    (or None); encodes stop once they outgrow it, and None is returned if
+    none came in under it.
+    """
+    budget_ms = PNG_OPTIMIZE_BUDGET_MS if budget_ms is None else budget_ms
+    max_bytes = max_bytes or _no_limit
+    deadline = time.monotonic() + budget_ms / 1000
+    pool = _get_pool()
+    futures = []
+
+    try:
+        for variant in _variants(img, colors):
+            # The image itself gets Pillow's own encode below, in this thread.
+            encoders = _encoders(variant, max_bytes, pillow_default=variant is not img)
+            futures.extend(pool.submit(encode, variant, deadline) for encode in encoders)
+            if time.monotonic() > deadline:
+                break
+
+        # Made here rather than queued, where it could wait behind other
+        # requests' trials; it is the answer if no trial finishes in time.
+        try:
+            best = _encode_plain(img, max_bytes)
+        except _Expired:
+            best = None
+        concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                data = future.result()
+                if best is None or len(data) < len(best):
+                    best = data
+        # Encodes that finished before the limit fell below them.
+        return None if best is None or _over(len(best), max_bytes) else best
+    finally:
+        # Trials still running stop at their next deadline check.
+        for future in futures:
+            future.cancel()
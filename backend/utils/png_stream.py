@@ -0,0 +1,138 @@
+"""
+Incremental PNG encoding for images produced in horizontal bands.
+
+Each band is deflated on its own into a segment that ends on a full flush, so
+segments can be compressed on different cores and simply concatenated into
+one zlib stream. The stream's Adler-32 checksum is combined from the
+per-segment checksums, which means the encoder never needs the raw pixels of
+more than one band at a time.
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG colour type by channel count: gray, gray+alpha, RGB, RGBA.
+_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+_PALETTE_COLOR_TYPE = 3
+
+# zlib header for a 32K window at the default level, and an empty final
+# fixed-Huffman block that terminates the concatenated deflate segments.
+_ZLIB_HEADER = b"\x78\x9c"
+_FINAL_BLOCK = b"\x03\x00"
+
+_ADLER_BASE = 65521
+
+
+def _chunk(tag, data):
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+
+def adler32_combine(adler1, adler2, len2):
+    """Return the Adler-32 of A + B given adler32(A), adler32(B) and len(B)."""
+    rem = len2 % _ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % _ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + _ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + _ADLER_BASE - rem
+
+    return (sum1 % _ADLER_BASE) | ((sum2 % _ADLER_BASE) << 16)
+
+
+def deflate_band(samples, stride, level=6, filter_type=0, strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Compress a band of rows into a standalone deflate segment.
+
+    Each row is tagged with PNG filter type `filter_type`, 0 (None) by
+    default; for any other type `samples` must already be filtered. Returns
+    (segment, adler32, raw_length), the three values PngBandEncoder.segment()
+    needs.
+    """
+    samples = memoryview(samples)
+    tag = bytes((filter_type,))
+    raw = b"".join(
+        tag + samples[offset:offset + stride]
+        for offset in range(0, len(samples), stride)
+    )
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy)
+    segment = compressor.compress(raw) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+    return segment, zlib.adler32(raw), len(raw)
+
+
+class PngBandEncoder:
+    """
+    Assemble a PNG from deflate segments produced top to bottom.
+
+    With `palette` (packed RGB triples) the image is indexed: one channel of
+    `bit_depth` bits per pixel, with `transparency` as the optional alpha of
+    the first palette entries. Gray and RGB images may instead take the
+    packed 16-bit gray or RGB value drawn transparent as `transparency`.
+    `icc_profile` is embedded as an iCCP chunk, as Pillow writes it.
+    """
+
+    def __init__(
+        self,
+        width,
+        height,
+        channels,
+        bit_depth=8,
+        palette=None,
+        transparency=None,
+        icc_profile=None,
+    ):
+        if palette is None and channels not in _COLOR_TYPES:
+            raise ValueError(f"Unsupported channel count: {channels}")
+        if palette is not None and (channels != 1 or bit_depth not in (1, 2, 4, 8)):
+            raise ValueError("Palette images have one channel of 1, 2, 4 or 8 bits")
+
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bit_depth = bit_depth
+        self.palette = palette
+        self.transparency = transparency
+        self.icc_profile = icc_profile
+        self._adler = 1
+        self._started = False
+
+    def header(self):
+        color_type = _PALETTE_COLOR_TYPE if self.palette is not None else _COLOR_TYPES[self.channels]
+        ihdr = struct.pack(
+            ">IIBBBBB",
+            self.width,
+            self.height,
+            self.bit_depth,
+            color_type,
+            0,
+            0,
+            0,
+        )
+        header = PNG_SIGNATURE + _chunk(b"IHDR", ihdr)
+        if self.icc_profile:
+            header += _chunk(b"iCCP", b"ICC Profile\0\0" + zlib.compress(self.icc_profile))
+        if self.palette is not None:
+            header += _chunk(b"PLTE", bytes(self.palette))
+        if self.transparency:
+            header += _chunk(b"tRNS", bytes(self.transparency))
+        return header
+
+    def segment(self, data, adler, raw_length):
+        """Return the IDAT chunk for the next band's segment."""
+        self._adler = adler32_combine(self._adler, adler, raw_length)
+
+        if not self._started:
+            self._started = True
+            data = _ZLIB_HEADER + data
+
+        return _chunk(b"IDAT", data)
+
+    def finish(self):
+        """Return the closing IDAT (end of stream and checksum) and IEND."""
+        tail = _FINAL_BLOCK + struct.pack(">I", self._adler)
+        if not self._started:
+            tail = _ZLIB_HEADER + tail
+
+        return _chunk(b"IDAT", tail) + _chunk(b"IEND", b"")
@@ -0,0 +1,150 @@
+"""
+Page rendering through poppler's pdftoppm, the alternative to PyMuPDF.
+
+pdf2image runs pdftoppm over a copy of the PDF on disk, splitting a page run
+across several pdftoppm processes that write their images straight to a
+scratch directory. Pages are read back, and deleted, in page order, a chunk
+at a time, so disk use is bounded by one chunk of pages per size.
+
+Only what pdftoppm can do without help is offered: DPI and width sizes, RGB
+or gray output and hiding annotations. PNG pages under the default profile
+and JPEG pages come straight from pdftoppm; other profiles are re-encoded
+from its raw PPM/PGM output through Pillow.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from pdf2image import convert_from_path
+from PIL import Image
+
+from utils.page_encoders import ENCODER_PROFILES, encode_image
+
+# Pages handed to one pdf2image call, across all of its pdftoppm processes.
+POPPLER_CHUNK_PAGES = int(os.getenv("POPPLER_CHUNK_PAGES", "32"))
+
+POPPLER_COLORSPACES = ("rgb", "gray")
+
+
+def poppler_available():
+    """Report whether the pdftoppm and pdfinfo binaries are installed."""
+    return all(shutil.which(tool) for tool in ("pdftoppm", "pdfinfo"))
+
+
+def _page_runs(page_numbers, chunk_pages):
+    """Cut sorted page numbers into runs of consecutive pages, at most chunk_pages long."""
+    runs = []
+    for page_num in page_numbers:
+        if runs and page_num == runs[-1][-1] + 1 and len(runs[-1]) < chunk_pages:
+            runs[-1].append(page_num)
+        else:
+            runs.append([page_num])
+    return runs
+
+
+def _output_format(profile):
+    """pdftoppm output format for `profile`, and whether Pillow re-encodes it."""
+    settings = ENCODER_PROFILES[profile]
+    if settings["format"] == "png" and settings["level"] is None:
+        return "png", False
+    if settings["format"] == "jpeg":
+        return "jpeg", False
+    return "ppm", True
+
+
+def _render_run(pdf_path, run, size, profile, colorspace, annots, workers, folder):
+    """Render one run of pages at one size; returns the image paths in page order."""
+    kind, value = size
+    fmt, _ = _output_format(profile)
+    settings = ENCODER_PROFILES[profile]
+
+    return convert_from_path(
+        pdf_path,
+        dpi=value if kind == "dpi" else 72,
+        size=(value, None) if kind == "width" else None,
+        first_page=run[0],
+        last_page=run[-1],
+        fmt=fmt,
+        jpegopt={"quality": settings["quality"]} if fmt == "jpeg" else None,
+        thread_count=min(workers, len(run)),
+        output_folder=folder,
+        paths_only=True,
+        grayscale=colorspace == "gray",
+        hide_annotations=not annots,
+        # MuPDF renders the crop box; pdftoppm defaults to the media box.
+        use_cropbox=True,
+    )
+
+
+def _read_image(path, profile, colorspace):
+    """Read one pdftoppm output as (data, width, height), deleting the file."""
+    try:
+        _, reencode = _output_format(profile)
+        with Image.open(path) as image:
+            width, height = image.size
+            if reencode:
+                image.load()
+                data = encode_image(image, profile)
+            else:
+                with open(path, "rb") as handle:
+                    data = handle.read()
+        return data, width, height
+    finally:
+        os.remove(path)
+
+
+def iter_poppler_pages(
+    pdf_bytes,
+    page_numbers,
+    targets,
+    profile,
+    colorspace="rgb",
+    annots=True,
+    workers=1,
+):
+    """
+    Yield (page_number, [(label, data, info)]) for each page, in page order,
+    rendered by pdftoppm with up to `workers` processes. `targets` are the
+    (label, size) pairs of pdf_render.render_targets(); only "dpi" and
+    "width" sizes are supported. info matches pdf_render.render_page_image(),
+    with a pdftoppm run's wall time spread evenly over its pages as render
+    time and no separate encode time.
+    """
+    channels = 3 if colorspace == "rgb" else 1
+
+    with tempfile.TemporaryDirectory(prefix="pdftoppm-") as folder:
+        pdf_path = os.path.join(folder, "document.pdf")
+        with open(pdf_path, "wb") as handle:
+            handle.write(pdf_bytes)
+
+        for run in _page_runs(page_numbers, POPPLER_CHUNK_PAGES):
+            outputs = []
+            for label, size in targets:
+                started = time.perf_counter()
+                paths = _render_run(pdf_path, run, size, profile, colorspace, annots, workers, folder)
+                render_ms = round((time.perf_counter() - started) * 1000 / len(run), 2)
+                outputs.append((label, size, paths, render_ms))
+
+            for index, page_num in enumerate(run):
+                images = []
+                for label, size, paths, render_ms in outputs:
+                    data, width, height = _read_image(paths[index], profile, colorspace)
+                    raw_bytes = width * height * channels
+                    images.append(
+                        (
+                            label,
+                            data,
+                            {
+                                "render_ms": render_ms,
+                                "encode_ms": None,
+                                "width": width,
+                                "height": height,
+                                "colorspace": colorspace,
+                                "raw_bytes": raw_bytes,
+                                "raw_bytes_saved": max(0, width * height * 3 - raw_bytes),
+                                "dpi": size[1] if size[0] == "dpi" else None,
+                            },
+                        )
+                    )
+                yield page_num, images
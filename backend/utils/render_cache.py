@@ -0,0 +1,215 @@
+"""
+Content-addressed cache for rendered PDF pages.
+
+Entries are keyed by a hash of the PDF bytes plus the render settings, so a
+repeat request for the same document is served from the cache no matter what
+the upload was called. The memory tier is a byte-bounded LRU. The optional disk
+tier (PDF_RENDER_CACHE_DIR) is shared by every worker on the host: lookups go
+to the filesystem, so a page one worker wrote is a hit in all of them, and
+after each write the directory is scanned and the least recently used files
+(by mtime) are removed until it is back under its size limit.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Memory tier size. 0 disables the memory tier.
+CACHE_MEMORY_BYTES = int(os.getenv("PDF_RENDER_CACHE_MB", "64")) * 1024 * 1024
+
+# Disk tier location and size. The disk tier is off unless a directory is set,
+# because rendered pages then outlive the request that produced them.
+CACHE_DIR = os.getenv("PDF_RENDER_CACHE_DIR", "")
+CACHE_DISK_BYTES = int(os.getenv("PDF_RENDER_CACHE_DISK_MB", "512")) * 1024 * 1024
+
+# Page counts remembered per document, so a fully cached request never has to
+# open the PDF just to validate the page range.
+MAX_DOCUMENT_ENTRIES = 1024
+
+
+def document_key(pdf_bytes):
+    """Return the content hash that identifies a PDF in the cache."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def page_key(pdf_key, page_index, dpi, colorspace="rgb", profile="default"):
+    """Return the cache key for one rendered page."""
+    return f"{pdf_key}:{page_index}:{dpi}:{colorspace}:{profile}"
+
+
+def _file_name(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".bin"
+
+
+class RenderCache:
+    """Two-tier LRU cache of encoded page images."""
+
+    def __init__(self, max_memory_bytes, disk_dir="", max_disk_bytes=0):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes if disk_dir else 0
+        self.disk_dir = disk_dir
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._page_counts = OrderedDict()
+        # Serializes this process's directory scans; other workers may scan
+        # at the same time, which only makes some removals fail.
+        self._evict_lock = threading.Lock()
+
+        if self.max_disk_bytes:
+            self._open_disk()
+
+    @classmethod
+    def from_env(cls):
+        return cls(CACHE_MEMORY_BYTES, CACHE_DIR, CACHE_DISK_BYTES)
+
+    @property
+    def enabled(self):
+        return bool(self.max_memory_bytes or self.max_disk_bytes)
+
+    def _open_disk(self):
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._evict_disk()
+        except OSError:
+            logger.exception("Render cache directory is unusable; disk tier disabled.")
+            self.max_disk_bytes = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, _file_name(key))
+
+    def contains(self, key):
+        """Report whether `key` is cached, without reading it."""
+        with self._lock:
+            if key in self._memory:
+                return True
+        return bool(self.max_disk_bytes) and os.path.isfile(self._disk_path(key))
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        if not self.max_disk_bytes:
+            return None
+        data = self._read_disk(self._disk_path(key))
+        if data is not None:
+            with self._lock:
+                self._store_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        """Cache `data` under `key` in both tiers."""
+        with self._lock:
+            self._store_memory(key, data)
+
+        if self.max_disk_bytes and len(data) <= self.max_disk_bytes:
+            self._write_disk(self._disk_path(key), data)
+
+    def get_page_count(self, pdf_key):
+        with self._lock:
+            count = self._page_counts.get(pdf_key)
+            if count is not None:
+                self._page_counts.move_to_end(pdf_key)
+            return count
+
+    def put_page_count(self, pdf_key, page_count):
+        with self._lock:
+            self._page_counts[pdf_key] = page_count
+            self._page_counts.move_to_end(pdf_key)
+            while len(self._page_counts) > MAX_DOCUMENT_ENTRIES:
+                self._page_counts.popitem(last=False)
+
+    def clear(self):
+        """Empty the memory tier and forget cached page counts."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._page_counts.clear()
+
+    def _store_memory(self, key, data):
+        # Caller holds the lock.
+        if len(data) > self.max_memory_bytes:
+            return
+
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, path):
+        try:
+            with open(path, "rb") as cached_file:
+                data = cached_file.read()
+            # The file's mtime is its place in the LRU order of every worker.
+            os.utime(path)
+            return data
+        except OSError:
+            # Not cached, or another worker evicted it first.
+            return None
+
+    def _write_disk(self, path, data):
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            # Atomic rename, so a concurrent reader never sees half a file.
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Failed to write render cache entry.")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+
+        try:
+            self._evict_disk()
+        except OSError:
+            logger.exception("Failed to evict render cache entries.")
+
+    def _disk_entries(self):
+        """(mtime, path, size) of every cached file, whichever worker wrote it."""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".bin"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _evict_disk(self):
+        with self._evict_lock:
+            entries = self._disk_entries()
+            total = sum(size for _, _, size in entries)
+            # Least recently used first.
+            for _, path, size in sorted(entries):
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Another worker removed it first; it is gone either way.
+                    pass
+                total -= size
+
+
+render_cache = RenderCache.from_env()
@@ -0,0 +1,339 @@
+"""
+Compression to a target file size, or to a target visual quality.
+
+Encoded size falls steadily, though not linearly, with quality. The search
+first encodes a downscaled proxy of the image at a ladder of qualities, in
+parallel, which gives the shape of the size/quality curve for a fraction of
+the cost. A few full-size encodes then calibrate the proxy's curve to the
+real image and close in on the highest quality that fits. Each full encode
+brackets the answer from one side, so the search ends after a bounded number
+of them however the curve is shaped.
+
+When resizing is allowed, quality is not lowered past RESIZE_MIN_QUALITY;
+the image is scaled down instead, by the factor its pixel count suggests,
+and the quality search runs again at the new size.
+
+A visual-quality target is a minimum SSIM against the source instead of a
+size. A downscaled proxy would hide exactly the artifacts being measured,
+so trial encodes are made of a mosaic of full-resolution tiles sampled
+across the image instead. The tiles sit on the encoder's 16-pixel block
+grid, so a JPEG mosaic decodes to the same pixels as those blocks of the
+full encode would. Each trial is scored on luminance with a vectorized
+SSIM; a ladder of qualities brackets the lowest one that passes and a
+short bisection pins it down, so only the final encode is made at full
+size.
+"""
+import concurrent.futures
+import io
+import itertools
+import math
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+TARGET_SIZE_WORKERS = int(os.getenv("TARGET_SIZE_WORKERS", str(os.cpu_count() or 1)))
+
+# Pixels in the proxy the quality ladder is encoded from.
+TARGET_PROXY_PIXELS = 250_000
+PROXY_QUALITIES = (95, 85, 75, 65, 55, 45, 35, 25, 15, 5)
+
+MIN_QUALITY = 5
+MAX_QUALITY = 95
+RESIZE_MIN_QUALITY = 50
+
+# Full-size encodes per quality search, and how close in quality the best
+# fit must be to the first setting known not to fit before the search stops.
+MAX_FULL_ENCODES = 4
+QUALITY_TOLERANCE = 2
+
+# Times the image may be scaled down, and the margin under the budget each
+# scale aims for.
+MAX_RESIZE_ROUNDS = 3
+RESIZE_MARGIN = 0.95
+
+# Pixels sampled for SSIM trial encodes, and the side of each sampled tile
+# (a multiple of the 16-pixel JPEG block with chroma subsampling).
+SSIM_PROXY_PIXELS = 500_000
+SSIM_TILE = 128
+SSIM_QUALITIES = (95, 80, 65, 50, 35, 20, 5)
+# Bisection steps after the ladder: enough to close a gap of 15 qualities.
+MAX_SSIM_REFINEMENTS = 4
+
+# SSIM's square window and stabilizing constants, as in Wang et al. (2004)
+# and skimage.metrics.structural_similarity's defaults for 8-bit images.
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    # Separate from the image batch pool: a batch worker waits on these
+    # encodes, so sharing one pool could leave every worker waiting.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=TARGET_SIZE_WORKERS,
+                thread_name_prefix="target-size",
+            )
+        return _pool
+
+
+def _proxy(img):
+    """A downscaled copy of `img` for trial encodes, and its pixel ratio to `img`."""
+    pixels = img.width * img.height
+    if pixels <= TARGET_PROXY_PIXELS:
+        return img, 1.0
+
+    factor = math.sqrt(TARGET_PROXY_PIXELS / pixels)
+    size = (max(1, round(img.width * factor)), max(1, round(img.height * factor)))
+    proxy = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return proxy, pixels / (size[0] * size[1])
+
+
+def _interpolate(curve, quality):
+    """Value of `curve` ({quality: value}) at `quality`, linear between its points."""
+    points = sorted(curve.items())
+    if quality <= points[0][0]:
+        return points[0][1]
+    for (q0, s0), (q1, s1) in itertools.pairwise(points):
+        if quality <= q1:
+            return s0 + (s1 - s0) * (quality - q0) / (q1 - q0)
+    return points[-1][1]
+
+
+def _search_quality(img, encode, target_bytes, min_quality):
+    """
+    Return (best, smallest, encodes): the highest-quality encode of `img`
+    in [min_quality, MAX_QUALITY] that fits, as (quality, data), or None;
+    the lowest-quality encode made; and the number of encodes tried.
+    """
+    qualities = sorted({q for q in PROXY_QUALITIES if q > min_quality} | {min_quality})
+    proxy, ratio = _proxy(img)
+    try:
+        sizes = list(_get_pool().map(lambda quality: len(encode(proxy, quality)), qualities))
+    finally:
+        if proxy is not img:
+            proxy.close()
+    curve = dict(zip(qualities, sizes))
+    encodes = len(qualities)
+
+    # Qualities up to `low` are known (or assumed) to fit, from `high` up do not.
+    low, high = min_quality - 1, MAX_QUALITY + 1
+    # Full size over proxy size, by quality: the proxy has more detail per
+    # pixel, and how much that costs depends on the quality.
+    scales = {}
+    best = smallest = None
+
+    for _ in range(MAX_FULL_ENCODES):
+        if high - low <= 1 or (best and high - low <= QUALITY_TOLERANCE):
+            break
+
+        quality = next(
+            (
+                q
+                for q in range(high - 1, low, -1)
+                if _interpolate(curve, q) * (_interpolate(scales, q) if scales else ratio) <= target_bytes
+            ),
+            low + 1,
+        )
+        data = encode(img, quality)
+        encodes += 1
+        scales[quality] = len(data) / _interpolate(curve, quality)
+
+        if smallest is None or quality < smallest[0]:
+            smallest = (quality, data)
+        if len(data) <= target_bytes:
+            best, low = (quality, data), quality
+        else:
+            high = quality
+
+    if best is None and smallest[0] > min_quality:
+        # The bounded search ran out before reaching the floor.
+        data = encode(img, min_quality)
+        encodes += 1
+        smallest = (min_quality, data)
+        if len(data) <= target_bytes:
+            best = smallest
+
+    return best, smallest, encodes
+
+
+def fit_to_size(img, encode, target_bytes, lossy=True, allow_resize=False):
+    """
+    Encode `img` with `encode(image, quality)` at the highest quality whose
+    output is at most `target_bytes` (`quality` is None when not `lossy`),
+    scaling the image down as well when `allow_resize`. Returns (data,
+    report), where report holds the chosen "quality" and "scale", the number
+    of "encodes" tried and whether the "target_met". When nothing fits, data
+    is the smallest encode made. Lossy trial encodes of one image run side by
+    side, so `encode` must save a copy (see image_ops.encode_copy()).
+    """
+    min_quality = RESIZE_MIN_QUALITY if allow_resize else MIN_QUALITY
+    current = img
+    scale = 1.0
+    encodes = 0
+
+    try:
+        for resize_round in range(MAX_RESIZE_ROUNDS + 1):
+            if lossy:
+                best, smallest, tried = _search_quality(current, encode, target_bytes, min_quality)
+            else:
+                smallest = (None, encode(current, None))
+                best = smallest if len(smallest[1]) <= target_bytes else None
+                tried = 1
+            encodes += tried
+
+            result = best or smallest
+            done = best is not None or not allow_resize or resize_round == MAX_RESIZE_ROUNDS
+            if done or (current.width == 1 and current.height == 1):
+                return result[1], {
+                    "quality": result[0],
+                    "scale": round(scale, 4),
+                    "encodes": encodes,
+                    "target_met": best is not None,
+                }
+
+            # Encoded size roughly follows the pixel count.
+            scale *= math.sqrt(target_bytes / len(smallest[1])) * RESIZE_MARGIN
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            if current is not img:
+                current.close()
+            current = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    finally:
+        if current is not img:
+            current.close()
+
+
+def _mosaic(img):
+    """
+    `img` itself when it is small enough to score whole, else a mosaic of
+    SSIM_TILE tiles taken at evenly spaced, block-aligned positions.
+    """
+    if img.width * img.height <= SSIM_PROXY_PIXELS:
+        return img
+
+    tile_w, tile_h = min(SSIM_TILE, img.width), min(SSIM_TILE, img.height)
+    cols, rows = img.width // tile_w, img.height // tile_h
+    # Keep the grid's aspect ratio while sampling about SSIM_PROXY_PIXELS.
+    factor = math.sqrt(SSIM_PROXY_PIXELS / (tile_w * tile_h) / (cols * rows))
+    cols = max(1, min(cols, int(cols * factor)))
+    rows = max(1, min(rows, SSIM_PROXY_PIXELS // (tile_w * tile_h * cols)))
+
+    def offsets(count, tile, length):
+        last = length - tile
+        return [i * last // max(1, count - 1) // 16 * 16 for i in range(count)]
+
+    mosaic = Image.new(img.mode, (cols * tile_w, rows * tile_h))
+    for row, top in enumerate(offsets(rows, tile_h, img.height)):
+        for col, left in enumerate(offsets(cols, tile_w, img.width)):
+            with img.crop((left, top, left + tile_w, top + tile_h)) as tile:
+                mosaic.paste(tile, (col * tile_w, row * tile_h))
+    return mosaic
+
+
+def _window_sums(values):
+    """Sums of `values` over every SSIM window that fits inside the array."""
+    # Integral image: exact in int64 for 8-bit values and their products.
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    w = SSIM_WINDOW
+    sums = table[w:, w:] - table[:-w, w:] - table[w:, :-w] + table[:-w, :-w]
+    return sums.astype(np.float32)
+
+
+def _luminance(img):
+    """The luminance of `img` as an int32 array, wide enough for products."""
+    with img.convert("L") as gray:
+        return np.asarray(gray, dtype=np.int32)
+
+
+def _reference(img):
+    """The luminance of `img` and its per-window sums and scaled variances."""
+    x = _luminance(img)
+    sum_x = _window_sums(x)
+    return x, sum_x, _window_sums(x * x) - sum_x * sum_x / SSIM_WINDOW**2
+
+
+def _similarity(reference, data):
+    """
+    Mean SSIM of the decoded `data` against `reference` (from _reference()).
+    Works on window sums rather than means, which scales every term by the
+    window's pixel count n; the constants are scaled to match.
+    """
+    x, sum_x, var_x = reference
+    with Image.open(io.BytesIO(data)) as decoded:
+        y = _luminance(decoded)
+
+    n = SSIM_WINDOW**2
+    sum_y = _window_sums(y)
+    var_y = _window_sums(y * y) - sum_y * sum_y / n
+    cov = _window_sums(x * y) - sum_x * sum_y / n
+    # Sample (n - 1) rather than population variances, as skimage uses.
+    k = n / (n - 1)
+    numerator = (2 * sum_x * sum_y + SSIM_C1 * n * n) * (2 * k * cov + SSIM_C2 * n)
+    denominator = (sum_x * sum_x + sum_y * sum_y + SSIM_C1 * n * n) * (
+        k * (var_x + var_y) + SSIM_C2 * n
+    )
+    return float((numerator / denominator).mean(dtype=np.float64))
+
+
+def fit_to_ssim(img, encode, min_ssim):
+    """
+    Encode `img` with `encode(image, quality)` at the lowest quality whose
+    output scores at least `min_ssim` against `img`. Returns (data, report),
+    where report holds the chosen "quality", its "ssim" (measured on the
+    sampled tiles), the number of "encodes" tried and whether the
+    "target_met". When no quality reaches `min_ssim`, data is encoded at
+    MAX_QUALITY. Trial encodes of one image run side by side, so `encode`
+    must save a copy (see image_ops.encode_copy()).
+    """
+    if min(img.size) < SSIM_WINDOW:
+        raise ValueError(f"min_ssim needs an image at least {SSIM_WINDOW} pixels on each side.")
+
+    proxy = _mosaic(img)
+    try:
+        reference = _reference(proxy)
+
+        def score(quality):
+            return _similarity(reference, encode(proxy, quality))
+
+        scores = dict(zip(SSIM_QUALITIES, _get_pool().map(score, SSIM_QUALITIES)))
+        encodes = len(scores)
+
+        # Qualities from `high` up pass and `low` fails. SSIM falls with
+        # quality, so the scan stops at the first failure.
+        low, high = MIN_QUALITY - 1, None
+        for quality in sorted(scores, reverse=True):
+            if scores[quality] < min_ssim:
+                low = quality
+                break
+            high = quality
+
+        if high is not None:
+            for _ in range(MAX_SSIM_REFINEMENTS):
+                if high - low <= 1:
+                    break
+                quality = (low + high) // 2
+                scores[quality] = score(quality)
+                encodes += 1
+                if scores[quality] >= min_ssim:
+                    high = quality
+                else:
+                    low = quality
+    finally:
+        if proxy is not img:
+            proxy.close()
+
+    quality = MAX_QUALITY if high is None else high
+    return encode(img, quality), {
+        "quality": quality,
+        "ssim": round(scores[quality], 4),
+        "encodes": encodes + 1,
+        "target_met": high is not None,
+    }
@@ -140,7 +140,12 @@ def validate_mime_type(
 
     return None
 
-def validate_image_file(file):
+def validate_image_file(file, before_load=None):
+    """
+    Return (img, file_bytes, error) for an uploaded image, decoded. A
+    `before_load` callable gets the opened image before its pixels are
+    decoded, e.g. to shrink the decode with img.draft().
+    """
     mime_error = validate_mime_type(
         file,
         ALLOWED_IMAGE_MIME_TYPES,
@@ -153,6 +158,8 @@ def validate_image_file(file):
     try:
         file_bytes = file.read()
         img = Image.open(io.BytesIO(file_bytes))
+        if before_load:
+            before_load(img)
         img.load()
 
         return img, file_bytes, None
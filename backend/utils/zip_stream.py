@@ -0,0 +1,74 @@
+"""
+Incremental ZIP writer for streamed download responses.
+
+zipfile can write to a stream that only supports write(): it falls back to
+data descriptors instead of seeking back to patch headers. Each entry is
+flushed out as soon as it is written, so only one entry is ever held in memory.
+"""
+import posixpath
+import zipfile
+
+from werkzeug.utils import secure_filename
+
+
+class _ChunkSink:
+    """Write-only file object that collects bytes until they are drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def unique_stems(names, fallback):
+    """
+    One unique, filesystem-safe stem per uploaded name, for naming its ZIP
+    entries: "report.pdf" twice becomes "report" and "report-2".
+    """
+    stems = []
+    seen = set()
+
+    for name in names:
+        stem = secure_filename(posixpath.basename(name)).rsplit(".", 1)[0] or fallback
+        unique, copy = stem, 1
+        while unique in seen:
+            copy += 1
+            unique = f"{stem}-{copy}"
+        seen.add(unique)
+        stems.append(unique)
+
+    return stems
+
+
+def iter_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yield a ZIP archive chunk by chunk.
+
+    `entries` is an iterable of (name, data) pairs, or (name, data,
+    compress_type) to override `compression` for one entry. It is consumed
+    lazily, so a generator that renders each entry on demand is never more
+    than one entry ahead of the client.
+    """
+    sink = _ChunkSink()
+
+    with zipfile.ZipFile(sink, "w", compression) as zip_file:
+        for name, data, *compress_type in entries:
+            zip_file.writestr(name, data, *compress_type)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+
+    # Central directory, written when the archive is closed.
+    chunk = sink.drain()
+    if chunk:
+        yield chunk